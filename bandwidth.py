@@ -0,0 +1,101 @@
+# Streaming alternate settings
+#
+# Real cameras expose a ladder of VideoStreaming alternates with increasing
+# isochronous packet sizes, and the host selects the smallest one whose
+# bandwidth covers dwMaxPayloadTransferSize from the committed probe. Offering
+# only one large alternate makes every emulated camera reserve worst-case bus
+# bandwidth, so several can't share a bus.
+#
+# High-speed isochronous endpoints can carry up to 3 transactions per
+# microframe (wMaxPacketSize bits 12:11), full-speed ones a single packet of
+# up to 1023 bytes per frame. SuperSpeed endpoints burst up to 16 packets of
+# 1024 bytes, times Mult+1 (up to 3), per service interval, described by a
+# SuperSpeed Endpoint Companion descriptor (USB 3.2, 9.6.7) after the
+# endpoint descriptor
+
+import bisect
+import struct
+
+from dataclasses import dataclass
+from typing import List
+
+from facedancer import DeviceSpeed
+
+
+FS_PACKET_SIZES = (128, 256, 512, 1023)
+HS_PACKET_SIZES = (128, 256, 512, 768, 1024)
+HS_MAX_TRANSACTIONS = 3
+
+SS_PACKET_SIZE = 1024
+SS_SMALL_PACKET_SIZES = (128, 256, 512)
+SS_MAX_BURST = 15
+SS_MAX_MULT = 2
+
+SS_ENDPOINT_COMPANION = 0x30
+
+
+@dataclass(frozen=True)
+class StreamingAlternate:
+    alternate: int
+    max_packet_size: int
+    # Transactions per (micro)frame: the high-speed high-bandwidth multiplier,
+    # or Mult + 1 at SuperSpeed
+    transactions: int = 1
+    # SuperSpeed bMaxBurst, packets per burst - 1
+    max_burst: int = 0
+    superspeed: bool = False
+
+    @property
+    def bytes_per_interval(self) -> int:
+        return self.max_packet_size * self.transactions * (self.max_burst + 1)
+
+    @property
+    def w_max_packet_size(self) -> int:
+        """ wMaxPacketSize as it appears in the endpoint descriptor """
+        if self.superspeed:
+            return self.max_packet_size
+        return self.max_packet_size | ((self.transactions - 1) << 11)
+
+    def companion_descriptor(self) -> bytes:
+        """ SuperSpeed Endpoint Companion descriptor; empty below SuperSpeed """
+        if not self.superspeed:
+            return b''
+        return struct.pack('<BBBBH', 6, SS_ENDPOINT_COMPANION, self.max_burst,
+                           self.transactions - 1, self.bytes_per_interval)
+
+
+def bandwidth_ladder(speed: DeviceSpeed, first_alternate: int = 1) -> List[StreamingAlternate]:
+    """ Streaming alternates for `speed`, ordered by bandwidth """
+    if speed >= DeviceSpeed.SUPER:
+        return superspeed_ladder(first_alternate)
+
+    if speed == DeviceSpeed.FULL or speed == DeviceSpeed.LOW:
+        rungs = [(size, 1) for size in FS_PACKET_SIZES]
+    else:
+        rungs = [(size, 1) for size in HS_PACKET_SIZES]
+        # Past one full packet, add transactions instead
+        largest = HS_PACKET_SIZES[-1]
+        for transactions in range(2, HS_MAX_TRANSACTIONS + 1):
+            rungs += [(size, transactions) for size in HS_PACKET_SIZES
+                      if size * transactions > largest * (transactions - 1)]
+        rungs.sort(key=lambda rung: rung[0] * rung[1])
+
+    return [StreamingAlternate(first_alternate + i, size, transactions)
+            for i, (size, transactions) in enumerate(rungs)]
+
+
+def superspeed_ladder(first_alternate: int = 1) -> List[StreamingAlternate]:
+    """ Single small packets, then bursts of 1, 2, 4, 8 and 16 full packets, then Mult 1 and 2 """
+    rungs = [(size, 1, 0) for size in SS_SMALL_PACKET_SIZES]
+    rungs += [(SS_PACKET_SIZE, 1, burst - 1) for burst in (1, 2, 4, 8, 16)]
+    rungs += [(SS_PACKET_SIZE, mult + 1, SS_MAX_BURST) for mult in range(1, SS_MAX_MULT + 1)]
+
+    return [StreamingAlternate(first_alternate + i, size, transactions, burst, superspeed=True)
+            for i, (size, transactions, burst) in enumerate(rungs)]
+
+
+def pick_alternate(ladder: List[StreamingAlternate], payload_transfer_size: int) -> StreamingAlternate:
+    """ Smallest alternate that carries `payload_transfer_size` bytes per interval, else the largest """
+    capacities = [alternate.bytes_per_interval for alternate in ladder]
+    index = bisect.bisect_left(capacities, payload_transfer_size)
+    return ladder[min(index, len(ladder) - 1)]
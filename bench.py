@@ -0,0 +1,229 @@
+# Control path benchmark
+#
+# Drives the Webcam device from fake-cam.py through a stand-in facedancer
+# backend, no Cynthion needed, replaying what a Linux host does on connect:
+# enumeration, reading the strings, SET_CONFIGURATION, probe/commit and
+# starting and stopping the stream. The sequence runs --iterations times and
+# every handle_request() call is timed, then reported as p50/p99 per request.
+# A second, shorter pass under tracemalloc measures the memory each request
+# allocates (peak) and keeps (net), since tracing skews the timings
+#
+#   python bench.py                      table on stdout
+#   python bench.py --json > bench.json  to compare across changes
+
+import argparse
+import json
+import logging
+import runpy
+import statistics
+import sys
+import time
+import tracemalloc
+
+from collections import defaultdict
+from pathlib import Path
+
+from facedancer.backends.base import FacedancerBackend
+
+from enum_timing import describe
+from probe import pack_probe
+
+
+DEFAULT_ITERATIONS = 2000
+DEFAULT_ALLOCATION_ITERATIONS = 50
+
+
+class BenchmarkBackend(FacedancerBackend):
+    """ Accepts everything the device sends and only counts it """
+
+    def __init__(self, device=None, verbose: int = 0, quirks=None):
+        self.device = device
+        self.control_replies = 0
+        self.stalls = 0
+        self.endpoint_bytes = 0
+
+    def connect(self, usb_device, max_packet_size_ep0: int = 64, device_speed=None):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def set_address(self, address: int, defer: bool = False):
+        pass
+
+    def configured(self, configuration):
+        pass
+
+    def send_on_control_endpoint(self, endpoint_number, in_request, data, blocking=True):
+        self.control_replies += 1
+
+    def send_on_endpoint(self, endpoint_number, data, blocking=True):
+        self.endpoint_bytes += len(data)
+
+    def ack_status_stage(self, direction=None, endpoint_number=0, blocking=False):
+        self.control_replies += 1
+
+    def stall_endpoint(self, endpoint_number, direction=None):
+        self.stalls += 1
+
+    def clear_halt(self, endpoint_number, direction=None):
+        pass
+
+
+def load_device_module() -> dict:
+    return runpy.run_path(str(Path(__file__).with_name('fake-cam.py')), run_name='fake_cam')
+
+
+def connect_sequence(module: dict, device) -> list:
+    """ (setup bytes, OUT data) of everything a Linux host sends on connect """
+    probe_length = device.probe_commit.length
+    probe = lambda request, selector: bytes([0xa1 if request & 0x80 else 0x21, request]) + \
+        bytes([0, selector, 1, 0, probe_length, 0])
+    UVC = module['uvc'].UVC
+
+    sequence = [
+        (bytes.fromhex('8006000100004000'), b''),
+        (bytes.fromhex('0005010000000000'), b''),
+        (bytes.fromhex('8006000100001200'), b''),
+        (bytes.fromhex('8006000200000900'), b''),
+        (bytes.fromhex('800600020000ffff'), b''),
+        (bytes.fromhex('800600030000ff00'), b''),
+        (bytes.fromhex('800601030904ff00'), b''),
+        (bytes.fromhex('800602030904ff00'), b''),
+        (bytes.fromhex('800603030904ff00'), b''),
+        (bytes.fromhex('0009010000000000'), b''),
+        (bytes.fromhex('a186000200010100'), b''),
+        (bytes.fromhex('a181000200010100'), b''),
+        (bytes.fromhex('010b000001000000'), b''),
+        (probe(UVC.GET_INFO, UVC.VS_PROBE_CONTROL)[:6] + b'\x01\x00', b''),
+        (probe(UVC.GET_DEF, UVC.VS_PROBE_CONTROL), b''),
+        (probe(UVC.SET_CUR, UVC.VS_PROBE_CONTROL), None),
+        (probe(UVC.GET_CUR, UVC.VS_PROBE_CONTROL), b''),
+        (probe(UVC.GET_MIN, UVC.VS_PROBE_CONTROL), b''),
+        (probe(UVC.GET_MAX, UVC.VS_PROBE_CONTROL), b''),
+        (probe(UVC.SET_CUR, UVC.VS_COMMIT_CONTROL), None),
+    ]
+
+    # Start streaming on the alternate the committed probe fits, then stop
+    ladder = module['STREAMING_LADDER']
+    if ladder:
+        committed = device.probe_commit.default
+        alternate = module['pick_alternate'](ladder, committed['dwMaxPayloadTransferSize']).alternate
+        sequence.append((bytes([0x01, 0x0b, alternate, 0, 1, 0, 0, 0]), b''))
+        sequence.append((bytes.fromhex('010b000001000000'), b''))
+
+    # SET_CUR sends the host's proposal: the default probe
+    proposal = pack_probe(device.probe_commit.default, probe_length)
+    return [(setup, proposal if data is None else data) for setup, data in sequence]
+
+
+def run_once(device, sequence, timings=None, allocations=None):
+    clock = time.perf_counter_ns
+    # Keyed by position, the same request can appear more than once
+    for position, (setup, data) in enumerate(sequence):
+        request = device.create_request(setup)
+        request.data = data
+
+        if allocations is not None:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            device.handle_request(request)
+            after, peak = tracemalloc.get_traced_memory()
+            allocations[position].append((peak - before, after - before))
+        else:
+            start = clock()
+            device.handle_request(request)
+            timings[position].append(clock() - start)
+
+
+def percentile(samples, fraction: float):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def benchmark(iterations: int = DEFAULT_ITERATIONS,
+              allocation_iterations: int = DEFAULT_ALLOCATION_ITERATIONS,
+              log_level: int = logging.WARNING) -> dict:
+    module = load_device_module()
+    # fake-cam.py turns on TRACE logging when it's loaded
+    logging.getLogger().setLevel(log_level)
+    logging.getLogger('facedancer').setLevel(log_level)
+
+    device = module['Webcam']()
+    device.backend = BenchmarkBackend(device)
+    sequence = connect_sequence(module, device)
+
+    # Warm up caches and lazy imports outside the measurements
+    run_once(device, sequence, defaultdict(list))
+
+    timings = defaultdict(list)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        run_once(device, sequence, timings)
+    elapsed = time.perf_counter() - start
+
+    allocations = defaultdict(list)
+    tracemalloc.start()
+    for _ in range(allocation_iterations):
+        run_once(device, sequence, allocations=allocations)
+    tracemalloc.stop()
+
+    requests = []
+    for position, (setup, _) in enumerate(sequence):
+        samples = timings[position]
+        memory = allocations[position]
+        requests.append({
+            'setup': setup.hex(),
+            'request': describe(setup),
+            'p50_us': round(percentile(samples, 0.50) / 1e3, 2),
+            'p99_us': round(percentile(samples, 0.99) / 1e3, 2),
+            'mean_us': round(statistics.fmean(samples) / 1e3, 2),
+            'peak_bytes': round(statistics.median(peak for peak, _ in memory)),
+            'retained_bytes': round(statistics.median(net for _, net in memory)),
+        })
+
+    all_samples = [sample for samples in timings.values() for sample in samples]
+    return {
+        'iterations': iterations,
+        'requests_per_iteration': len(sequence),
+        'connects_per_second': round(iterations / elapsed, 1),
+        'p50_us': round(percentile(all_samples, 0.50) / 1e3, 2),
+        'p99_us': round(percentile(all_samples, 0.99) / 1e3, 2),
+        'stalls': device.backend.stalls,
+        'requests': requests,
+    }
+
+
+def print_results(results: dict, out=sys.stdout):
+    print(f"{results['iterations']} connects of {results['requests_per_iteration']} requests, "
+          f"{results['connects_per_second']} connects/s, p50 {results['p50_us']} us, "
+          f"p99 {results['p99_us']} us, {results['stalls']} stalls", file=out)
+    print(f"{'p50 us':>9} {'p99 us':>9} {'peak B':>8} {'kept B':>7}  request", file=out)
+    for request in results['requests']:
+        print(f"{request['p50_us']:>9.2f} {request['p99_us']:>9.2f} {request['peak_bytes']:>8} "
+              f"{request['retained_bytes']:>7}  {request['request']}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Webcam control request path")
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--allocation-iterations', type=int, default=DEFAULT_ALLOCATION_ITERATIONS)
+    parser.add_argument('--json', action='store_true', help="write the results as JSON to stdout")
+    parser.add_argument('--log-level', default='WARNING',
+                        help="facedancer log level while benchmarking; TRACE measures logging too")
+    args = parser.parse_args(argv)
+
+    level = logging.getLevelName(args.log_level.upper())
+    results = benchmark(args.iterations, args.allocation_iterations, level)
+    if args.json:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,9 @@
 from facedancer.configuration import USBConfiguration
 from facedancer.descriptor    import USBDescribable, USBDescriptor, StringRef
 from facedancer.magic         import instantiate_subordinates, AutoInstantiable
-from facedancer.request       import USBRequestHandler
+from facedancer.request       import USBRequestHandler, standard_request_handler, to_this_interface
 from facedancer.interface     import USBInterface
+from facedancer.types         import USBStandardRequests
 
 from dataclasses  import field
 
@@ -51,3 +52,42 @@ class USBConfigurationOverride(USBConfiguration):
         # Gather any interfaces attached to the configuration.
         for interface in instantiate_subordinates(self, USBInterface):
             self.add_interface(interface)
+
+        # ... and any built at runtime, e.g. a ladder of alternate settings
+        for interface in self.generate_interfaces():
+            self.add_interface(interface)
+
+    def generate_interfaces(self):
+        return ()
+
+
+# Another hack: the configuration offers interface requests to every alternate
+# setting of an interface, so with several alternates SET_INTERFACE and
+# GET_INTERFACE get answered once per alternate. Only let the alternate being
+# selected (or the one currently active) answer
+class USBAlternateInterface(USBInterface):
+
+    @standard_request_handler(number=USBStandardRequests.SET_INTERFACE)
+    @to_this_interface
+    def handle_set_interface_request(self, request):
+        if request.value != self.alternate:
+            raise NotImplementedError()
+        USBInterface.handle_set_interface_request(self, request)
+
+        configuration = self.parent
+        if configuration.parent.configuration is configuration and \
+                configuration.active_interfaces.get(self.number) is self:
+            self.handle_alternate_selected()
+
+    @standard_request_handler(number=USBStandardRequests.GET_INTERFACE)
+    @to_this_interface
+    def handle_get_interface_request(self, request):
+        configuration = self.parent
+        active = getattr(configuration, 'active_interfaces', {}).get(self.number)
+        # Unconfigured, alternate 0 answers (and stalls)
+        if active is not self and not (active is None and self.alternate == 0):
+            raise NotImplementedError()
+        USBInterface.handle_get_interface_request(self, request)
+
+    def handle_alternate_selected(self):
+        """ Called after the host selects this alternate setting with SET_INTERFACE """
@@ -0,0 +1,380 @@
+# Camera Terminal and Processing Unit controls (UVC 1.5, 4.2.2.1 and 4.2.2.3)
+#
+# ControlStore keeps the current value of every control of one unit or
+# terminal packed little endian in a single bytearray, at a fixed offset per
+# control, and answers the requests hosts poll at startup and while
+# streaming: GET_INFO, GET_LEN, GET_MIN, GET_MAX, GET_RES and GET_DEF are
+# packed once when the store is built and go straight into the dispatch
+# table as reply bytes; GET_CUR is a slice of the bytearray. SET_CUR clamps
+# nothing silently: out of range values are stalled and reported through
+# VC_REQUEST_ERROR_CODE_CONTROL (4.2.1.2), in-range values are rounded to
+# the control's resolution. Listeners are called with the store after a
+# change, e.g. to rebuild the image adjustment LUT or report it on the
+# status interrupt endpoint (status.py)
+#
+# Controls are laid out in the order of their bmControls bits, which is the
+# parameter block of the UVC 1.5 _ALL requests (4.2.1, wValue 0): the whole
+# bytearray is the GET_CUR_ALL reply, the other GET_*_ALL replies are packed
+# once like their single-control counterparts, and SET_CUR_ALL validates
+# every settable control in the block before storing any of them, so a host
+# reads or writes a whole unit in one control transfer
+#
+# ImageAdjustment turns brightness, contrast and gamma into one 256 entry
+# luma lookup table, rebuilt only when one of them changes; applying it to
+# an uncompressed frame is one NumPy table lookup over the Y bytes
+
+import struct
+
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple, Union
+
+from facedancer.logging import log
+
+import uvc
+
+
+UVC = uvc.UVC
+
+# GET_INFO bits
+INFO_GET = 0x01
+INFO_SET = 0x02
+INFO_GET_SET = INFO_GET | INFO_SET
+# The device may change the value itself, and reports it on the status endpoint
+INFO_AUTOUPDATE = 0x08
+
+# 4.2.1.2 Request Error Code Control
+ERROR_NONE = 0x00
+ERROR_OUT_OF_RANGE = 0x04
+ERROR_INVALID_CONTROL = 0x06
+ERROR_INVALID_REQUEST = 0x07
+ERROR_INVALID_VALUE_WITHIN_RANGE = 0x08
+
+# Static UVC 1.5 _ALL requests and the request each field of their block answers
+ALL_REQUESTS = {
+    UVC.GET_MIN_ALL: UVC.GET_MIN,
+    UVC.GET_MAX_ALL: UVC.GET_MAX,
+    UVC.GET_RES_ALL: UVC.GET_RES,
+    UVC.GET_DEF_ALL: UVC.GET_DEF,
+}
+
+Value = Union[int, Tuple[int, ...]]
+
+
+@dataclass
+class Control:
+    """
+    One control: its selector, bit in the descriptor's bmControls, the
+    struct format of its value and its limits. A control with `modes` (a
+    bitmap like CT_AE_MODE_CONTROL) takes exactly one of those bits and
+    reports them as GET_RES instead of having a MIN/MAX range
+    """
+    name: str
+    selector: int
+    bit: int
+    format: str
+    default: Value
+    minimum: Optional[Value] = None
+    maximum: Optional[Value] = None
+    resolution: Value = 1
+    modes: int = 0
+    info: int = INFO_GET_SET
+
+    def __post_init__(self):
+        self.struct = struct.Struct(self.format)
+
+    @property
+    def length(self) -> int:
+        return self.struct.size
+
+    def pack(self, value: Value) -> bytes:
+        return self.struct.pack(*value) if isinstance(value, tuple) else self.struct.pack(value)
+
+    @staticmethod
+    def fields(value: Value) -> tuple:
+        return value if isinstance(value, tuple) else (value,)
+
+    def static_replies(self) -> dict:
+        """ Replies to every GET_* but GET_CUR, by request """
+        replies = {
+            UVC.GET_INFO: bytes([self.info]),
+            UVC.GET_LEN: self.length.to_bytes(2, 'little'),
+            UVC.GET_DEF: self.pack(self.default),
+        }
+        if self.modes:
+            replies[UVC.GET_RES] = self.pack(self.modes)
+        else:
+            replies[UVC.GET_MIN] = self.pack(self.minimum)
+            replies[UVC.GET_MAX] = self.pack(self.maximum)
+            replies[UVC.GET_RES] = self.pack(self.resolution)
+        return replies
+
+    def validate(self, data: bytes):
+        """ (packed value to store, 0) or (None, error code) for SET_CUR data """
+        if len(data) != self.length:
+            return None, ERROR_INVALID_REQUEST
+        values = self.struct.unpack(data)
+
+        if self.modes:
+            mode = values[0]
+            if mode & (mode - 1) or not mode & self.modes:
+                return None, ERROR_INVALID_VALUE_WITHIN_RANGE
+            return bytes(data), ERROR_NONE
+
+        minimums = self.fields(self.minimum)
+        maximums = self.fields(self.maximum)
+        resolutions = self.fields(self.resolution)
+        rounded = []
+        for value, minimum, maximum, resolution in zip(values, minimums, maximums, resolutions):
+            if not minimum <= value <= maximum:
+                return None, ERROR_OUT_OF_RANGE
+            steps = round((value - minimum) / resolution) if resolution else 0
+            rounded.append(min(minimum + steps * resolution, maximum))
+        return self.struct.pack(*rounded), ERROR_NONE
+
+
+def bm_controls(controls) -> int:
+    """ bmControls of the unit/terminal descriptor advertising `controls` """
+    bitmap = 0
+    for control in controls:
+        bitmap |= 1 << control.bit
+    return bitmap
+
+
+class RequestErrorCode:
+    """ VC_REQUEST_ERROR_CODE_CONTROL: the outcome of the last control request """
+
+    def __init__(self):
+        self.code = ERROR_NONE
+
+    def register(self, dispatcher, interface: int):
+        selector = UVC.VC_REQUEST_ERROR_CODE_CONTROL
+        dispatcher.add(interface, 0, UVC.GET_INFO, selector, 0, bytes([INFO_GET]))
+        dispatcher.add(interface, 0, UVC.GET_CUR, selector, 0,
+                       lambda request: request.reply(bytes([self.code])[:request.length]))
+
+
+class ControlStore:
+    """ Current values of the controls of unit/terminal `unit_id`, packed in one bytearray """
+
+    def __init__(self, unit_id: int, controls: List[Control], errors: RequestErrorCode = None):
+        self.unit_id = unit_id
+        controls = sorted(controls, key=lambda control: control.bit)
+        self.controls = {control.selector: control for control in controls}
+        self.errors = errors or RequestErrorCode()
+        self.listeners: List[Callable[['ControlStore', Control], None]] = []
+
+        self._offsets = {}
+        offset = 0
+        for control in controls:
+            self._offsets[control.selector] = offset
+            offset += control.length
+        self.values = bytearray(offset)
+        self.reset()
+
+    def reset(self):
+        for control in self.controls.values():
+            self._store(control, control.pack(control.default))
+
+    @property
+    def bm_controls(self) -> int:
+        return bm_controls(self.controls.values())
+
+    def _store(self, control: Control, data: bytes):
+        offset = self._offsets[control.selector]
+        self.values[offset:offset + control.length] = data
+
+    def current(self, selector: int) -> bytes:
+        control = self.controls[selector]
+        offset = self._offsets[selector]
+        return bytes(self.values[offset:offset + control.length])
+
+    def get(self, selector: int) -> tuple:
+        """ Current value of a control, unpacked """
+        control = self.controls[selector]
+        return control.struct.unpack_from(self.values, self._offsets[selector])
+
+    def set_all(self, data: bytes) -> int:
+        """ Store a SET_CUR_ALL parameter block; nothing is stored unless every control is valid """
+        if len(data) != len(self.values):
+            return ERROR_INVALID_REQUEST
+        data = bytes(data)
+        changes = []
+        for selector, control in self.controls.items():
+            if not control.info & INFO_SET:
+                continue
+            offset = self._offsets[selector]
+            packed, error = control.validate(data[offset:offset + control.length])
+            if packed is None:
+                return error
+            changes.append((control, packed))
+
+        for control, packed in changes:
+            if packed != self.current(control.selector):
+                self._store(control, packed)
+                for listener in self.listeners:
+                    listener(self, control)
+        return ERROR_NONE
+
+    def set(self, selector: int, data: bytes) -> int:
+        """ Store SET_CUR data; returns the request error code, 0 on success """
+        control = self.controls[selector]
+        packed, error = control.validate(bytes(data))
+        if packed is None:
+            return error
+        if packed != self.current(selector):
+            self._store(control, packed)
+            for listener in self.listeners:
+                listener(self, control)
+        return ERROR_NONE
+
+    def update(self, selector: int, value: Value) -> int:
+        """ Change a control from the device side, e.g. an auto mode; returns the request error code """
+        control = self.controls[selector]
+        packed, error = control.validate(control.pack(value))
+        if packed is None:
+            return error
+        if packed != self.current(selector):
+            self._store(control, packed)
+            for listener in self.listeners:
+                listener(self, control)
+        return ERROR_NONE
+
+    def handle_get_cur(self, request):
+        selector = request.value >> 8
+        self.errors.code = ERROR_NONE
+        request.reply(self.current(selector)[:request.length])
+
+    def handle_get_cur_all(self, request):
+        self.errors.code = ERROR_NONE
+        request.reply(bytes(self.values[:request.length]))
+
+    def handle_set_cur_all(self, request):
+        error = self.set_all(request.data)
+        self.errors.code = error
+        if error:
+            log.info(f"SET_CUR_ALL of unit {self.unit_id} failed with error 0x{error:02x}")
+            request.stall()
+        else:
+            request.ack()
+
+    def handle_set_cur(self, request):
+        selector = request.value >> 8
+        error = self.set(selector, request.data)
+        self.errors.code = error
+        if error:
+            log.info(f"SET_CUR of unit {self.unit_id} control 0x{selector:02x} to "
+                     f"{bytes(request.data).hex()} failed with error 0x{error:02x}")
+            request.stall()
+        else:
+            request.ack()
+
+    def register(self, dispatcher, interface: int):
+        """ Add every control's requests, and the unit's _ALL requests, on `interface` to `dispatcher` """
+        self.errors.register(dispatcher, interface)
+        replies = {selector: control.static_replies() for selector, control in self.controls.items()}
+        for selector, control in self.controls.items():
+            for request, reply in replies[selector].items():
+                dispatcher.add(interface, 0, request, selector, self.unit_id, reply)
+            dispatcher.add(interface, 0, UVC.GET_CUR, selector, self.unit_id, self.handle_get_cur)
+            if control.info & INFO_SET:
+                dispatcher.add(interface, 0, UVC.SET_CUR, selector, self.unit_id, self.handle_set_cur)
+
+        # Controls without a MIN/MAX (mode bitmaps) read as zeros in the block
+        for request_all, request in ALL_REQUESTS.items():
+            block = b''.join(replies[selector].get(request, bytes(control.length))
+                             for selector, control in self.controls.items())
+            dispatcher.add(interface, 0, request_all, 0, self.unit_id, block)
+        dispatcher.add(interface, 0, UVC.GET_CUR_ALL, 0, self.unit_id, self.handle_get_cur_all)
+        dispatcher.add(interface, 0, UVC.SET_CUR_ALL, 0, self.unit_id, self.handle_set_cur_all)
+
+
+# Camera Terminal controls and bmControls bits (3.7.2.3), ranges of a C920
+CAMERA_TERMINAL_CONTROLS = [
+    # Manual (1) and aperture priority (8)
+    Control('ae_mode', UVC.CT_AE_MODE_CONTROL, 1, '<B', default=0x08, modes=0x09),
+    Control('ae_priority', UVC.CT_AE_PRIORITY_CONTROL, 2, '<B', default=0, minimum=0, maximum=1),
+    # 100us units
+    Control('exposure_time', UVC.CT_EXPOSURE_TIME_ABSOLUTE_CONTROL, 3, '<I',
+            default=250, minimum=3, maximum=2047, info=INFO_GET_SET | INFO_AUTOUPDATE),
+    Control('focus', UVC.CT_FOCUS_ABSOLUTE_CONTROL, 5, '<H', default=0, minimum=0, maximum=250, resolution=5,
+            info=INFO_GET_SET | INFO_AUTOUPDATE),
+    Control('zoom', UVC.CT_ZOOM_ABSOLUTE_CONTROL, 9, '<H', default=100, minimum=100, maximum=500),
+    # Arc seconds, pan then tilt
+    Control('pan_tilt', UVC.CT_PANTILT_ABSOLUTE_CONTROL, 11, '<ii', default=(0, 0),
+            minimum=(-36000, -36000), maximum=(36000, 36000), resolution=(3600, 3600)),
+    Control('focus_auto', UVC.CT_FOCUS_AUTO_CONTROL, 17, '<B', default=1, minimum=0, maximum=1),
+]
+
+# Processing Unit controls and bmControls bits (3.7.2.5)
+PROCESSING_UNIT_CONTROLS = [
+    Control('brightness', UVC.PU_BRIGHTNESS_CONTROL, 0, '<h', default=128, minimum=0, maximum=255),
+    Control('contrast', UVC.PU_CONTRAST_CONTROL, 1, '<H', default=128, minimum=0, maximum=255),
+    Control('saturation', UVC.PU_SATURATION_CONTROL, 3, '<H', default=128, minimum=0, maximum=255),
+    Control('sharpness', UVC.PU_SHARPNESS_CONTROL, 4, '<H', default=128, minimum=0, maximum=255),
+    # Gamma times 100
+    Control('gamma', UVC.PU_GAMMA_CONTROL, 5, '<H', default=100, minimum=1, maximum=500),
+    Control('white_balance_temperature', UVC.PU_WHITE_BALANCE_TEMPERATURE_CONTROL, 6, '<H',
+            default=4000, minimum=2000, maximum=6500, resolution=1, info=INFO_GET_SET | INFO_AUTOUPDATE),
+    Control('backlight_compensation', UVC.PU_BACKLIGHT_COMPENSATION_CONTROL, 8, '<H',
+            default=0, minimum=0, maximum=1),
+    Control('gain', UVC.PU_GAIN_CONTROL, 9, '<H', default=0, minimum=0, maximum=255),
+    # Disabled, 50 Hz, 60 Hz
+    Control('power_line_frequency', UVC.PU_POWER_LINE_FREQUENCY_CONTROL, 10, '<B',
+            default=2, minimum=0, maximum=2),
+    Control('white_balance_temperature_auto', UVC.PU_WHITE_BALANCE_TEMPERATURE_AUTO_CONTROL, 12, '<B',
+            default=1, minimum=0, maximum=1),
+]
+
+# Limited range luma, BT.601
+LUMA_BLACK = 16
+LUMA_WHITE = 235
+
+
+class ImageAdjustment:
+    """
+    Brightness/contrast/gamma from a Processing Unit store as a 256 entry
+    luma LUT; `lut` is None while every control is at its default, so
+    unadjusted frames are passed through untouched
+    """
+
+    SELECTORS = (UVC.PU_BRIGHTNESS_CONTROL, UVC.PU_CONTRAST_CONTROL, UVC.PU_GAMMA_CONTROL)
+
+    def __init__(self, store: ControlStore, numpy):
+        self.numpy = numpy
+        self.lut = None
+        self.defaults = tuple(store.controls[selector].default for selector in self.SELECTORS)
+        store.listeners.append(self.handle_change)
+        self.update(store)
+
+    def handle_change(self, store: ControlStore, control: Control):
+        if control.selector in self.SELECTORS:
+            self.update(store)
+
+    def update(self, store: ControlStore):
+        brightness, contrast, gamma = (store.get(selector)[0] for selector in self.SELECTORS)
+        if (brightness, contrast, gamma) == self.defaults:
+            self.lut = None
+            return
+
+        np = self.numpy
+        luma = (np.arange(256, dtype=np.float32) - LUMA_BLACK) / (LUMA_WHITE - LUMA_BLACK)
+        luma = np.clip(luma, 0, 1) ** (100 / gamma)
+        luma = (luma - 0.5) * (contrast / 128) + 0.5 + (brightness - 128) / 255
+        luma = LUMA_BLACK + np.clip(luma, 0, 1) * (LUMA_WHITE - LUMA_BLACK)
+        # One assignment, so the frame source thread sees the old or the new table
+        self.lut = np.rint(luma).astype(np.uint8)
+        log.debug("Image adjustment: brightness %d contrast %d gamma %d", brightness, contrast, gamma)
+
+    def apply(self, frame, luma_offset: int = 0, luma_step: int = 2):
+        """
+        `frame` (packed YUV, Y every `luma_step` bytes from `luma_offset`)
+        with the LUT applied to its luma, as a new buffer; `frame` itself if
+        there is nothing to adjust
+        """
+        lut = self.lut
+        if lut is None:
+            return frame
+        np = self.numpy
+        adjusted = np.frombuffer(frame, dtype=np.uint8).copy()
+        adjusted[luma_offset::luma_step] = lut[adjusted[luma_offset::luma_step]]
+        return adjusted.data
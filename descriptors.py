@@ -0,0 +1,187 @@
+# Descriptor compiler
+#
+# Builds every class-specific descriptor of the device in one go from a
+# definition, filling in the fields that depend on the other descriptors:
+#
+#   bLength              - length of each built descriptor
+#   wTotalLength         - VC header: header + units/terminals,
+#                          VS input header: header + formats/frames
+#   bInCollection        - number of entries in the VC header's baInterfaceNr
+#   bNumFormats          - number of format descriptors after a VS input header
+#   bmaControls          - one entry per format in the VS input header
+#   bNumFrameDescriptors - number of frame descriptors following each format
+#
+# The result is cached on disk, keyed by a hash of the definition and of the
+# descriptor formats, so later launches load the bytes without importing or
+# running construct (see uvc.__getattr__)
+#
+# A definition maps a block name (one class-specific interface) to an ordered
+# dict of descriptor name -> (uvc format name, fields); the first entry of a
+# block is its header:
+#
+#   {
+#       'VideoControl': {
+#           'ClassSpecificVideoControl': ('ClassSpecificVCInterfaceHeader', {...}),
+#           'ProcessingUnit': ('ProcessingUnitDescriptor', {...}),
+#       },
+#       ...
+#   }
+
+import hashlib
+import json
+import os
+
+from pathlib import Path
+
+from facedancer.logging import log
+
+import uvc
+
+
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'fake-uvc'
+CACHE_VERSION = 1
+
+VC_HEADER = 'ClassSpecificVCInterfaceHeader'
+VS_INPUT_HEADER = 'ClassSpecificVideoStreamInputHeaderDescriptor'
+
+# bDescriptorSubType values for VS format descriptors followed by frame
+# descriptors, and for those frame descriptors
+VS_FORMATS = {
+    uvc.UVC.VS_FORMAT_UNCOMPRESSED, uvc.UVC.VS_FORMAT_MJPEG, uvc.UVC.VS_FORMAT_FRAME_BASED,
+    uvc.UVC.VS_FORMAT_H264,
+}
+VS_FRAMES = {
+    uvc.UVC.VS_FRAME_UNCOMPRESSED, uvc.UVC.VS_FRAME_MJPEG, uvc.UVC.VS_FRAME_FRAME_BASED,
+    uvc.UVC.VS_FRAME_H264,
+}
+# Formats without frame descriptors (or a bNumFrameDescriptors field)
+VS_FRAMELESS_FORMATS = {
+    uvc.UVC.VS_FORMAT_MPEG2TS, uvc.UVC.VS_FORMAT_DV, uvc.UVC.VS_FORMAT_STREAM_BASED,
+}
+# Offset of bNumFrameDescriptors in the VS_FORMATS descriptors
+FORMAT_NUM_FRAMES_OFFSET = 4
+
+
+def definition_hash(definition: dict) -> str:
+    """ Hash of a definition plus the descriptor formats and the code used to build it """
+    digest = hashlib.sha256(f"{CACHE_VERSION}:{definition!r}".encode())
+    digest.update(Path(__file__).with_name('uvc_descriptors.py').read_bytes())
+    digest.update(Path(__file__).read_bytes())
+    return digest.hexdigest()
+
+
+def build_descriptor(format_name: str, fields: dict) -> bytes:
+    """ Build one descriptor with construct and fix up its bLength """
+    raw = bytearray(getattr(uvc, format_name).build(fields))
+    raw[0] = len(raw)
+    return bytes(raw)
+
+
+def build_block(entries: dict) -> dict:
+    names = list(entries)
+    header_name, (header_format, header_fields) = names[0], entries[names[0]]
+    header_fields = dict(header_fields)
+
+    # Everything after the header first, its lengths and counts go into the header
+    body = {}
+    last_format = None
+    formats = 0
+    for name in names[1:]:
+        format_name, fields = entries[name]
+        raw = bytearray(build_descriptor(format_name, fields))
+
+        if header_format == VS_INPUT_HEADER:
+            if raw[2] in VS_FORMATS:
+                formats += 1
+                last_format = name
+                raw[FORMAT_NUM_FRAMES_OFFSET] = 0
+            elif raw[2] in VS_FRAMELESS_FORMATS:
+                formats += 1
+                last_format = None
+            elif raw[2] in VS_FRAMES and last_format is not None:
+                body[last_format][FORMAT_NUM_FRAMES_OFFSET] += 1
+
+        body[name] = raw
+
+    body_length = sum(len(raw) for raw in body.values())
+    extra = b''
+
+    if header_format == VC_HEADER:
+        interfaces = header_fields.get('baInterfaceNr', 1)
+        if not isinstance(interfaces, (list, tuple)):
+            interfaces = [interfaces]
+        # The format only has room for one baInterfaceNr, the rest are appended
+        header_fields['baInterfaceNr'] = interfaces[0]
+        header_fields['bInCollection'] = len(interfaces)
+        extra = bytes(interfaces[1:])
+        header_length = len(build_descriptor(header_format, header_fields)) + len(extra)
+        header_fields['wTotalLength'] = header_length + body_length
+
+    elif header_format == VS_INPUT_HEADER:
+        header_fields['bNumFormats'] = formats
+        controls = header_fields.get('bmaControls', 0)
+        if not isinstance(controls, (list, tuple)):
+            controls = [controls]
+        # Like baInterfaceNr, only the first format's controls fit in the format
+        controls = list(controls[:formats]) + [0] * (formats - len(controls))
+        header_fields['bmaControls'] = controls[0] if controls else 0
+        extra = bytes(controls[1:])
+        header_length = len(build_descriptor(header_format, header_fields)) + len(extra)
+        header_fields['wTotalLength'] = header_length + body_length
+
+    header = bytearray(build_descriptor(header_format, header_fields) + extra)
+    header[0] = len(header)
+
+    block = {header_name: bytes(header)}
+    block.update((name, bytes(raw)) for name, raw in body.items())
+    return block
+
+
+def build_descriptors(definition: dict) -> dict:
+    descriptors = {}
+    for entries in definition.values():
+        descriptors.update(build_block(entries))
+    return descriptors
+
+
+def save_descriptors(path: Path, descriptors: dict):
+    index = [[name, len(raw)] for name, raw in descriptors.items()]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(index).encode() + b'\n')
+        for raw in descriptors.values():
+            f.write(raw)
+    os.replace(tmp, path)
+
+
+def load_descriptors(path: Path) -> dict:
+    with open(path, 'rb') as f:
+        index = json.loads(f.readline())
+        blob = f.read()
+
+    descriptors = {}
+    offset = 0
+    for name, length in index:
+        descriptors[name] = blob[offset:offset + length]
+        offset += length
+    if offset != len(blob):
+        raise ValueError(f"{path} is truncated or corrupt")
+    return descriptors
+
+
+def compile_descriptors(definition: dict, cache_dir: Path = CACHE_DIR) -> dict:
+    """ Returns descriptor name -> raw bytes for every descriptor in `definition` """
+    path = Path(cache_dir) / f"descriptors-{definition_hash(definition)}.bin"
+
+    try:
+        return load_descriptors(path)
+    except (OSError, ValueError):
+        pass
+
+    descriptors = build_descriptors(definition)
+    try:
+        save_descriptors(path, descriptors)
+    except OSError as e:
+        log.warning(f"Couldn't cache descriptors in {path}: {e}")
+    return descriptors
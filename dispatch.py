@@ -0,0 +1,80 @@
+# Class request dispatch
+#
+# All UVC class requests to the VideoControl and VideoStreaming interfaces go
+# through one table keyed by
+#
+#   (interface, alternate, bRequest, control selector, unit/terminal ID)
+#
+# where the control selector is wValue's high byte, the unit or terminal ID
+# is wIndex's high byte and the alternate is the interface's active alternate
+# setting. Entries are either reply bytes, decoded once when the table is
+# loaded (b'' acknowledges), STALL, or a handler called as handler(request).
+#
+# ANY in the selector or unit position matches every value; exact entries win
+# over (selector, ANY), which wins over (ANY, ANY), so a lookup is at most
+# three dict probes
+
+from typing import Callable, Union
+
+from facedancer.logging import log
+
+
+ANY = None
+
+# Sentinel entry: stall the request
+STALL = object()
+
+Entry = Union[bytes, str, Callable, object]
+
+
+class RequestDispatcher:
+
+    def __init__(self, table: dict = None):
+        self._table = {}
+        for key, entry in (table or {}).items():
+            self.add(*key, entry)
+
+    @staticmethod
+    def _key(interface, alternate, request, selector, unit) -> tuple:
+        # IntEnum members hash like ints but compare slower; store plain ints
+        return (int(interface), int(alternate), int(request),
+                ANY if selector is ANY else int(selector),
+                ANY if unit is ANY else int(unit))
+
+    def add(self, interface: int, alternate: int, request: int, selector, unit, entry: Entry):
+        """ Register `entry`; hex strings are decoded here, never at request time """
+        if isinstance(entry, str):
+            entry = bytes.fromhex(entry)
+        self._table[self._key(interface, alternate, request, selector, unit)] = entry
+
+    def remove(self, interface: int, alternate: int, request: int, selector, unit):
+        self._table.pop(self._key(interface, alternate, request, selector, unit), None)
+
+    def lookup(self, interface: int, alternate: int, request: int, selector: int, unit: int):
+        table = self._table
+        entry = table.get((interface, alternate, request, selector, unit))
+        if entry is None:
+            entry = table.get((interface, alternate, request, selector, ANY))
+        if entry is None:
+            entry = table.get((interface, alternate, request, ANY, ANY))
+        return entry
+
+    def dispatch(self, request, alternate: int = 0) -> bool:
+        """ Answer `request` from the table; returns False if nothing matched """
+        interface = request.index & 0xff
+        entry = self.lookup(interface, alternate, request.number,
+                            request.value >> 8, request.index >> 8)
+
+        log.debug("UVC request 0x%02x interface %d alt %d selector 0x%02x unit 0x%02x length %d",
+                  request.number, interface, alternate, request.value >> 8, request.index >> 8,
+                  request.length)
+
+        if entry is None:
+            return False
+        if entry is STALL:
+            request.stall()
+        elif isinstance(entry, bytes):
+            request.reply(entry if len(entry) <= request.length else entry[:request.length])
+        else:
+            entry(request)
+        return True
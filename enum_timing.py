@@ -0,0 +1,197 @@
+# Enumeration timing analyzer
+#
+# Compares how long the emulated camera and a real one take to answer each
+# control request while a host enumerates them, from usbmon captures:
+#
+#   python enum_timing.py webcam_fake_connect.pcapng webcam_real_connect.pcap
+#   python enum_timing.py --json fake.pcapng real.pcap > enum.json
+#
+# For each capture it reports the per-request latency (usbmon submission to
+# completion), time to enumerate (first request to the end of
+# SET_CONFIGURATION), requests the host repeated and requests that failed.
+# The diff lists requests the fake device answers slower than the real one,
+# answers differently, or doesn't see at all. --json writes the same report
+# as one JSON document, to track across versions
+#
+# Requests are matched by setup packet. Address 0 traffic is the device
+# being enumerated before SET_ADDRESS, so it's counted alongside the
+# device's own address
+
+import argparse
+import json
+import statistics
+import sys
+
+from collections import defaultdict
+
+from facedancer.types import USBStandardRequests
+
+from pcap_replay import SETUP, control_transfers, matching_devices
+from uvc import UVC
+
+
+VENDOR_ID = 0x046D
+PRODUCT_ID = 0x082D
+
+# A request counts as slower when the fake median exceeds the real one by both
+SLOWER_RATIO = 1.5
+SLOWER_MARGIN_US = 100
+
+SET_CONFIGURATION = (0x00, USBStandardRequests.SET_CONFIGURATION)
+
+DESCRIPTOR_TYPES = {1: 'DEVICE', 2: 'CONFIGURATION', 3: 'STRING', 6: 'DEVICE_QUALIFIER',
+                    7: 'OTHER_SPEED_CONFIGURATION', 0x0f: 'BOS'}
+UVC_REQUESTS = {int(UVC[name]): name for name in (
+    'SET_CUR', 'SET_CUR_ALL', 'GET_CUR', 'GET_MIN', 'GET_MAX', 'GET_RES', 'GET_LEN', 'GET_INFO',
+    'GET_DEF', 'GET_CUR_ALL', 'GET_MIN_ALL', 'GET_MAX_ALL', 'GET_RES_ALL', 'GET_DEF_ALL')}
+RECIPIENTS = ('device', 'interface', 'endpoint', 'other')
+
+
+def describe(setup: bytes) -> str:
+    """ Short human readable name of a setup packet """
+    request_type, request, value, index, length = SETUP.unpack(setup)
+    kind = (request_type >> 5) & 0x03
+    recipient = request_type & 0x1f
+    recipient = RECIPIENTS[recipient] if recipient < 4 else 'reserved'
+
+    if kind == 0:
+        try:
+            name = USBStandardRequests(request).name
+        except ValueError:
+            name = f"standard 0x{request:02x}"
+        if request == USBStandardRequests.GET_DESCRIPTOR:
+            descriptor = DESCRIPTOR_TYPES.get(value >> 8, f"0x{value >> 8:02x}")
+            return f"GET_DESCRIPTOR {descriptor} {value & 0xff} length {length}"
+        return f"{name} {recipient} value 0x{value:04x} index 0x{index:04x}"
+
+    if kind == 1:
+        name = UVC_REQUESTS.get(request, f"class 0x{request:02x}")
+        return (f"{name} {recipient} {index & 0xff} selector 0x{value >> 8:02x} "
+                f"unit 0x{index >> 8:02x} length {length}")
+
+    return f"vendor 0x{request:02x} value 0x{value:04x} index 0x{index:04x} length {length}"
+
+
+def analyze(path, vendor_id: int = VENDOR_ID, product_id: int = PRODUCT_ID) -> dict:
+    """ Timing report for the camera's control transfers in one capture """
+    transfers = list(control_transfers(path))
+    devices = matching_devices(transfers, vendor_id, product_id) | {0}
+    transfers = sorted((t for t in transfers if t.device in devices), key=lambda t: t.submitted)
+
+    report = {'capture': str(path), 'devices': sorted(devices), 'transfers': len(transfers),
+              'requests': {}, 'failures': [], 'repeated': {}}
+    if not transfers:
+        return report
+
+    start = transfers[0].submitted
+    latencies = defaultdict(list)
+    responses = {}
+    for transfer in transfers:
+        key = transfer.setup.hex()
+        latencies[key].append((transfer.completed - transfer.submitted) * 1e6)
+        responses.setdefault(key, transfer.response.hex())
+        if transfer.status != 0:
+            report['failures'].append({'setup': key, 'request': describe(transfer.setup),
+                                       'status': transfer.status,
+                                       'at_ms': round((transfer.submitted - start) * 1e3, 3)})
+
+    configured = [t.completed for t in transfers if tuple(t.setup[:2]) == SET_CONFIGURATION]
+    report['enumeration_ms'] = round((configured[0] - start) * 1e3, 3) if configured else None
+    report['total_ms'] = round((transfers[-1].completed - start) * 1e3, 3)
+    report['control_time_ms'] = round(sum(map(sum, latencies.values())) / 1e3, 3)
+
+    for key, samples in latencies.items():
+        setup = bytes.fromhex(key)
+        report['requests'][key] = {
+            'request': describe(setup),
+            'count': len(samples),
+            'median_us': round(statistics.median(samples), 1),
+            'max_us': round(max(samples), 1),
+            'response': responses[key],
+        }
+        if len(samples) > 1:
+            report['repeated'][key] = len(samples)
+    return report
+
+
+def compare(fake: dict, real: dict) -> dict:
+    """ Where `fake` answers slower, differently or not at all compared to `real` """
+    diff = {'slower': [], 'different': [], 'fake_only': [], 'real_only': []}
+    for key, request in fake['requests'].items():
+        reference = real['requests'].get(key)
+        if reference is None:
+            diff['fake_only'].append({'setup': key, 'request': request['request']})
+            continue
+
+        if (request['median_us'] > reference['median_us'] * SLOWER_RATIO
+                and request['median_us'] - reference['median_us'] > SLOWER_MARGIN_US):
+            diff['slower'].append({'setup': key, 'request': request['request'],
+                                   'fake_us': request['median_us'], 'real_us': reference['median_us']})
+        if request['response'] != reference['response']:
+            diff['different'].append({'setup': key, 'request': request['request'],
+                                      'fake': request['response'], 'real': reference['response']})
+
+    diff['real_only'] = [{'setup': key, 'request': request['request']}
+                         for key, request in real['requests'].items() if key not in fake['requests']]
+    diff['slower'].sort(key=lambda entry: entry['real_us'] - entry['fake_us'])
+    return diff
+
+
+def print_report(report: dict, out=sys.stdout):
+    print(f"{report['capture']}: {report['transfers']} control transfers to devices {report['devices']}", file=out)
+    if report['transfers'] == 0:
+        return
+    print(f"  time to enumerate {report['enumeration_ms']} ms, last request at {report['total_ms']} ms, "
+          f"{report['control_time_ms']} ms inside control transfers", file=out)
+    for key, request in sorted(report['requests'].items(), key=lambda item: -item[1]['median_us']):
+        print(f"  {request['median_us']:>10.1f} us  x{request['count']:<3} {request['request']}", file=out)
+    for failure in report['failures']:
+        print(f"  failed at {failure['at_ms']} ms with status {failure['status']}: {failure['request']}", file=out)
+
+
+def print_diff(diff: dict, out=sys.stdout):
+    print("Slower than the real camera:", file=out)
+    for entry in diff['slower']:
+        print(f"  {entry['fake_us']:>10.1f} us vs {entry['real_us']:>8.1f} us  {entry['request']}", file=out)
+    print("Answered differently:", file=out)
+    for entry in diff['different']:
+        print(f"  {entry['request']}\n    fake {entry['fake']}\n    real {entry['real']}", file=out)
+    for which, title in (('real_only', "Only asked of the real camera:"),
+                         ('fake_only', "Only asked of the fake camera:")):
+        print(title, file=out)
+        for entry in diff[which]:
+            print(f"  {entry['request']}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare control request timing of a fake and a real camera")
+    parser.add_argument('fake', help="capture of the emulated camera")
+    parser.add_argument('real', nargs='+', help="captures of the real camera")
+    parser.add_argument('--vid', type=lambda value: int(value, 16), default=VENDOR_ID)
+    parser.add_argument('--pid', type=lambda value: int(value, 16), default=PRODUCT_ID)
+    parser.add_argument('--json', action='store_true', help="write one JSON report to stdout")
+    args = parser.parse_args(argv)
+
+    fake = analyze(args.fake, args.vid, args.pid)
+    reals = [analyze(path, args.vid, args.pid) for path in args.real]
+
+    # Several real captures act as one reference; the first answer of a request wins
+    reference = {'requests': {}}
+    for real in reals:
+        for key, request in real['requests'].items():
+            reference['requests'].setdefault(key, request)
+    diff = compare(fake, reference)
+
+    if args.json:
+        json.dump({'fake': fake, 'real': reals, 'diff': diff}, sys.stdout, indent=1)
+        print()
+        return
+
+    for report in (fake, *reals):
+        print_report(report)
+        print()
+    print_diff(diff)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,26 +28,467 @@ from facedancer import (
     vendor_request_handler,
     requestable,
     class_request_handler,
-    to_this_interface
+    to_this_interface,
+    to_any_interface,
+    to_this_endpoint,
+    standard_request_handler,
 )
 from facedancer import main
 from facedancer.descriptor import USBDescribable, AutoInstantiable, StringRef, include_in_config
 from facedancer.request import USBRequestHandler
+from facedancer.types import USBStandardRequests
 from facedancer.logging import log, configure_default_logging, LOGLEVEL_TRACE
 
 # Patching the USBConfiguration class to quickly add support for the USBAssociation type
-from configuration_override import USBConfigurationOverride, USBAssociation
+from configuration_override import USBConfigurationOverride, USBAssociation, USBAlternateInterface
 
 import logging
 import binascii
+import os
+import signal
+import time
 
 from dataclasses import dataclass
 from typing import List
 import struct
 
 import  uvc
+from payload import PayloadEngine
+from frame_source import MJPEGFileSource
+from live_source import LiveMJPEGSource, is_live_address
+from pattern_source import PatternSource
+from pcap_replay import load_replay_table
+from metrics import Metrics, MetricsWriter
+from request_trace import TraceRing, STATUS_STALL
+from shm_ring import SharedFrameRing, is_shm_address, open_ring
+from overlay_encoder import OverlayEncoder
+from controls import (ControlStore, ImageAdjustment, RequestErrorCode, bm_controls, INFO_AUTOUPDATE,
+                      CAMERA_TERMINAL_CONTROLS, PROCESSING_UNIT_CONTROLS)
+from producer import FrameProducer, DEFAULT_DEPTH
+from scheduler import FramePacer, SERVICE_INTERVAL_FS_NS, SERVICE_INTERVAL_HS_NS
+from descriptors import compile_descriptors
+from dispatch import RequestDispatcher, ANY
+from probe import ProbeCommit, FrameSetting, probe_length
+from still import StillCapture, StillFormat
+from h264_source import H264FileSource, KeyFrameControl
+from status import StatusQueue, interrupt_interval_ns, STREAM_ERROR_INPUT_UNDERRUN, STREAM_ERROR_UNKNOWN
+from bandwidth import bandwidth_ladder, pick_alternate
+
+# Production mode: FAKE_UVC_TRACE=<records> keeps the last requests and replies
+# in a binary ring (see request_trace.py), dumped to FAKE_UVC_TRACE_DUMP on
+# SIGUSR1 or a crash, with one request in FAKE_UVC_TRACE_SAMPLE recorded
+TRACE_RECORDS = int(os.environ.get('FAKE_UVC_TRACE', '0'))
+TRACE_SAMPLE = int(os.environ.get('FAKE_UVC_TRACE_SAMPLE', '1'))
+TRACE_DUMP = os.environ.get('FAKE_UVC_TRACE_DUMP', 'fake-uvc-trace.pcapng')
+
+# trace, debug, info, warning...; tracing to the ring replaces TRACE logging
+LOG_LEVEL = os.environ.get('FAKE_UVC_LOG_LEVEL', 'warning' if TRACE_RECORDS else 'trace').upper()
+configure_default_logging(level=LOGLEVEL_TRACE if LOG_LEVEL == 'TRACE' else logging.getLevelName(LOG_LEVEL))
+
+# MJPEG clip (or single JPEG) streamed on the video endpoint, e.g. FAKE_UVC_MJPEG=clip.mjpeg,
+# or a live MJPEG stream: '-' for stdin, a named pipe, or unix:/path to listen on,
+# or shm:NAME for frames written into shared memory by another process (shm_ring.py)
+MJPEG_SOURCE = os.environ.get('FAKE_UVC_MJPEG')
+
+# Size and largest frame the MJPEG frame descriptor advertises, e.g.
+# FAKE_UVC_MJPEG_SIZE=1280x720 FAKE_UVC_MJPEG_MAX_FRAME=400000. A clip is
+# measured for its largest frame, but nothing tells the size of a live or
+# shared memory stream until it arrives, so set these to match the pipeline
+MJPEG_SIZE = os.environ.get('FAKE_UVC_MJPEG_SIZE', '176x144')
+MJPEG_MAX_FRAME_SIZE = int(os.environ.get('FAKE_UVC_MJPEG_MAX_FRAME', '0'), 0)
+
+# H.264 Annex B stream passed through as a frame-based format, e.g. FAKE_UVC_H264=clip.h264;
+# the frame descriptor takes its size from the stream (see h264_source.py)
+H264_SOURCE = os.environ.get('FAKE_UVC_H264')
+
+# Bus speed to enumerate at: full, high or super. The C920 is a high-speed
+# device, and not every backend can do SuperSpeed (moondancer can't)
+DEVICE_SPEED = DeviceSpeed[os.environ.get('FAKE_UVC_SPEED', 'high').upper()]
+SUPERSPEED = DEVICE_SPEED >= DeviceSpeed.SUPER
+SERVICE_INTERVAL_NS = SERVICE_INTERVAL_FS_NS if DEVICE_SPEED <= DeviceSpeed.FULL else SERVICE_INTERVAL_HS_NS
+
+# Video data transfers: isochronous (alternates 1..n) or bulk (one endpoint on alternate 0)
+BULK_STREAMING = os.environ.get('FAKE_UVC_TRANSFER', 'isochronous').lower() == 'bulk'
+# Upper bound on a bulk payload; normally a whole frame plus its header fits in one
+BULK_MAX_PAYLOAD_SIZE = 4 * 1024 * 1024
+BULK_PACKET_SIZE = 64 if DEVICE_SPEED <= DeviceSpeed.FULL else 1024 if SUPERSPEED else 512
+
+# usbmon captures of a real camera, separated by os.pathsep, to answer control
+# requests nothing here handles, e.g. FAKE_UVC_REPLAY=webcam_real_connect.pcap
+REPLAY_CAPTURES = [path for path in os.environ.get('FAKE_UVC_REPLAY', '').split(os.pathsep) if path]
+
+# Metrics file rewritten every FAKE_UVC_METRICS_INTERVAL seconds; .prom for
+# Prometheus text format, anything else for JSON (see metrics.py)
+METRICS_PATH = os.environ.get('FAKE_UVC_METRICS')
+METRICS_INTERVAL = float(os.environ.get('FAKE_UVC_METRICS_INTERVAL', '5'))
+
+# Frames are produced on a thread per format, into a ring of
+# FAKE_UVC_PRODUCER_DEPTH frames: block, drop-oldest or repeat-last when the
+# two sides don't keep up (see producer.py), or inline in the USB loop
+PRODUCER_POLICY = os.environ.get('FAKE_UVC_PRODUCER', 'block')
+PRODUCER_DEPTH = int(os.environ.get('FAKE_UVC_PRODUCER_DEPTH', DEFAULT_DEPTH))
+
+# Test pattern streamed for the uncompressed format: bars or gradient (see pattern_source.py)
+PATTERN = os.environ.get('FAKE_UVC_PATTERN', 'bars')
+
+# Burn a sequence number and timestamp into every frame of the clip, re-encoding
+# on this many worker processes with FAKE_UVC_OVERLAY_IN_FLIGHT frames queued
+OVERLAY_WORKERS = int(os.environ.get('FAKE_UVC_OVERLAY', '0'))
+OVERLAY_IN_FLIGHT = int(os.environ.get('FAKE_UVC_OVERLAY_IN_FLIGHT', '0')) or None
+
+# Full-resolution JPEGs sent for a still image capture, one per still size and
+# separated by os.pathsep; without them the next MJPEG frame is the still
+STILL_PATHS = [path for path in os.environ.get('FAKE_UVC_STILL', '').split(os.pathsep) if path]
+
+# UVC 1.5: 48 byte probe/commit and the _ALL control requests
+UVC_VERSION = 1.5
+VIDEO_CLOCK_FREQUENCY = 30000000
+FRAME_INTERVAL = 0x000A2C2A # 100ns units, 15fps
+FRAME_INTERVAL_30FPS = 0x00051615
+
+FORMAT_MJPEG = 1
+FORMAT_YUY2 = 2
+FORMAT_H264 = 3
+MJPEG_WIDTH, MJPEG_HEIGHT = (int(n) for n in MJPEG_SIZE.lower().split('x'))
+# Otherwise 12 bits a pixel, as the captured 176x144 descriptor has (0x9480)
+MJPEG_FRAME_BUF_SIZE = MJPEG_MAX_FRAME_SIZE or MJPEG_WIDTH * MJPEG_HEIGHT * 3 // 2
+YUY2_WIDTH = 640
+YUY2_HEIGHT = 480
+YUY2_FRAME_SIZE = YUY2_WIDTH * YUY2_HEIGHT * 2
+
+
+def load_frame_source():
+    if MJPEG_SOURCE is None:
+        log.warning("FAKE_UVC_MJPEG not set, the video endpoint will not stream")
+        return lambda: None
+
+    if is_shm_address(MJPEG_SOURCE):
+        return open_ring(MJPEG_SOURCE)
+    if is_live_address(MJPEG_SOURCE):
+        log.info(f"Streaming live MJPEG from {MJPEG_SOURCE}")
+        return LiveMJPEGSource(MJPEG_SOURCE)
+
+    source = MJPEGFileSource(MJPEG_SOURCE)
+    log.info(f"Streaming {len(source)} frames from {MJPEG_SOURCE}")
+    if OVERLAY_WORKERS:
+        try:
+            source = OverlayEncoder(source, OVERLAY_WORKERS, OVERLAY_IN_FLIGHT, FRAME_INTERVAL)
+        except ImportError as e:
+            log.warning(f"{e}; streaming the clip without overlays")
+    return source
+
+
+def load_still_formats():
+    """ Still sizes of each format: the cached stills for MJPEG, if any, else the video frame """
+    mjpeg = StillFormat(FORMAT_MJPEG, [(MJPEG_WIDTH, MJPEG_HEIGHT)], compressions=[1])
+    if STILL_PATHS:
+        try:
+            mjpeg = StillFormat.from_files(FORMAT_MJPEG, STILL_PATHS)
+        except (OSError, ValueError) as e:
+            log.warning(f"Couldn't load still images: {e}; stills are taken from the video")
+    return [mjpeg, StillFormat(FORMAT_YUY2, [(YUY2_WIDTH, YUY2_HEIGHT)])]
+
+
+STILL_FORMATS = load_still_formats()
+
+
+def load_h264_stream():
+    """ The FAKE_UVC_H264 stream, indexed, or None if there is none """
+    if not H264_SOURCE:
+        return None
+    try:
+        stream = H264FileSource(H264_SOURCE)
+        width, height = stream.size()
+    except (OSError, ValueError) as e:
+        log.warning(f"Couldn't load H.264 stream {H264_SOURCE}: {e}; not offering H.264")
+        return None
+    log.info(f"Streaming {len(stream)} H.264 frames ({width}x{height}, {len(stream.idrs)} IDRs) from {H264_SOURCE}")
+    return stream
+
+
+# Loaded before the descriptors are built: the frame descriptor needs its size
+H264_STREAM = load_h264_stream()
+
+
+def load_pattern_source():
+    try:
+        return PatternSource(YUY2_WIDTH, YUY2_HEIGHT, PATTERN)
+    except ImportError as e:
+        log.warning(f"{e}; the uncompressed format will not stream")
+        return lambda: None
+
+
+# Class-specific descriptors; lengths and counts (wTotalLength, bLength,
+# bInCollection, bNumFormats, bNumFrameDescriptors) are filled in by descriptors.py
+DESCRIPTOR_DEFINITION = {
+    'VideoControl': {
+        # 2.3.4.2 Class-specific VC Interface Header Descriptor
+        'ClassSpecificVideoControl': ('ClassSpecificVCInterfaceHeader', {
+            'bcdUVC': UVC_VERSION,
+            'dwClockFrequency': VIDEO_CLOCK_FREQUENCY,
+            'baInterfaceNr': [1],
+        }),
+        'InputTerminalCamera': ('InputTerminalCameraInputDescriptor', {
+            'bTerminalID':0x01,
+            'bAssocTerminal':0x00,
+            'iTerminal':0x00,
+            'wObjectiveFocalLengthMin':0x0000,
+            'wObjectiveFocalLengthMax':0x0000,
+            'wOcularFocalLength':0x0000,
+            'bmControls': bm_controls(CAMERA_TERMINAL_CONTROLS),
+        }),
+        'InputTerminalComposite': ('InputTerminalDescriptorComposite', {
+            'bTerminalID':0x02,
+            'bAssocTerminal':0x00,
+            'iTerminal':0x00,
+        }),
+        'OutputTerminal': ('OutputTerminalDescriptor', {
+            'bTerminalID':0x03,
+            'wTerminalType':0x0101,
+            'bAssocTerminal':0x00,
+            'bSourceID':0x05,
+            'iTerminal':0x00,
+        }),
+        # Camera (1) -> Selector Unit (4) -> Processing Unit (5) -> Output Terminal (3);
+        # unit 4's SU_INPUT_SELECT_CONTROL gets the VC catch-all answers
+        'SelectorUnit': ('SelectorUnitDescriptor', {
+            'bUnitID':0x04,
+            'bNrInPins':1,
+            'baSourceID':0x01,
+            'iSelector':0x00
+        }),
+        # 2.3.4.7 Processing Unit Descriptor
+        'ProcessingUnit': ('ProcessingUnitDescriptor', {
+            'bUnitID':0x05,
+            'bSourceID':0x04,
+            'wMaxMultiplier':0x0000,
+            'bmControls': bm_controls(PROCESSING_UNIT_CONTROLS),
+            'iProcessing':0x00,
+            'bmVideoStandards':0x00
+        }),
+    },
+    'VideoStreaming': {
+        # 2.3.5.1.2 Class-specific VS Header Descriptor (Input)
+        'ClassSpecificVideoStreamHeader': ('ClassSpecificVideoStreamInputHeaderDescriptor', {
+            'bEndPointAddress': 0x82,
+            'bmInfo': 0x00,
+            'bTerminalLink': 0x03,
+            # Method 2, with a Still Image Frame descriptor after each format's frames (see still.py)
+            'bStillCaptureMethod': 0x02,
+            'bTriggerSupport': 0x01,
+            'bTriggerUsage': 0x00,
+            'bControlSize': 0x01,
+            'bmaControls': 0x00
+        }),
+        # 2.3.5.1.3 Class-specific VS Format Descriptor
+        'FormatMJPEG': ('ClassSpecificVideoStreamFormatDescriptorMJPEG', {
+            'bFormatIndex':FORMAT_MJPEG,
+            'bmFlags':0x01,
+            'bDefaultFrameIndex':0x01,
+            'bAspectRatioX':0,
+            'bAspectRatioY':0,
+            'bmInterlaceFlags':0,
+            'bCopyProtect':0
+        }),
+        # 2.3.5.1.4 Class-specific VS Frame Descriptor
+        'Frame': ('ClassSpecificVideoStreamFrameDescriptorMJPEG', {
+            'bFrameIndex':0x01,
+            'bmCapabilities':0x03,
+            'wWidth':MJPEG_WIDTH,
+            'wHeight':MJPEG_HEIGHT,
+            'dwMinBitRate':0x000DEC00,
+            'dwMaxBitRate':0x000DEC00,
+            'dwMaxVideoFrameBufSize':MJPEG_FRAME_BUF_SIZE,
+            'dwDefaultFrameInterval':FRAME_INTERVAL,
+            'bFrameIntervalType':0,
+            'dwMinFrameInterval':FRAME_INTERVAL,
+            'dwMaxFrameInterval':FRAME_INTERVAL,
+            'dwFrameIntervalStep':0x00000000,
+        }),
+        # 3.9.2.6 Still Image Frame Descriptor
+        'StillFrame': ('ClassSpecificVideoStreamStillImageFrameDescriptor', STILL_FORMATS[0].descriptor_fields()),
+        # Uncompressed Payload 3.1.1 Uncompressed Video Format Descriptor
+        'FormatYUY2': ('ClassSpecificVideoStreamFormatDescriptorUncompressed', {
+            'bFormatIndex':FORMAT_YUY2,
+            'bBitsPerPixel':16,
+            'bDefaultFrameIndex':0x01,
+        }),
+        # Uncompressed Payload 3.1.2 Uncompressed Video Frame Descriptor
+        'FrameYUY2': ('ClassSpecificVideoStreamFrameDescriptorUncompressed', {
+            'bFrameIndex':0x01,
+            'bmCapabilities':0x00,
+            'wWidth':YUY2_WIDTH,
+            'wHeight':YUY2_HEIGHT,
+            'dwMinBitRate':YUY2_FRAME_SIZE * 8 * 15,
+            'dwMaxBitRate':YUY2_FRAME_SIZE * 8 * 30,
+            'dwMaxVideoFrameBufSize':YUY2_FRAME_SIZE,
+            'dwDefaultFrameInterval':FRAME_INTERVAL_30FPS,
+            'bFrameIntervalType':0,
+            'dwMinFrameInterval':FRAME_INTERVAL_30FPS,
+            'dwMaxFrameInterval':FRAME_INTERVAL,
+            'dwFrameIntervalStep':FRAME_INTERVAL - FRAME_INTERVAL_30FPS,
+        }),
+        'StillFrameYUY2': ('ClassSpecificVideoStreamStillImageFrameDescriptor', STILL_FORMATS[1].descriptor_fields()),
+    },
+}
+
+if H264_STREAM is not None:
+    H264_WIDTH, H264_HEIGHT = H264_STREAM.size()
+    H264_MAX_BIT_RATE = H264_STREAM.max_frame_size() * 8 * 30
+    DESCRIPTOR_DEFINITION['VideoStreaming'].update({
+        # Frame Based Payload 3.1.1 Frame Based Video Format Descriptor
+        'FormatH264': ('ClassSpecificVideoStreamFormatDescriptorFrameBased', {
+            'bFormatIndex':FORMAT_H264,
+            'bDefaultFrameIndex':0x01,
+        }),
+        # Frame Based Payload 3.1.2 Frame Based Video Frame Descriptor
+        'FrameH264': ('ClassSpecificVideoStreamFrameDescriptorFrameBased', {
+            'bFrameIndex':0x01,
+            'bmCapabilities':0x00,
+            'wWidth':H264_WIDTH,
+            'wHeight':H264_HEIGHT,
+            'dwMinBitRate':H264_MAX_BIT_RATE // 4,
+            'dwMaxBitRate':H264_MAX_BIT_RATE,
+            'dwDefaultFrameInterval':FRAME_INTERVAL_30FPS,
+            'bFrameIntervalType':0,
+            'dwBytesPerLine':0,
+            'dwMinFrameInterval':FRAME_INTERVAL_30FPS,
+            'dwMaxFrameInterval':FRAME_INTERVAL,
+            'dwFrameIntervalStep':FRAME_INTERVAL - FRAME_INTERVAL_30FPS,
+        }),
+    })
+
+DESCRIPTORS = compile_descriptors(DESCRIPTOR_DEFINITION)
+
+VIDEO_CONTROL_INTERFACE = 0x00
+VIDEO_STREAMING_INTERFACE = 0x01
+
+# Status interrupt endpoint polling interval: 2^(9-1) microframes (32ms) at
+# high speed and above, 9ms at full speed; status packets go out at most once each
+STATUS_ENDPOINT_INTERVAL = 0x09
+# wMaxPacketSize of the interrupt endpoint, and its class-specific wMaxTransferSize
+STATUS_MAX_TRANSFER_SIZE = 64
+STATUS_INTERVAL_NS = interrupt_interval_ns(STATUS_ENDPOINT_INTERVAL, DEVICE_SPEED >= DeviceSpeed.HIGH)
+
+# UVC class requests to both interfaces; see dispatch.py
+# (interface, alternate, bRequest, control selector, unit/terminal ID): reply, b'' acks
+# The two catch-alls answer with the captures first when replaying (see reply_from_capture)
+CLASS_REQUESTS = {
+    (VIDEO_CONTROL_INTERFACE, 0, uvc.UVC.GET_CUR, ANY, ANY): b'',
+    (VIDEO_CONTROL_INTERFACE, 0, uvc.UVC.GET_INFO, ANY, ANY): b'',
+    # VS_PROBE_CONTROL/VS_COMMIT_CONTROL are added by ProbeCommit.register()
+}
+
+# Every frame descriptor the VideoStreaming interface advertises, for probe/commit
+STREAM_FRAMES = [
+    FrameSetting.from_descriptor_fields(FORMAT_MJPEG, DESCRIPTOR_DEFINITION['VideoStreaming']['Frame'][1]),
+    FrameSetting.from_descriptor_fields(FORMAT_YUY2, DESCRIPTOR_DEFINITION['VideoStreaming']['FrameYUY2'][1]),
+]
+if H264_STREAM is not None:
+    STREAM_FRAMES.append(FrameSetting.from_descriptor_fields(
+        FORMAT_H264, DESCRIPTOR_DEFINITION['VideoStreaming']['FrameH264'][1]))
+
+# Isochronous alternates 1..n with increasing bandwidth; see bandwidth.py
+STREAMING_LADDER = [] if BULK_STREAMING else bandwidth_ladder(DEVICE_SPEED)
+
+# USB 3.2, 9.6.2 Binary Device Object Store: USB 2.0 Extension (LPM) and
+# SuperSpeed USB Device Capability (FS/HS/SS supported, functional from FS,
+# U1/U2 exit latencies of 10us/2047us)
+BOS_DESCRIPTOR = binascii.unhexlify(
+    '050f160002'
+    '07100202000000'
+    '0a1003000e00010aff07'
+)
+# bMaxPacketSize0 is an exponent at SuperSpeed: 2^9 = 512 bytes
+SUPERSPEED_EP0_PACKET_SIZE = 9
+
+
+# 2.3.5.2.2 Standard VS Isochronous Video Data Endpoint Descriptor
+class IsochronousVideoEndpoint(USBEndpoint):
+    number: int = 0x02
+    direction: USBDirection = USBDirection.IN
+    transfer_type: USBTransferType = USBTransferType.ISOCHRONOUS
+    synchronization_type: USBSynchronizationType = (
+        USBSynchronizationType.ASYNC
+    )
+    usage_type: USBUsageType = USBUsageType.DATA
+    interval = 0x01
+
+    def handle_data_requested(self: USBEndpoint):
+        device = self.get_device()
+        payload = device.payloads.next_payload()
+        if payload is None:
+            return
+        # Payloads already fit in one service interval, skip USBEndpoint.send()
+        # which copies and re-chunks everything through a bytearray
+        device.backend.send_on_endpoint(self.number, payload, blocking=False)
+
+
+# 2.4.3.2.2 Bulk Transfers: one payload per bulk transfer, streaming from
+# SET_CUR(COMMIT) until the host clears the endpoint halt
+@use_inner_classes_automatically
+class BulkVideoEndpoint(USBEndpoint):
+    number: int = 0x02
+    direction: USBDirection = USBDirection.IN
+    transfer_type: USBTransferType = USBTransferType.BULK
+    max_packet_size: int = BULK_PACKET_SIZE
+
+    if SUPERSPEED:
+        # Bursts of 16 packets
+        class EndpointCompanion(USBDescriptor):
+            include_in_config = True
+            raw = binascii.unhexlify('06300f000000')
+
+    def handle_data_requested(self: USBEndpoint):
+        device = self.get_device()
+        payload = device.payloads.next_payload()
+        if payload is None:
+            return
+        device.backend.send_on_endpoint(self.number, payload, blocking=False)
+        # A short payload that fills its last packet needs a ZLP to end the transfer
+        length = len(payload)
+        if length % self.max_packet_size == 0 and length < device.payloads.max_payload_size:
+            device.backend.send_on_endpoint(self.number, b'', blocking=False)
+
+    @standard_request_handler(number=USBStandardRequests.CLEAR_FEATURE)
+    @to_this_endpoint
+    def handle_clear_feature_request(self, request):
+        # CLEAR_FEATURE(ENDPOINT_HALT) is how the host stops a bulk stream
+        self.get_device().stop_streaming()
+        request.acknowledge()
+
+
+def video_streaming_alternate(setting):
+    """ VideoStreaming interface class for one StreamingAlternate of the ladder """
+
+    @use_inner_classes_automatically
+    class VideoStreamingAlt(USBAlternateInterface):
+        number = VIDEO_STREAMING_INTERFACE
+        alternate = setting.alternate
+        class_number = 0x0e
+        subclass_number = 0x02
 
-configure_default_logging(level=LOGLEVEL_TRACE)
+        @use_inner_classes_automatically
+        class VideoEndpoint(IsochronousVideoEndpoint):
+            max_packet_size = setting.w_max_packet_size
+
+            if setting.superspeed:
+                # USB 3.2, 9.6.7 SuperSpeed Endpoint Companion Descriptor
+                class EndpointCompanion(USBDescriptor):
+                    include_in_config = True
+                    raw = setting.companion_descriptor()
+
+        def handle_alternate_selected(self):
+            self.get_device().start_streaming(setting)
+
+    VideoStreamingAlt.__name__ = VideoStreamingAlt.__qualname__ = f"VideoStreamingAlt{setting.alternate}"
+    return VideoStreamingAlt
+
+
+VIDEO_STREAMING_ALTERNATES = [video_streaming_alternate(setting) for setting in STREAMING_LADDER]
+
+# Every alternate setting of the VideoStreaming interface that takes probe/commit
+STREAMING_ALTERNATE_NUMBERS = [0, *(setting.alternate for setting in STREAMING_LADDER)]
 
 
 @use_inner_classes_automatically
@@ -58,7 +499,8 @@ class Webcam(USBDevice):
     serial_number_string: StringRef = StringRef.field(string="C0FFEEEE")
     vendor_id: int = 0x046D # Logitech
     product_id: int = 0x082D # C920 camera
-    device_speed: DeviceSpeed = DeviceSpeed.SUPER
+    device_speed: DeviceSpeed = DEVICE_SPEED
+    usb_spec_version: int = 0x0320 if SUPERSPEED else 0x0200
     device_revision: int = 0x11
 
     supported_languages: tuple = (LanguageIDs.ENGLISH_US,)
@@ -69,6 +511,317 @@ class Webcam(USBDevice):
     protocol_revision_number: int = 0x01
     max_packet_size: int = 64
 
+    def __post_init__(self):
+        super().__post_init__()
+        if SUPERSPEED:
+            self.requestable_descriptors[(0x0F, 0)] = BOS_DESCRIPTOR
+
+        # 2.4.2.2 Status Interrupt Endpoint: control changes, the still button, stream errors
+        self.status = StatusQueue(STATUS_INTERVAL_NS)
+
+        # One source per format; the committed format's feeds the payload engine
+        self.frame_sources = {
+            FORMAT_MJPEG: load_frame_source(),
+            FORMAT_YUY2: load_pattern_source(),
+        }
+        if H264_STREAM is not None:
+            self.frame_sources[FORMAT_H264] = H264_STREAM
+        for format_index, source in self.frame_sources.items():
+            policy = PRODUCER_POLICY
+            # Live sources block on reads, they can't run inline; a shared memory
+            # ring is already filled by another process and always has its newest frame
+            if policy == 'inline' and isinstance(source, LiveMJPEGSource):
+                policy = 'block'
+            if isinstance(source, SharedFrameRing):
+                policy = 'inline'
+            # Every H.264 frame is needed to decode the next; never drop or repeat one
+            if isinstance(source, H264FileSource) and policy != 'inline':
+                policy = 'block'
+            if policy != 'inline':
+                producer = FrameProducer(source, PRODUCER_DEPTH, policy, FRAME_INTERVAL,
+                                         name=f"frames-{format_index}")
+                producer.on_error = lambda e: self.status.stream_error(VIDEO_STREAMING_INTERFACE,
+                                                                       STREAM_ERROR_UNKNOWN)
+                self.frame_sources[format_index] = producer
+        self.frame_source = self.frame_sources[FORMAT_MJPEG]
+        self.resume_producer(self.frame_source, FRAME_INTERVAL)
+        self.pacer = FramePacer(FRAME_INTERVAL, SERVICE_INTERVAL_NS)
+        self.payloads = PayloadEngine(self.payload_capacities()[-1], self.frame_source,
+                                      clock_frequency=VIDEO_CLOCK_FREQUENCY,
+                                      pacer=self.pacer)
+
+        self.replay = None
+        if REPLAY_CAPTURES:
+            self.replay = load_replay_table(REPLAY_CAPTURES, self.vendor_id, self.product_id)
+            log.info(f"Replaying {len(self.replay)} captured control requests from {', '.join(REPLAY_CAPTURES)}")
+
+        self.class_requests = RequestDispatcher(CLASS_REQUESTS)
+        if self.replay is not None:
+            for request in (uvc.UVC.GET_CUR, uvc.UVC.GET_INFO):
+                self.class_requests.add(VIDEO_CONTROL_INTERFACE, 0, request, ANY, ANY, self.reply_from_capture)
+        self.probe_commit = ProbeCommit(STREAM_FRAMES, self.payload_capacities(),
+                                        length=probe_length(UVC_VERSION),
+                                        clock_frequency=VIDEO_CLOCK_FREQUENCY,
+                                        header_length=self.payloads.header_length,
+                                        service_interval_ns=SERVICE_INTERVAL_NS,
+                                        max_frame_size=self.max_frame_size,
+                                        on_commit=self.handle_commit)
+        self.probe_commit.register(self.class_requests, VIDEO_STREAMING_INTERFACE,
+                                   STREAMING_ALTERNATE_NUMBERS)
+        self.still_capture = StillCapture(STILL_FORMATS, lambda: self.probe_commit.commit, self.payloads)
+        self.still_capture.register(self.class_requests, VIDEO_STREAMING_INTERFACE,
+                                    STREAMING_ALTERNATE_NUMBERS)
+        if H264_STREAM is not None:
+            # The key frame request is pending until its IDR leaves the producer for the bus
+            self.payloads.on_frame_started = H264_STREAM.frame_started
+            self.key_frames = KeyFrameControl(self.request_key_frame, pending=self.key_frame_pending)
+            self.key_frames.register(self.class_requests, VIDEO_STREAMING_INTERFACE,
+                                     STREAMING_ALTERNATE_NUMBERS)
+
+        # 4.2.2.1 Camera Terminal and 4.2.2.3 Processing Unit controls
+        control_errors = RequestErrorCode()
+        video_control = DESCRIPTOR_DEFINITION['VideoControl']
+        self.camera_controls = ControlStore(video_control['InputTerminalCamera'][1]['bTerminalID'],
+                                            CAMERA_TERMINAL_CONTROLS, control_errors)
+        self.processing_controls = ControlStore(video_control['ProcessingUnit'][1]['bUnitID'],
+                                                PROCESSING_UNIT_CONTROLS, control_errors)
+        for store in (self.camera_controls, self.processing_controls):
+            store.register(self.class_requests, VIDEO_CONTROL_INTERFACE)
+        self.image_adjustment = self.start_image_adjustment()
+
+        self.status.register(self.class_requests, VIDEO_STREAMING_INTERFACE, STREAMING_ALTERNATE_NUMBERS)
+        for store in (self.camera_controls, self.processing_controls):
+            store.listeners.append(self.report_control_change)
+        self._status_underruns = 0
+        if hasattr(signal, 'SIGUSR2'):
+            # kill -USR2 presses the camera's still button
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.press_button())
+
+        self.trace = None
+        if TRACE_RECORDS:
+            self.trace = TraceRing(TRACE_RECORDS, TRACE_SAMPLE)
+            self.trace.install_dump_handlers(TRACE_DUMP)
+
+        self.metrics = None
+        if METRICS_PATH:
+            self.start_metrics(METRICS_PATH, METRICS_INTERVAL)
+
+    def reply_from_capture(self, request):
+        """ VC GET_CUR/GET_INFO of a control nothing here models: the capture's answer, else an empty one """
+        if not self.replay.reply(request):
+            request.reply(b'')
+
+    def start_image_adjustment(self):
+        """ Apply brightness/contrast/gamma to the uncompressed test pattern, if it's streaming """
+        source = self.frame_sources[FORMAT_YUY2]
+        if isinstance(source, FrameProducer):
+            source = source.source
+        if not isinstance(source, PatternSource):
+            return None
+        adjustment = ImageAdjustment(self.processing_controls, source.np)
+        source.adjustment = adjustment
+        return adjustment
+
+    def report_control_change(self, store: ControlStore, control):
+        if control.info & INFO_AUTOUPDATE:
+            self.status.control_changed(store.unit_id, control.selector, store.current(control.selector))
+
+    def press_button(self):
+        """ Press and release the still button; with bTriggerUsage 0 the host takes a still """
+        self.status.button(VIDEO_STREAMING_INTERFACE, True)
+        self.status.button(VIDEO_STREAMING_INTERFACE, False)
+
+    def next_status_packet(self):
+        """ Status packet for the interrupt endpoint, once per interrupt interval """
+        if not self.status.due():
+            return None
+        # Frames the payload engine had to wait for since the last interval
+        underruns = self.payloads.underruns
+        if underruns != self._status_underruns:
+            self._status_underruns = underruns
+            self.status.stream_error(VIDEO_STREAMING_INTERFACE, STREAM_ERROR_INPUT_UNDERRUN)
+        return self.status.next_packet()
+
+    def start_metrics(self, path, interval: float):
+        self.metrics = Metrics()
+        self._request_labels = {}
+        self.pacer.lateness_histogram = self.metrics.histogram('frame_lateness_us')
+        for source in self.frame_sources.values():
+            if isinstance(source, FrameProducer):
+                source = source.source
+            if isinstance(source, OverlayEncoder):
+                source.encode_histogram = self.metrics.histogram('frame_encode_us')
+                self.metrics.add_collector(lambda encoder=source: {'overlay_frames_late': encoder.late})
+        # Counters only ever go up: the pacer's totals survive reset(), and the
+        # producers of every format are summed, not just the one streaming
+        sources = list(self.frame_sources.values())
+        self.metrics.add_collector(lambda: {
+            'frames_produced': self.payloads.frames_started,
+            'frames_sent': self.payloads.frames_sent,
+            'frames_dropped': (self.payloads.frames_abandoned + self.pacer.skipped_frames
+                               + sum(getattr(source, 'dropped', 0) for source in sources)),
+            'frames_repeated': sum(getattr(source, 'repeated', 0) for source in sources),
+            'stills_sent': self.payloads.stills_sent,
+            'status_events_posted': self.status.posted,
+            'status_events_coalesced': self.status.coalesced,
+            'status_packets_sent': self.status.sent,
+            'payloads_sent': self.payloads.payloads_sent,
+            'bytes_sent': self.payloads.bytes_sent,
+            'underruns': self.payloads.underruns,
+            **{f"pacer_{name}": value for name, value in self.pacer.stats().items()},
+        })
+        self.metrics_writer = MetricsWriter(self.metrics, path, interval,
+                                            rates=('bytes_sent', 'frames_sent'))
+        self.metrics_writer.start()
+        log.info(f"Writing metrics to {path} every {interval}s")
+
+    def payload_capacities(self) -> List[int]:
+        """ Largest payload of each streaming alternate; in bulk mode a whole frame """
+        if not BULK_STREAMING:
+            return [a.bytes_per_interval for a in STREAMING_LADDER]
+
+        frame_size = max(max(self.max_frame_size(frame), frame.max_frame_size) for frame in STREAM_FRAMES)
+        # 12 byte header with PTS and SCR
+        return [min(frame_size + 12, BULK_MAX_PAYLOAD_SIZE)]
+
+    @staticmethod
+    def resume_producer(source, frame_interval: int):
+        set_interval = getattr(source, 'set_interval', None)
+        if set_interval:
+            set_interval(frame_interval)
+        if isinstance(source, FrameProducer):
+            source.resume()
+
+    def max_frame_size(self, frame: FrameSetting) -> int:
+        """ Largest frame the source for `frame`'s format produces, 0 if unknown """
+        source = self.frame_sources.get(frame.format_index)
+        max_frame_size = getattr(source, 'max_frame_size', None)
+        return max_frame_size() if max_frame_size else 0
+
+    def get_descriptor(self) -> bytes:
+        descriptor = super().get_descriptor()
+        if SUPERSPEED:
+            descriptor = bytearray(descriptor)
+            descriptor[7] = SUPERSPEED_EP0_PACKET_SIZE
+            descriptor = bytes(descriptor)
+        return descriptor
+
+    def request_key_frame(self):
+        """ Make the next H.264 frame an IDR, dropping frames produced ahead of it """
+        if H264_STREAM is None:
+            return
+        source = self.frame_sources[FORMAT_H264]
+        if isinstance(source, FrameProducer):
+            # Requested from the producer thread, so a frame it's reading
+            # can't slip in after the flush
+            source.flush(then=H264_STREAM.request_key_frame)
+        else:
+            H264_STREAM.request_key_frame()
+
+    def key_frame_pending(self) -> bool:
+        source = self.frame_sources[FORMAT_H264]
+        return H264_STREAM.key_frame_pending or (isinstance(source, FrameProducer) and source.flush_pending)
+
+    def handle_commit(self, values: dict):
+        self.pacer.set_interval(values['dwFrameInterval'])
+        source = self.frame_sources[values['bFormatIndex']]
+        if source is not self.frame_source:
+            if isinstance(self.frame_source, FrameProducer):
+                self.frame_source.pause()
+            self.frame_source = self.payloads.frame_source = source
+            self.payloads.stop()
+        self.resume_producer(source, values['dwFrameInterval'])
+        if BULK_STREAMING:
+            # No alternate to select, the stream starts now
+            self.payloads.stop()
+            self.payloads.resize(values['dwMaxPayloadTransferSize'])
+            self.pacer.reset()
+            self.start_on_key_frame()
+
+    def start_streaming(self, setting):
+        expected = pick_alternate(STREAMING_LADDER, self.probe_commit.commit['dwMaxPayloadTransferSize'])
+        if setting != expected:
+            log.warning(f"Host selected alternate {setting.alternate} ({setting.bytes_per_interval} bytes), "
+                        f"committed stream fits alternate {expected.alternate} ({expected.bytes_per_interval} bytes)")
+        self.payloads.resize(setting.bytes_per_interval)
+        self.pacer.reset()
+        self.start_on_key_frame()
+
+    def start_on_key_frame(self):
+        """ A host decoder can only join an H.264 stream at an IDR """
+        if self.probe_commit.commit['bFormatIndex'] == FORMAT_H264:
+            self.request_key_frame()
+
+    def stop_streaming(self):
+        self.payloads.stop()
+
+    def active_alternate(self, interface: int) -> int:
+        if self.configuration is None:
+            return 0
+        active = self.configuration.active_interfaces.get(interface)
+        return active.alternate if active is not None else 0
+
+    def handle_request(self, request: USBControlRequest):
+        if self.trace is not None:
+            self.trace.submit(request, self.address)
+        if self.metrics is None:
+            return self._handle_request(request)
+
+        start = time.perf_counter_ns()
+        self._handle_request(request)
+        elapsed_us = (time.perf_counter_ns() - start) // 1000
+
+        key = (request.request_type, request.number, request.index & 0xff)
+        labels = self._request_labels.get(key)
+        if labels is None:
+            labels = self._request_labels[key] = self.request_labels(request)
+        self.metrics.increment('control_requests_total', labels)
+        self.metrics.histogram('control_request_latency_us', labels[:2]).observe(elapsed_us)
+
+    @staticmethod
+    def request_labels(request: USBControlRequest) -> tuple:
+        """ Metric labels of a request: type, recipient, request number and interface """
+        kinds = ('standard', 'class', 'vendor', 'reserved')
+        recipients = ('device', 'interface', 'endpoint', 'other')
+        recipient = request.request_type & 0x1f
+        interface = str(request.index & 0xff) if recipient == 1 else ''
+        return (('type', kinds[(request.request_type >> 5) & 0x03]),
+                ('recipient', recipients[recipient] if recipient < 4 else 'reserved'),
+                ('request', f"0x{request.number:02x}"),
+                ('interface', interface))
+
+    def _handle_request(self, request: USBControlRequest):
+        # USBDevice.handle_request, formatting only when logged and with the
+        # captures tried before stalling
+        log.debug("%s received request: %s", self.name, request)
+        if USBRequestHandler.handle_request(self, request):
+            return
+        if self.replay is not None and self.replay.reply(request):
+            return
+        log.warning("Stalling unhandled %s.", request)
+        self._add_request_suggestion(request)
+        self.stall(direction=USBDirection.IN)
+
+    def control_send(self, endpoint_number: int, in_request: USBControlRequest, data: bytes, *,
+                     blocking: bool = False):
+        if self.trace is not None:
+            self.trace.complete(data)
+        super().control_send(endpoint_number, in_request, data, blocking=blocking)
+
+    def stall(self, *, endpoint_number: int = 0, direction: USBDirection = USBDirection.OUT):
+        if self.trace is not None and endpoint_number == 0:
+            self.trace.complete(status=STATUS_STALL)
+        super().stall(endpoint_number=endpoint_number, direction=direction)
+
+    # All UVC class requests go through one table instead of per-interface handlers
+    @class_request_handler()
+    @to_any_interface
+    def handle_uvc_request(self, request: USBControlRequest):
+        interface = request.index & 0xff
+        if not self.class_requests.dispatch(request, self.active_alternate(interface)):
+            # Not handled here; facedancer stalls it
+            raise NotImplementedError()
+
     class Webcam(USBConfigurationOverride):
 
 
@@ -87,105 +840,60 @@ class Webcam(USBDevice):
 
             class ClassSpeicifcVideoControl(USBDescriptor):
                 include_in_config: bool = True
-                raw = uvc.ClassSpecificVCInterfaceHeader.build({
-                    'bcdUVC': 1.0,
-                    'wTotalLength': 214,
-                    'dwClockFrequency': 30000000,
-                    'bInCollection': 1,
-                    'baInterfaceNr': 1
-                })
+                raw = DESCRIPTORS['ClassSpecificVideoControl']
 
             class InputTerminalCamera(USBDescriptor):
                 include_in_config: bool = True
-                raw = uvc.InputTerminalCameraInputDescriptor.build({
-                    'bTerminalID':0x02,
-                    'wTerminalType':0x0201,
-                    'bAssocTerminal':0x00,
-                    'iTerminal':0x00,
-                    'bTerminalID':0x01,
-                    'bAssocTerminal':0x00,
-                    'iTerminal':0x00,
-                    'wObjectiveFocalLengthMin':0x0000,
-                    'wObjectiveFocalLengthMax':0x0000,
-                    'wOcularFocalLength':0x0000,
-                    'bmControls':0x0000,
-                })
+                raw = DESCRIPTORS['InputTerminalCamera']
 
             class InputTerminalComposite(USBDescriptor):
                 include_in_config: bool = True
-                raw = uvc.InputTerminalDescriptorComposite.build({
-                    'bTerminalID':0x02,
-                    'bAssocTerminal':0x00,
-                    'iTerminal':0x00,
-                })
+                raw = DESCRIPTORS['InputTerminalComposite']
 
             class OutputTerminal(USBDescriptor):
                 include_in_config: bool = True
-                raw = uvc.OutputTerminalDescriptor.build({
-                    'bTerminalID':0x03,
-                    'wTerminalType':0x0101,
-                    'bAssocTerminal':0x00,
-                    'bSourceID':0x05,
-                    'iTerminal':0x00,
-                })
+                raw = DESCRIPTORS['OutputTerminal']
 
             class SelectorUnit(USBDescriptor):
                 include_in_config: bool = True
-                raw = uvc.SelectorUnitDescriptor.build({
-                    'bUnitID':0x05,
-                    'bNrInPins':1,
-                    'baSourceID':0x01,
-                    'iSelector':0x00
-                })
+                raw = DESCRIPTORS['SelectorUnit']
 
             # 2.3.4.7 Processing Unit Descriptor
             class ProcessingUnit(USBDescriptor):
                 include_in_config: bool = True
-                raw = uvc.ProcessingUnitDescriptor.build({
-                    'bUnitID':0x05,
-                    'bSourceID':0x04,
-                    'wMaxMultiplier':0x0000,
-                    'bmControls':0x000001, # Brightness control
-                    'iProcessing':0x00,
-                    'bmVideoStandards':0x00
-                })
+                raw = DESCRIPTORS['ProcessingUnit']
 
             # 2.3.4.8 Standard Interrupt Endpoint Descriptor
+            @use_inner_classes_automatically
             class StandardInterruptEndpoint(USBEndpoint):
                 number = 0x81
                 direction = USBDirection.IN
-                interval = 0x09
+                interval = STATUS_ENDPOINT_INTERVAL
                 transfer_type = USBTransferType.INTERRUPT
-
-            # 2.3.4.9 Class-specific Interrupt Endpoint Descriptor
-            # class ClassSpecificInterruptEndpoint(USBDescriptor):
-            #     raw: bytes = binascii.unhexlify('0505030040')
-            #     include_in_config: bool = True
-
-            # OR
-
-            # 2.3.4.9 Class-specific Interrupt Endpoint Descriptor
-            # class ClassSpecificInterruptEndpoint(USBEndpoint):
-            #     number=  0x83
-            #     direction = USBDirection.OUT
-            #     transfer_type = USBTransferType.INTERRUPT
-
-
-            @class_request_handler(number=0x81, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x81(self, request: USBControlRequest):
-                log.info(f"VideoControl 0x81 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                request.ack()
-
-            @class_request_handler(number=0x86, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x86(self, request: USBControlRequest):
-                log.info(f"VideoControl 0x86 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                request.ack()
+                max_packet_size = STATUS_MAX_TRANSFER_SIZE
+
+                def handle_data_requested(self: USBEndpoint):
+                    device = self.get_device()
+                    packet = device.next_status_packet()
+                    if packet is not None:
+                        device.backend.send_on_endpoint(self.number & 0x7f, packet, blocking=False)
+
+                if SUPERSPEED:
+                    # Every SuperSpeed endpoint has a companion; one 64 byte packet per interval
+                    class EndpointCompanion(USBDescriptor):
+                        include_in_config = True
+                        raw = binascii.unhexlify('063000004000')
+
+                # 2.3.4.9 Class-specific Interrupt Endpoint Descriptor, after the
+                # standard one (and its companion): status packets of up to 64 bytes
+                class ClassSpecificInterruptEndpoint(USBDescriptor):
+                    include_in_config = True
+                    raw = (bytes((5, uvc.UVC.CS_ENDPOINT, uvc.UVC.EP_INTERRUPT))
+                           + STATUS_MAX_TRANSFER_SIZE.to_bytes(2, 'little'))
 
         # 2.3.5.1 Operational Alternate Setting 0
         # 2.3.5.1.1 Standard VS Interface Descriptor
-        class VideoStreamingAlt0(USBInterface):
+        class VideoStreamingAlt0(USBAlternateInterface):
             number = 0x01
             alternate = 0x00
             class_number = 0x0e
@@ -194,146 +902,56 @@ class Webcam(USBDevice):
             # 2.3.5.1.2 Class-specific VS Header Descriptor (Input)
             class ClassSpecificVideoStreamHeader(USBDescriptor):
                 include_in_config = True
-                raw = uvc.ClassSpecificVideoStreamInputHeaderDescriptor.build({
-                    'bNumFormats': 0x01,
-                    'wTotalLength': 0x003f,
-                    'bEndPointAddress': 0x82,
-                    'bmInfo': 0x00,
-                    'bTerminalLink': 0x03,
-                    'bStillCaptureMethod': 0x01,
-                    'bTriggerSupport': 0x01,
-                    'bTriggerUsage': 0x00,
-                    'bControlSize': 0x01,
-                    'bmaControls': 0x00
-                })
+                raw = DESCRIPTORS['ClassSpecificVideoStreamHeader']
 
             # 2.3.5.1.3 Class-specific VS Format Descriptor
             class FormatMJPEG(USBDescriptor):
                 include_in_config: bool = True
-                raw = uvc.ClassSpecificVideoStreamFormatDescriptorMJPEG.build({
-                    'bFormatIndex':0x01,
-                    'bNumFrameDescriptors':0x01,
-                    'bmFlags':0x01,
-                    'bDefaultFrameIndex':0x01,
-                    'bAspectRatioX':0,
-                    'bAspectRatioY':0,
-                    'bmInterlaceFlags':0,
-                    'bCopyProtect':0
-                })
+                raw = DESCRIPTORS['FormatMJPEG']
 
             # 2.3.5.1.4 Class-specific VS Frame Descriptor
             class Frame(USBDescriptor):
                 include_in_config: bool = True
-                raw = uvc.ClassSpecificVideoStreamFrameDescriptorMJPEG.build({
-                    'bFrameIndex':0x01,
-                    'bmCapabilities':0x03,
-                    'wWidth':176,
-                    'wHeight':144,
-                    'dwMinBitRate':0x000DEC00,
-                    'dwMaxBitRate':0x000DEC00,
-                    'dwMaxVideoFrameBufSize':0x00009480,
-                    'dwDefaultFrameInterval':0x000A2C2A,
-                    'bFrameIntervalType':0,
-                    'dwMinFrameInterval':0x000A2C2A,
-                    'dwMaxFrameInterval':0x000A2C2A,
-                    'dwFrameIntervalStep':0x00000000,
-                })
-
-            # SET VALUE
-            @class_request_handler(number=1, direction=USBDirection.OUT)
-            @to_this_interface
-            def handle_control_request_1(self, request):
-                request.ack()
-
-            @class_request_handler(number=0x81, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x81(self, request: USBControlRequest):
-                log.info(f"VideoStreamingAlt0 0x81 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                request.reply(binascii.unhexlify('0100010115160500000000003d000000000000600900800a0000'))
-
-            @class_request_handler(number=0x82, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x82(self, request: USBControlRequest):
-                log.info(f"VideoStreamingAlt0 0x82 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                request.ack()
-
-            # GET_INFO
-            @class_request_handler(number=0x86, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x86(self, request):
-                log.info(f"VideoStreamingAlt0 0x86 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                request.ack()
-
-            # GET_DEF
-            @class_request_handler(number=0x87, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x87(self, request):
-                log.info(f"VideoStreamingAlt0 0x87 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                request.reply(binascii.unhexlify('0100010115160500000000003d00000000000000000000000000'))
-
-
-        # 2.3.5.2 Operational Alternate Setting 1
-        # 2.3.5.2.1 Standard VS Interface Descriptor
-        class VideoStreamingAlt1(USBInterface):
-            number = 0x01
-            alternate = 0x01
-            class_number = 0x0e
-            subclass_number = 0x02
+                raw = DESCRIPTORS['Frame']
+
+            # 3.9.2.6 Still Image Frame Descriptor
+            class StillFrame(USBDescriptor):
+                include_in_config: bool = True
+                raw = DESCRIPTORS['StillFrame']
 
-            # 2.3.5.2.2 Standard VS Isochronous Video Data Endpoint Descriptor
-            class IsochronousVideoEndpoint(USBEndpoint):
-                number: int = 0x02
-                direction: USBDirection = USBDirection.IN
-                transfer_type: USBTransferType = USBTransferType.ISOCHRONOUS
-                max_packet_size: int = 0x01fe #510 bytes
-                synchronization_type: USBSynchronizationType = (
-                    USBSynchronizationType.ASYNC
-                )
-                usage_type: USBUsageType = USBUsageType.DATA
-                interval = 0x01
-
-                # def handle_data_requested(self: USBEndpoint):
-                #     logging.info("handle_data_requested")
-                #     self.send(b"device on bulk endpoint")
-
-            # INTERFACE RESPONSES
-            # 0x81 GET_CUR
-            # 0x82 GET_MIN
-            # 0x83 GET_MAX
-            # 0x84 GET_RES
-            # 0x86 GET_INFO
-            # 0x87 GET_DEV
-
-            @class_request_handler(number=0x81, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x81(self, request: USBControlRequest):
-                log.info(f"VideoStreamingAlt1 0x81 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                request.ack()
-
-            @class_request_handler(number=0x82, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x82(self, request: USBControlRequest):
-                log.info(f"VideoStreamingAlt1 0x82 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                request.ack()
-
-            # GET_INFO
-            @class_request_handler(number=0x86, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x86(self, request):
-                log.info(f"VideoStreamingAlt1 0x86 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                request.ack()
-
-            # GET_DEF
-            @class_request_handler(number=0x87, direction=USBDirection.IN)
-            @to_this_interface
-            def handle_control_request_0x87(self, request):
-                log.info(f"VideoStreamingAlt1 0x87 request direciton: {request.direction:x} type: {request.type} recipient: {request.recipient} num,value,index,length {request.number:x},{request.value:x},{request.index:x},{request.length:x} bytes: {request.data}")
-                # Most recent request was for 26B of data.
-                # Replace me with your handler.
-                #
-                # request.stall()
-                request.reply(binascii.unhexlify('0100010115160500000000003d00000000000000000000000000'))
+            class FormatYUY2(USBDescriptor):
+                include_in_config: bool = True
+                raw = DESCRIPTORS['FormatYUY2']
 
+            class FrameYUY2(USBDescriptor):
+                include_in_config: bool = True
+                raw = DESCRIPTORS['FrameYUY2']
+
+            class StillFrameYUY2(USBDescriptor):
+                include_in_config: bool = True
+                raw = DESCRIPTORS['StillFrameYUY2']
+
+            if H264_STREAM is not None:
+                # Frame Based Payload 3.1.1 Frame Based Video Format Descriptor
+                class FormatH264(USBDescriptor):
+                    include_in_config: bool = True
+                    raw = DESCRIPTORS['FormatH264']
+
+                # Frame Based Payload 3.1.2 Frame Based Video Frame Descriptor
+                class FrameH264(USBDescriptor):
+                    include_in_config: bool = True
+                    raw = DESCRIPTORS['FrameH264']
+
+            # 2.3.5.2.3 Standard VS Bulk Video Data Endpoint Descriptor
+            if BULK_STREAMING:
+                VideoEndpoint = BulkVideoEndpoint
+
+            def handle_alternate_selected(self):
+                # Zero bandwidth, the host stopped streaming
+                self.get_device().stop_streaming()
+        def generate_interfaces(self):
+            # 2.3.5.2 Operational Alternate Settings 1..n, one per rung of the bandwidth ladder
+            return [alternate(parent=self) for alternate in VIDEO_STREAMING_ALTERNATES]
 
 
 
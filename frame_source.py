@@ -0,0 +1,172 @@
+# Frame sources for the video endpoint
+#
+# MJPEGFileSource memory-maps a file of concatenated JPEG images (an MJPEG
+# clip, or a directory of JPEGs packed with pack_directory()) and serves each
+# frame as a memoryview into the mapping, so frames are never read into the
+# Python heap. Frame boundaries (SOI/EOI markers) are found once and saved in
+# an index file next to the clip; later runs load the index instead of scanning
+
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+from array import array
+from pathlib import Path
+
+from facedancer.logging import log
+
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'UVCIDX01'
+# magic, clip size, clip mtime (ns), frame count
+INDEX_HEADER = struct.Struct('<8sQQQ')
+
+
+def scan_frames(data) -> array:
+    """
+    Find every SOI..EOI span in `data`
+
+    Returns a flat array of (start, end) offsets. JPEG entropy-coded data can't
+    contain an EOI marker (0xFF is always stuffed), so the first EOI after an
+    SOI closes the frame; embedded EXIF thumbnails aren't supported
+    """
+    offsets = array('Q')
+    find = data.find
+    position = 0
+    while True:
+        start = find(SOI, position)
+        if start < 0:
+            break
+        end = find(EOI, start + 2)
+        if end < 0:
+            log.warning(f"Truncated JPEG at offset {start}, ignoring the rest of the clip")
+            break
+        end += 2
+        offsets.append(start)
+        offsets.append(end)
+        position = end
+    return offsets
+
+
+# Start Of Frame markers; 0xC4, 0xC8 and 0xCC in that range are DHT, JPG and DAC
+SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+def jpeg_size(data) -> tuple:
+    """ (width, height) from the SOF segment of a JPEG; ValueError if there is none """
+    position = 2
+    while position + 9 <= len(data):
+        if data[position] != 0xff:
+            break
+        marker = data[position + 1]
+        if marker == 0xff:
+            # Fill byte
+            position += 1
+            continue
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', data, position + 5)
+            return width, height
+        if marker == 0xd9 or marker == 0xda:
+            # EOI or SOS, past the headers
+            break
+        position += 2 + struct.unpack_from('>H', data, position + 2)[0]
+    raise ValueError("No SOF segment in JPEG")
+
+
+class MJPEGFileSource:
+    """ Memory-mapped MJPEG clip; calling the source returns the next frame, looping forever """
+
+    def __init__(self, path, index_path=None):
+        self.path = Path(path)
+        self.index_path = Path(index_path) if index_path else self.path.with_name(self.path.name + INDEX_SUFFIX)
+
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        self._view = memoryview(self._map)
+
+        self.offsets = self._load_index()
+        if self.offsets is None:
+            self.offsets = scan_frames(self._map)
+            self._save_index()
+        if not self.offsets:
+            raise ValueError(f"No JPEG frames found in {self.path}")
+
+        self.position = 0
+        self._max_frame_size = None
+
+    def __len__(self):
+        return len(self.offsets) // 2
+
+    def __getitem__(self, index: int) -> memoryview:
+        start = self.offsets[2 * index]
+        end = self.offsets[2 * index + 1]
+        return self._view[start:end]
+
+    def __call__(self) -> memoryview:
+        frame = self[self.position]
+        self.position += 1
+        if self.position == len(self):
+            self.position = 0
+        return frame
+
+    def frame_size(self, index: int) -> int:
+        return self.offsets[2 * index + 1] - self.offsets[2 * index]
+
+    def max_frame_size(self) -> int:
+        if self._max_frame_size is None:
+            offsets = self.offsets
+            self._max_frame_size = max(offsets[i + 1] - offsets[i] for i in range(0, len(offsets), 2))
+        return self._max_frame_size
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                magic, size, mtime, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                if magic != INDEX_MAGIC or (size, mtime) != self._stat:
+                    return None
+                offsets = array('Q')
+                offsets.fromfile(f, 2 * count)
+        except (OSError, struct.error, EOFError):
+            return None
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        return offsets
+
+    def _save_index(self):
+        offsets = self.offsets
+        if sys.byteorder != 'little':
+            offsets = array('Q', offsets)
+            offsets.byteswap()
+        try:
+            with open(self.index_path, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, *self._stat, len(self.offsets) // 2))
+                offsets.tofile(f)
+        except OSError as e:
+            log.warning(f"Couldn't save frame index {self.index_path}: {e}")
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+
+
+def pack_directory(directory, output):
+    """ Concatenate every *.jpg/*.jpeg in `directory`, in name order, into one clip file """
+    paths = sorted(p for p in Path(directory).iterdir() if p.suffix.lower() in ('.jpg', '.jpeg'))
+    with open(output, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+    return len(paths)
+
+
+if __name__ == "__main__":
+    # python frame_source.py <jpeg directory> <clip.mjpeg>
+    count = pack_directory(sys.argv[1], sys.argv[2])
+    print(f"Packed {count} frames into {sys.argv[2]}")
@@ -0,0 +1,373 @@
+# H.264 frame source for the frame-based format (UVC 1.5 Frame Based Payload)
+#
+# H264FileSource memory-maps an H.264 Annex B byte stream (ffmpeg -c:v libx264
+# -bf 0 -f h264 clip.h264) and serves one access unit per frame, passed
+# through as encoded: nothing is decoded or re-encoded, so a 1080p or 4K
+# stream fits isochronous bandwidth that MJPEG at that size can't. Like
+# MJPEGFileSource, the stream is scanned once: NAL units are found by their
+# start codes and grouped into access units (H.264 7.4.1.2.3), and where
+# each access unit starts, which ones are IDR pictures and where the first
+# SPS/PPS are is saved in an index file next to the stream, so later runs
+# load the index instead of scanning.
+#
+# A key frame request (VS_GENERATE_KEY_FRAME_CONTROL, or a stream starting)
+# makes the next frame the IDR nearest the current position, found by
+# bisecting the IDR list: going back a few frames replays them, which is
+# less of a jump than skipping most of a GOP ahead. An IDR whose access
+# unit doesn't repeat the SPS/PPS gets the stream's parameter sets
+# prepended, so a decoder can start there. The request stays pending until
+# the payload engine starts sending that IDR (frame_started()), not just
+# until a producer thread queues it. Streams with B-frames are passed
+# through in decoding order, which hosts expect from a frame-based format
+# anyway
+
+import bisect
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+from pathlib import Path
+
+from facedancer.logging import log
+
+import uvc
+from dispatch import ANY
+
+
+START_CODE = b'\x00\x00\x01'
+
+# nal_unit_type (Table 7-1)
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+# NAL units that can only come before the first slice of an access unit
+NAL_AU_PREFIX = {NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD, 14, 15, 16, 17, 18}
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'UVCH2641'
+# magic, stream size, stream mtime (ns), access units, IDRs, SPS start/end, PPS start/end
+INDEX_HEADER = struct.Struct('<8sQQQQQQQQ')
+
+# Access unit flags
+AU_IDR = 0x01
+AU_PARAMETER_SETS = 0x02
+
+
+def scan_access_units(data):
+    """
+    Find the access units of an Annex B stream
+
+    Returns (offsets, flags, parameter_sets): the start of every access unit
+    followed by the end of the last one, AU_* flags for each access unit,
+    and the (start, end) of the first SPS and of the first PPS. A slice with
+    first_mb_in_slice 0 after the slices of an access unit, or an SEI,
+    SPS, PPS or delimiter after them, starts the next access unit
+    """
+    offsets = array('Q')
+    flags = array('B')
+    sps = pps = (0, 0)
+    find = data.find
+    length = len(data)
+
+    position = find(START_CODE)
+    has_slices = False
+    au_flags = 0
+    while position >= 0:
+        # A four byte start code's zero belongs to this NAL unit, not the last one
+        start = position - 1 if position > 0 and data[position - 1] == 0 else position
+        header = position + 3
+        following = find(START_CODE, header)
+        end = following if following >= 0 else length
+        if header >= length:
+            break
+
+        nal_type = data[header] & 0x1f
+        if nal_type in NAL_AU_PREFIX:
+            new_au = has_slices or not offsets
+        elif nal_type in (NAL_SLICE, NAL_IDR):
+            # first_mb_in_slice is ue(v): 0 is a single 1 bit
+            new_au = not offsets or (has_slices and header + 1 < length and data[header + 1] & 0x80)
+        else:
+            new_au = not offsets
+
+        if new_au:
+            if offsets:
+                flags.append(au_flags)
+            offsets.append(start)
+            has_slices = False
+            au_flags = 0
+
+        if nal_type in (NAL_SLICE, NAL_IDR):
+            has_slices = True
+            if nal_type == NAL_IDR:
+                au_flags |= AU_IDR
+        elif nal_type == NAL_SPS:
+            au_flags |= AU_PARAMETER_SETS
+            if sps == (0, 0):
+                sps = (start, end)
+        elif nal_type == NAL_PPS and pps == (0, 0):
+            pps = (start, end)
+
+        position = following
+
+    if offsets:
+        flags.append(au_flags)
+        offsets.append(length)
+    return offsets, flags, (sps, pps)
+
+
+def unescape(rbsp) -> bytes:
+    """ Drop the emulation prevention bytes of a NAL unit's payload """
+    return bytes(rbsp).replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+class BitReader:
+    """ Exp-Golomb bit reader over an unescaped NAL unit payload """
+
+    def __init__(self, data: bytes):
+        self.value = int.from_bytes(data, 'big')
+        self.remaining = len(data) * 8
+
+    def u(self, bits: int) -> int:
+        if bits > self.remaining:
+            raise ValueError("SPS ends early")
+        self.remaining -= bits
+        return (self.value >> self.remaining) & ((1 << bits) - 1)
+
+    def ue(self) -> int:
+        zeros = 0
+        while not self.u(1):
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+# profile_idc values whose SPS carries chroma format and scaling lists
+HIGH_PROFILES = {100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135}
+
+
+def sps_size(sps) -> tuple:
+    """ (width, height) of the pictures an SPS NAL unit (without start code) describes, after cropping """
+    bits = BitReader(unescape(sps[1:]))
+    profile_idc = bits.u(8)
+    bits.u(16)      # constraint flags, level_idc
+    bits.ue()       # seq_parameter_set_id
+    chroma_format_idc = 1
+    if profile_idc in HIGH_PROFILES:
+        chroma_format_idc = bits.ue()
+        if chroma_format_idc == 3:
+            bits.u(1)   # separate_colour_plane_flag
+        bits.ue()       # bit_depth_luma_minus8
+        bits.ue()       # bit_depth_chroma_minus8
+        bits.u(1)       # qpprime_y_zero_transform_bypass_flag
+        if bits.u(1):   # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if bits.u(1):
+                    last = following = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if following:
+                            following = (last + bits.se()) % 256
+                        last = following or last
+    bits.ue()       # log2_max_frame_num_minus4
+    poc_type = bits.ue()
+    if poc_type == 0:
+        bits.ue()
+    elif poc_type == 1:
+        bits.u(1)
+        bits.se()
+        bits.se()
+        for _ in range(bits.ue()):
+            bits.se()
+    bits.ue()       # max_num_ref_frames
+    bits.u(1)       # gaps_in_frame_num_value_allowed_flag
+    width = (bits.ue() + 1) * 16
+    height_units = bits.ue() + 1
+    frame_mbs_only = bits.u(1)
+    if not frame_mbs_only:
+        bits.u(1)   # mb_adaptive_frame_field_flag
+    bits.u(1)       # direct_8x8_inference_flag
+    height = height_units * 16 * (2 - frame_mbs_only)
+
+    if bits.u(1):   # frame_cropping_flag
+        left, right, top, bottom = bits.ue(), bits.ue(), bits.ue(), bits.ue()
+        crop_x = 2 if chroma_format_idc in (1, 2) else 1
+        crop_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+        width -= (left + right) * crop_x
+        height -= (top + bottom) * crop_y
+    return width, height
+
+
+class H264FileSource:
+    """ Memory-mapped H.264 Annex B stream; calling the source returns the next access unit, looping forever """
+
+    def __init__(self, path, index_path=None):
+        self.path = Path(path)
+        self.index_path = Path(index_path) if index_path else self.path.with_name(self.path.name + INDEX_SUFFIX)
+
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        self._view = memoryview(self._map)
+
+        index = self._load_index()
+        if index is None:
+            index = scan_access_units(self._map)
+            self.offsets, self.flags, self.parameter_set_spans = index
+            self._save_index()
+        else:
+            self.offsets, self.flags, self.parameter_set_spans = index
+        self.idrs = array('Q', (i for i, flags in enumerate(self.flags) if flags & AU_IDR))
+        if not self.idrs:
+            raise ValueError(f"No IDR pictures found in {self.path}")
+
+        (sps_start, sps_end), (pps_start, pps_end) = self.parameter_set_spans
+        self.parameter_sets = bytes(self._map[sps_start:sps_end]) + bytes(self._map[pps_start:pps_end])
+        if not sps_end:
+            raise ValueError(f"No SPS found in {self.path}")
+
+        # Start at an IDR: leading frames before the first one can't be decoded
+        self.position = self.idrs[0]
+        self._key_frame_requested = False
+        # The IDR handed out for the last key frame request, until it's being sent
+        self._key_frame = None
+        self._max_frame_size = None
+        self.key_frames_sent = 0
+
+    def size(self) -> tuple:
+        """ (width, height) of the stream's pictures, from its first SPS """
+        start = self._map.find(START_CODE, self.parameter_set_spans[0][0]) + 3
+        return sps_size(self._map[start:self.parameter_set_spans[0][1]])
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __getitem__(self, index: int) -> memoryview:
+        return self._view[self.offsets[index]:self.offsets[index + 1]]
+
+    def __call__(self):
+        key_frame = self._key_frame_requested
+        if key_frame:
+            self._key_frame_requested = False
+            self.position = self.nearest_idr(self.position)
+
+        index = self.position
+        self.position += 1
+        if self.position == len(self):
+            self.position = self.idrs[0]
+
+        frame = self[index]
+        if self.flags[index] & AU_IDR and not self.flags[index] & AU_PARAMETER_SETS:
+            # The only copy: a decoder joining at this IDR needs the parameter sets
+            frame = self.parameter_sets + frame
+        if key_frame:
+            self._key_frame = frame
+        return frame
+
+    def nearest_idr(self, index: int) -> int:
+        """ The IDR access unit nearest `index`; past the last IDR, the stream loops to the first """
+        idrs = self.idrs
+        found = bisect.bisect_left(idrs, index)
+        following = idrs[found] if found < len(idrs) else len(self) + idrs[0]
+        if found and index - idrs[found - 1] < following - index:
+            return idrs[found - 1]
+        return following % len(self)
+
+    def request_key_frame(self):
+        """ Make the next frame an IDR; safe to call from another thread than the one calling the source """
+        self._key_frame = None
+        self._key_frame_requested = True
+
+    def frame_started(self, frame):
+        """ Called by the payload engine as it starts sending `frame` """
+        if frame is self._key_frame:
+            self._key_frame = None
+            self.key_frames_sent += 1
+
+    @property
+    def key_frame_pending(self) -> bool:
+        """ A key frame was requested and hasn't started going out yet """
+        return self._key_frame_requested or self._key_frame is not None
+
+    def frame_size(self, index: int) -> int:
+        return self.offsets[index + 1] - self.offsets[index]
+
+    def max_frame_size(self) -> int:
+        if self._max_frame_size is None:
+            offsets = self.offsets
+            self._max_frame_size = max(offsets[i + 1] - offsets[i] for i in range(len(offsets) - 1))
+            self._max_frame_size += len(self.parameter_sets)
+        return self._max_frame_size
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                magic, size, mtime, count, _, *spans = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                if magic != INDEX_MAGIC or (size, mtime) != self._stat:
+                    return None
+                offsets = array('Q')
+                offsets.fromfile(f, count + 1)
+                flags = array('B')
+                flags.fromfile(f, count)
+        except (OSError, struct.error, EOFError):
+            return None
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        return offsets, flags, (tuple(spans[:2]), tuple(spans[2:]))
+
+    def _save_index(self):
+        offsets = self.offsets
+        if sys.byteorder != 'little':
+            offsets = array('Q', offsets)
+            offsets.byteswap()
+        (sps_start, sps_end), (pps_start, pps_end) = self.parameter_set_spans
+        idrs = sum(1 for flags in self.flags if flags & AU_IDR)
+        try:
+            with open(self.index_path, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, *self._stat, len(self.flags), idrs,
+                                          sps_start, sps_end, pps_start, pps_end))
+                offsets.tofile(f)
+                self.flags.tofile(f)
+        except OSError as e:
+            log.warning(f"Couldn't save access unit index {self.index_path}: {e}")
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+
+
+class KeyFrameControl:
+    """
+    VS_GENERATE_KEY_FRAME_CONTROL (4.3.1.5): SET_CUR 1 asks for a key frame,
+    passed on to `on_request`; it reads back as 1 while `pending()`, until
+    the key frame starts going out
+    """
+
+    def __init__(self, on_request, pending=None):
+        self.on_request = on_request
+        self.pending = pending or (lambda: False)
+
+    def handle_set_cur(self, request):
+        if request.data and request.data[0] == 1:
+            log.info("Key frame requested")
+            self.on_request()
+        request.ack()
+
+    def register(self, dispatcher, interface: int, alternates):
+        """ Add the control's handlers for `interface` to `dispatcher`, for each alternate setting """
+        UVC = uvc.UVC
+        selector = UVC.VS_GENERATE_KEY_FRAME_CONTROL
+        for alternate in alternates:
+            dispatcher.add(interface, alternate, UVC.GET_INFO, selector, ANY, b'\x03')
+            dispatcher.add(interface, alternate, UVC.GET_LEN, selector, ANY, b'\x01\x00')
+            dispatcher.add(interface, alternate, UVC.SET_CUR, selector, ANY, self.handle_set_cur)
+            dispatcher.add(interface, alternate, UVC.GET_CUR, selector, ANY,
+                           lambda request: request.reply(bytes([int(self.pending())])[:request.length]))
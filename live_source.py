@@ -0,0 +1,205 @@
+# Live MJPEG ingest
+#
+# LiveMJPEGSource turns the fake camera into a virtual camera fed by another
+# process: a byte stream of concatenated JPEGs (ffmpeg -f mjpeg, gstreamer
+# multifilesink/jpegenc, a capture pipeline) on stdin, a named pipe or a UNIX
+# socket we listen on:
+#
+#   ffmpeg -i input.mp4 -f mjpeg -q:v 3 - | FAKE_UVC_MJPEG=- python fake-cam.py
+#   mkfifo /tmp/cam; FAKE_UVC_MJPEG=/tmp/cam python fake-cam.py
+#   FAKE_UVC_MJPEG=unix:/tmp/cam.sock python fake-cam.py
+#   ffmpeg -re -i input.mp4 -f mjpeg unix:/tmp/cam.sock
+#
+# JPEGSplitter finds frame boundaries incrementally: each chunk read is
+# searched once for SOI/EOI markers, starting where the last search stopped,
+# and a marker split across two chunks is caught by remembering whether the
+# previous chunk ended in 0xFF. Frames that fit inside one chunk are handed
+# out as memoryviews of that chunk; only frames spanning chunks are
+# assembled, and each byte is appended to the frame once, so nothing is ever
+# rescanned or copied a second time however the stream is chunked.
+#
+# Reading blocks, so a live source always runs behind a FrameProducer
+# thread; with the block policy a slow host holds the pipeline back through
+# the pipe instead of frames piling up here
+
+import os
+import socket
+import stat
+import sys
+
+from collections import deque
+from typing import Optional
+
+from facedancer.logging import log
+
+from frame_source import SOI, EOI
+
+
+UNIX_PREFIX = 'unix:'
+STDIN = '-'
+
+CHUNK_SIZE = 256 * 1024
+
+# Larger "frames" mean a lost EOI; the partial frame is dropped and the
+# parser waits for the next SOI
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class JPEGSplitter:
+    """ Splits an MJPEG byte stream, fed in chunks of any size, into JPEG frames """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        # The frame being assembled across chunks, None between frames
+        self._frame: Optional[bytearray] = None
+        self._trailing_ff = False
+        self.discarded = 0
+
+    def feed(self, chunk: bytes) -> list:
+        """ Complete frames ending in `chunk`, as memoryviews or bytearrays """
+        frames = []
+        if not chunk:
+            return frames
+
+        view = memoryview(chunk)
+        find = chunk.find
+        position = 0
+
+        # A marker whose 0xFF ended the previous chunk
+        if self._trailing_ff:
+            if self._frame is None and chunk[0] == SOI[1]:
+                self._frame = bytearray(SOI[:1])
+            elif self._frame is not None and chunk[0] == EOI[1]:
+                self._frame.append(EOI[1])
+                frames.append(self._frame)
+                self._frame = None
+                position = 1
+
+        while True:
+            if self._frame is None:
+                start = find(SOI, position)
+                if start < 0:
+                    break
+                end = find(EOI, start + 2)
+                if end < 0:
+                    self._frame = bytearray(view[start:])
+                    break
+                frames.append(view[start:end + 2])
+                position = end + 2
+            else:
+                end = find(EOI, position)
+                if end < 0:
+                    self._frame += view[position:]
+                    if len(self._frame) > self.max_frame_size:
+                        log.warning(f"No EOI in {len(self._frame)} bytes, dropping the frame")
+                        self.discarded += 1
+                        self._frame = None
+                    break
+                self._frame += view[position:end + 2]
+                frames.append(self._frame)
+                self._frame = None
+                position = end + 2
+
+        self._trailing_ff = chunk[-1] == 0xff
+        return frames
+
+    def reset(self):
+        """ Forget any partial frame, e.g. when the writer goes away """
+        self._frame = None
+        self._trailing_ff = False
+
+
+def is_live_address(address: str) -> bool:
+    """ Whether FAKE_UVC_MJPEG names a stream (stdin, socket, FIFO) rather than a clip """
+    if address == STDIN or address.startswith(UNIX_PREFIX):
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(address).st_mode)
+    except OSError:
+        return False
+
+
+class LiveMJPEGSource:
+    """
+    MJPEG frames read from stdin ('-'), a named pipe, or a UNIX socket
+    ('unix:/path') that writers connect to, one writer at a time
+
+    Calling the source blocks until the next frame arrives; it returns None
+    once stdin is exhausted. A FIFO is reopened and the socket accepts a new
+    writer when the current one goes away
+    """
+
+    def __init__(self, address: str, chunk_size: int = CHUNK_SIZE, max_frame_size: int = MAX_FRAME_SIZE):
+        self.address = address
+        self.chunk_size = chunk_size
+        self.splitter = JPEGSplitter(max_frame_size)
+        self._frames = deque()
+        self._fd = None
+        self._connection = None
+        self._listener = None
+        self._eof = False
+
+        self.frames_received = 0
+        self.bytes_received = 0
+
+        if address.startswith(UNIX_PREFIX):
+            path = address[len(UNIX_PREFIX):]
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(path)
+            self._listener.listen(1)
+            self._socket_path = path
+
+    def __call__(self):
+        while not self._frames:
+            chunk = self._read()
+            if chunk is None:
+                return None
+            self._frames.extend(self.splitter.feed(chunk))
+        self.frames_received += 1
+        return self._frames.popleft()
+
+    def _read(self) -> Optional[bytes]:
+        """ Next chunk of the stream, waiting for a new writer at end of stream; None when done """
+        while not self._eof:
+            if self._listener is not None:
+                if self._connection is None:
+                    self._connection, _ = self._listener.accept()
+                    log.info(f"MJPEG writer connected to {self.address}")
+                chunk = self._connection.recv(self.chunk_size)
+            else:
+                if self._fd is None:
+                    self._fd = sys.stdin.fileno() if self.address == STDIN else os.open(self.address, os.O_RDONLY)
+                    log.info(f"Reading MJPEG from {'stdin' if self.address == STDIN else self.address}")
+                chunk = os.read(self._fd, self.chunk_size)
+
+            if chunk:
+                self.bytes_received += len(chunk)
+                return chunk
+
+            log.info(f"MJPEG writer on {self.address} went away")
+            self.splitter.reset()
+            self._close_stream()
+            if self.address == STDIN:
+                self._eof = True
+        return None
+
+    def _close_stream(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._fd is not None and self.address != STDIN:
+            os.close(self._fd)
+        self._fd = None
+
+    def close(self):
+        self._eof = True
+        self._close_stream()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            try:
+                os.unlink(self._socket_path)
+            except OSError:
+                pass
@@ -0,0 +1,167 @@
+# Device metrics
+#
+# Counters and histograms kept in plain dicts and arrays so recording one is
+# a dict lookup and an add; nothing is formatted until export. Values that
+# other objects already count (PayloadEngine, FramePacer) aren't duplicated:
+# collectors read them when a snapshot is taken, and rates are derived from
+# the change between two snapshots.
+#
+# MetricsWriter rewrites a file every `interval` seconds from a daemon
+# thread, as JSON or as Prometheus text exposition format (by the file's
+# suffix, .prom or .json), atomically so readers never see half a file
+
+import bisect
+import json
+import os
+import threading
+import time
+
+from array import array
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, Tuple
+
+from facedancer.logging import log
+
+
+PREFIX = 'fake_uvc_'
+
+# Handler latency buckets, microseconds: 10us .. ~80ms
+LATENCY_BUCKETS_US = tuple(10 * 2 ** n for n in range(14))
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """ Cumulative-on-export histogram with fixed upper bounds """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # The last slot counts everything above the largest bound (+Inf)
+        self.counts = array('Q', bytes(8 * (len(self.buckets) + 1)))
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ (upper bound, observations <= bound) pairs, ending with +Inf """
+        total = 0
+        for bound, count in zip((*self.buckets, float('inf')), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], int] = defaultdict(int)
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.collectors = []
+
+    def increment(self, name: str, labels: Labels = (), amount: int = 1):
+        self.counters[(name, labels)] += amount
+
+    def histogram(self, name: str, labels: Labels = (), buckets=LATENCY_BUCKETS_US) -> Histogram:
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        return histogram
+
+    def add_collector(self, collector: Callable[[], dict]):
+        """ `collector` returns {name: value} of counters or gauges kept elsewhere, read at export """
+        self.collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        values = {}
+        for collector in self.collectors:
+            values.update(collector())
+        return {
+            'time': time.time(),
+            'values': values,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in list(self.counters.items())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'sum': histogram.sum,
+                            'count': histogram.count,
+                            'buckets': [[bound, count] for bound, count in histogram.cumulative()]}
+                           for (name, labels), histogram in list(self.histograms.items())],
+        }
+
+
+def format_labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def to_prometheus(snapshot: dict) -> str:
+    lines = []
+    for name, value in snapshot['values'].items():
+        lines.append(f"{PREFIX}{name} {value}")
+    for counter in snapshot['counters']:
+        lines.append(f"{PREFIX}{counter['name']}{format_labels(counter['labels'])} {counter['value']}")
+    for histogram in snapshot['histograms']:
+        name = PREFIX + histogram['name']
+        for bound, count in histogram['buckets']:
+            le = '+Inf' if bound == float('inf') else bound
+            lines.append(f"{name}_bucket{format_labels(histogram['labels'], le=le)} {count}")
+        lines.append(f"{name}_sum{format_labels(histogram['labels'])} {histogram['sum']}")
+        lines.append(f"{name}_count{format_labels(histogram['labels'])} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+def to_json(snapshot: dict) -> str:
+    # JSON has no Infinity; the last bucket is "+Inf" like in Prometheus
+    for histogram in snapshot['histograms']:
+        histogram['buckets'][-1][0] = '+Inf'
+    return json.dumps(snapshot, indent=1) + '\n'
+
+
+class MetricsWriter(threading.Thread):
+    """
+    Rewrites `path` with a snapshot of `metrics` every `interval` seconds
+
+    Values named in `rates` (e.g. bytes_sent) also get a <name>_per_second
+    gauge, from the change since the previous snapshot
+    """
+
+    def __init__(self, metrics: Metrics, path, interval: float = 5.0, rates=()):
+        super().__init__(name='metrics-writer', daemon=True)
+        self.metrics = metrics
+        self.path = Path(path)
+        self.interval = interval
+        self.rates = tuple(rates)
+        self.format = to_prometheus if self.path.suffix == '.prom' else to_json
+        self._stop_event = threading.Event()
+        self._previous = None
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self._stop_event.set()
+        self.write()
+
+    def write(self):
+        snapshot = self.metrics.snapshot()
+        values = snapshot['values']
+        if self._previous is not None:
+            elapsed = snapshot['time'] - self._previous['time']
+            for name in self.rates:
+                if name in values and elapsed > 0:
+                    change = values[name] - self._previous['values'].get(name, 0)
+                    values[f"{name}_per_second"] = round(change / elapsed, 1)
+        self._previous = {'time': snapshot['time'], 'values': dict(values)}
+
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        try:
+            tmp.write_text(self.format(snapshot))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning(f"Couldn't write metrics to {self.path}: {e}")
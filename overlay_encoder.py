@@ -0,0 +1,203 @@
+# JPEG overlay encoder
+#
+# OverlayEncoder burns a sequence number and a timestamp into every frame of
+# an MJPEG source, for latency tests: capture the camera on the host, read
+# the stamp, and compare it with the host's clock. Re-encoding a JPEG takes
+# longer than a frame interval at larger sizes, so frames are decoded,
+# stamped and encoded in a pool of worker processes, with `in_flight` frames
+# queued ahead of the one being streamed.
+#
+# The stamp is the wall-clock time the frame is due on the bus at the
+# committed frame rate, not when it was rendered; frames are rendered ahead
+# of time. Each frame's encode time is recorded (encode_histogram, like
+# FramePacer's lateness histogram), and a warning is logged when the pool
+# can't keep up with the frame rate, since the rate the Frame descriptor
+# advertises is then not sustainable.
+#
+# Workers are forked when the encoder is created, before the producer and
+# metrics threads start, and inherit the clip's memory mapping: for a clip,
+# only the frame index crosses the process boundary. Other sources send
+# the frame's bytes.
+#
+# Pillow is optional (pip install fake-uvc[overlay]) and only imported here
+
+import io
+import multiprocessing
+import os
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from facedancer.logging import log
+
+from scheduler import FRAME_INTERVAL_UNIT_NS
+
+
+DEFAULT_QUALITY = 85
+
+# How many encodes the throughput check averages over
+THROUGHPUT_WINDOW = 30
+
+# Set in each worker: the clip the frame indexes refer to, and the font
+_source = None
+_fonts = {}
+
+
+def import_pillow():
+    try:
+        from PIL import Image, ImageDraw, ImageFont
+    except ImportError as e:
+        raise ImportError("overlays need Pillow: pip install fake-uvc[overlay]") from e
+    return Image, ImageDraw, ImageFont
+
+
+def _start_worker(source):
+    global _source
+    _source = source
+    import_pillow()
+
+
+def render_overlay(frame, text: str, quality: int = DEFAULT_QUALITY):
+    """
+    Decode `frame` (JPEG bytes, or an index into the worker's clip), draw
+    `text` in its top left corner and encode it again
+
+    Returns the new JPEG and how long that took, in nanoseconds
+    """
+    start = time.perf_counter_ns()
+    Image, ImageDraw, ImageFont = import_pillow()
+
+    if isinstance(frame, int):
+        frame = _source[frame]
+    image = Image.open(io.BytesIO(frame))
+    image.load()
+
+    size = max(12, image.height // 24)
+    font = _fonts.get(size)
+    if font is None:
+        font = _fonts[size] = ImageFont.load_default(size)
+
+    draw = ImageDraw.Draw(image)
+    margin = size // 3
+    left, top, right, bottom = draw.textbbox((2 * margin, 2 * margin), text, font=font)
+    draw.rectangle((left - margin, top - margin, right + margin, bottom + margin), fill='black')
+    draw.text((2 * margin, 2 * margin), text, fill='white', font=font)
+
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=quality)
+    return out.getvalue(), time.perf_counter_ns() - start
+
+
+def format_stamp(sequence: int, due: float) -> str:
+    seconds = time.strftime('%H:%M:%S', time.localtime(due))
+    return f"#{sequence:06d} {seconds}.{int(due * 1000) % 1000:03d}"
+
+
+class OverlayEncoder:
+    """
+    Frames of `source` with a sequence number and due time burned in,
+    encoded by `workers` processes with up to `in_flight` frames queued
+
+    Calling the encoder never blocks: it returns the oldest finished frame,
+    or None if that frame isn't encoded yet
+    """
+
+    encode_histogram = None
+
+    def __init__(self, source, workers: int = None, in_flight: int = None,
+                 frame_interval: int = 0, quality: int = DEFAULT_QUALITY):
+        import_pillow()
+        self.source = source
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.in_flight = in_flight or 2 * self.workers
+        self.quality = quality
+        self.set_interval(frame_interval)
+
+        # A clip is shared with the workers by index, anything else is sent as bytes
+        self._by_index = hasattr(source, '__getitem__') and hasattr(source, '__len__')
+        self._position = 0
+
+        self._pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context('fork'),
+                                         initializer=_start_worker,
+                                         initargs=(source if self._by_index else None,))
+        # Fork every worker now, while this is the only thread
+        for future in [self._pool.submit(time.sleep, 0) for _ in range(self.workers)]:
+            future.result()
+
+        self._pending = deque()
+        self._due = 0.0
+        self._recent = deque(maxlen=THROUGHPUT_WINDOW)
+        self._warned = False
+
+        self.sequence = 0
+        self.encoded = 0
+        # Frames handed out after the time stamped in them
+        self.late = 0
+        self.failed = 0
+        self.encode_time_ns = 0
+
+    def set_interval(self, frame_interval: int):
+        """ Frame interval in 100ns units, for the due times and the throughput check """
+        self.interval = frame_interval * FRAME_INTERVAL_UNIT_NS / 1e9
+
+    def max_frame_size(self) -> int:
+        # Re-encoding changes the size; leave it to the descriptor
+        return 0
+
+    def __call__(self) -> Optional[bytes]:
+        self._fill()
+        if not self._pending or not self._pending[0][0].done():
+            return None
+
+        future, due = self._pending.popleft()
+        if time.time() > due:
+            self.late += 1
+        self._fill()
+        try:
+            frame, encode_time = future.result()
+        except Exception as e:
+            log.warning(f"Couldn't render overlay: {e}")
+            self.failed += 1
+            return None
+
+        self.encoded += 1
+        self.encode_time_ns += encode_time
+        if self.encode_histogram is not None:
+            self.encode_histogram.observe(encode_time // 1000)
+        self._check_throughput(encode_time)
+        return frame
+
+    def _fill(self):
+        while len(self._pending) < self.in_flight:
+            frame = self._next_frame()
+            if frame is None:
+                return
+            self.sequence += 1
+            # Due one interval after the previous frame, or now if we fell behind
+            self._due = max(time.time(), self._due + self.interval)
+            future = self._pool.submit(render_overlay, frame, format_stamp(self.sequence, self._due), self.quality)
+            self._pending.append((future, self._due))
+
+    def _next_frame(self):
+        if not self._by_index:
+            frame = self.source()
+            return None if frame is None else bytes(frame)
+
+        index = self._position
+        self._position = (index + 1) % len(self.source)
+        return index
+
+    def _check_throughput(self, encode_time: int):
+        self._recent.append(encode_time)
+        if self._warned or not self.interval or len(self._recent) < THROUGHPUT_WINDOW:
+            return
+        mean = sum(self._recent) / len(self._recent) / 1e9
+        if mean / self.workers > self.interval:
+            log.warning(f"Overlay encoding takes {mean * 1e3:.1f} ms a frame on {self.workers} workers, "
+                        f"too slow for {1 / self.interval:.1f} fps")
+            self._warned = True
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,175 @@
+# Test pattern frame source
+#
+# Renders uncompressed YUY2 test patterns (color bars with a scrolling luma
+# ramp, or a full-frame moving gradient) with a frame counter burned in, so
+# uncompressed formats can be streamed without shipping video files.
+#
+# Every frame is drawn with whole-array NumPy operations into one ring of
+# frames, the first time it is served: the ring's memory is only touched as
+# frames are rendered, so nothing is drawn until the format is streamed, and
+# after the first pass streaming serves memoryviews into the ring and does no
+# per-pixel work. The counter runs over the ring, so it wraps every `frames`
+# frames
+#
+# NumPy is optional (pip install fake-uvc[patterns]) and only imported here
+
+from facedancer.logging import log
+
+
+PATTERNS = ('bars', 'gradient')
+DEFAULT_RING_FRAMES = 60
+
+# YUY2 packs two pixels in four bytes: Y0 U Y1 V
+BYTES_PER_PIXEL = 2
+
+# 75% color bars, BT.601 limited range: white, yellow, cyan, green, magenta, red, blue, black
+BARS_Y = (180, 162, 131, 112, 84, 65, 35, 16)
+BARS_U = (128, 44, 156, 72, 184, 100, 212, 128)
+BARS_V = (128, 142, 44, 58, 198, 212, 114, 128)
+
+LUMA_BLACK = 16
+LUMA_WHITE = 235
+CHROMA_ZERO = 128
+
+# 3x5 digit glyphs, one string of rows per digit
+DIGITS = (
+    '111101101101111', '010110010010111', '111001111100111', '111001111001111', '101101111001001',
+    '111100111001111', '111100111101111', '111001001001001', '111101111101111', '111101111001111',
+)
+GLYPH_WIDTH = 3
+GLYPH_HEIGHT = 5
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError("test patterns need NumPy: pip install fake-uvc[patterns]") from e
+    return numpy
+
+
+class PatternSource:
+    """
+    Ring of `frames` YUY2 frames of `width` x `height`, each rendered on first use
+
+    Called like MJPEGFileSource: returns the next frame as a memoryview,
+    looping over the ring forever
+    """
+
+    adjustment = None
+
+    def __init__(self, width: int, height: int, pattern: str = 'bars',
+                 frames: int = DEFAULT_RING_FRAMES):
+        if width % 2:
+            raise ValueError(f"YUY2 needs an even width, not {width}")
+        if pattern not in PATTERNS:
+            raise ValueError(f"Unknown pattern {pattern!r}, expected one of {', '.join(PATTERNS)}")
+
+        np = import_numpy()
+        self.np = np
+        self.width = width
+        self.height = height
+        self.pattern = pattern
+        self.frame_length = width * height * BYTES_PER_PIXEL
+
+        self._font = np.array([[int(bit) for bit in glyph] for glyph in DIGITS],
+                              dtype=bool).reshape(10, GLYPH_HEIGHT, GLYPH_WIDTH)
+        self._ring = np.empty((frames, height, width // 2, 4), dtype=np.uint8)
+        self._rendered = bytearray(frames)
+
+        self._frames = [memoryview(frame).cast('B') for frame in self._ring.reshape(frames, -1)]
+        self._next = 0
+        log.info(f"Streaming {frames} {width}x{height} '{pattern}' frames, rendered as they're first sent")
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def __getitem__(self, index: int) -> memoryview:
+        if not self._rendered[index]:
+            self.render(index, self._ring[index])
+            self._rendered[index] = 1
+        return self._frames[index]
+
+    def __call__(self) -> memoryview:
+        frame = self[self._next]
+        self._next = (self._next + 1) % len(self._frames)
+        if self.adjustment is not None:
+            # Brightness/contrast/gamma from the Processing Unit, see controls.py
+            frame = self.adjustment.apply(frame)
+        return frame
+
+    def frame_size(self, index: int) -> int:
+        return self.frame_length
+
+    def max_frame_size(self) -> int:
+        return self.frame_length
+
+    def close(self):
+        self._frames = []
+        self._ring = None
+
+    #
+    # Rendering, whole planes at a time
+    #
+
+    def render(self, index: int, out):
+        """ Draw frame `index` of the ring into `out`, a (height, width / 2, 4) uint8 array """
+        np = self.np
+        y = np.empty((self.height, self.width), dtype=np.uint8)
+        u = np.empty((self.height, self.width // 2), dtype=np.uint8)
+        v = np.empty_like(u)
+
+        shift = index * self.width // len(self._ring)
+        if self.pattern == 'bars':
+            self.draw_bars(y, u, v)
+            # Scrolling ramp along the bottom sixth, so motion is visible
+            strip = self.height - self.height // 6
+            self.draw_ramp(y[strip:], u[strip:], v[strip:], shift)
+        else:
+            self.draw_ramp(y, u, v, shift)
+            # Chroma sweeps top to bottom
+            u[:] = np.linspace(16, 240, self.height, dtype=np.uint8)[:, None]
+
+        self.draw_counter(y, u, v, index)
+
+        out[..., 0] = y[:, 0::2]
+        out[..., 1] = u
+        out[..., 2] = y[:, 1::2]
+        out[..., 3] = v
+
+    def draw_bars(self, y, u, v):
+        np = self.np
+        bars = np.arange(self.width) * len(BARS_Y) // self.width
+        y[:] = np.array(BARS_Y, dtype=np.uint8)[bars]
+        u[:] = np.array(BARS_U, dtype=np.uint8)[bars[0::2]]
+        v[:] = np.array(BARS_V, dtype=np.uint8)[bars[0::2]]
+
+    def draw_ramp(self, y, u, v, shift: int):
+        np = self.np
+        ramp = LUMA_BLACK + np.arange(self.width) * (LUMA_WHITE - LUMA_BLACK) // (self.width - 1)
+        y[:] = np.roll(ramp.astype(np.uint8), shift)
+        u[:] = CHROMA_ZERO
+        v[:] = CHROMA_ZERO
+
+    def draw_counter(self, y, u, v, index: int):
+        """ Burn `index` into the top left corner as white digits on black """
+        np = self.np
+        digits = len(str(len(self._ring) - 1))
+        glyphs = self._font[[int(digit) for digit in f"{index:0{digits}d}"]]
+
+        # One blank column after each digit, then scale every dot up
+        glyphs = np.pad(glyphs, ((0, 0), (0, 0), (0, 1)))
+        text = glyphs.transpose(1, 0, 2).reshape(GLYPH_HEIGHT, -1)
+        scale = max(1, self.height // 60)
+        text = text.repeat(scale, axis=0).repeat(scale, axis=1)
+
+        margin = scale * 2
+        height, width = text.shape
+        width += width % 2
+        if margin + height > self.height or margin + width > self.width:
+            return
+
+        box = y[margin:margin + height, margin:margin + text.shape[1]]
+        box[:] = np.where(text, LUMA_WHITE, LUMA_BLACK)
+        u[margin:margin + height, margin // 2:(margin + width) // 2] = CHROMA_ZERO
+        v[margin:margin + height, margin // 2:(margin + width) // 2] = CHROMA_ZERO
@@ -0,0 +1,218 @@
+# UVC payload generation
+#
+# Slices video frames into isochronous/bulk payloads, each prefixed with a
+# UVC payload header (UVC 1.5, 2.4.3.3 Video and Still Image Payload Headers)
+#
+# Every payload is assembled in a single preallocated buffer; frame data is
+# copied in from a memoryview of the source frame so no per-packet bytes
+# objects are created. The returned memoryview aliases that buffer, so it is
+# only valid until the next call to next_payload()
+#
+# Within a frame the payload headers only differ in EOF and SCR, so
+# bmHeaderInfo (FID, and EOF for the last payload) and the PTS are planned
+# once when the frame starts, and each payload header is then written with
+# a single pack_into(). Where the last payload starts follows from the frame
+# length, so a resize() mid-frame needs no replanning
+#
+# A still image (2.4.2.4, method 2) goes out on the same pipe as the video,
+# in place of the next video frame, with STI set in its payload headers;
+# see still.py
+
+import struct
+import time
+
+from typing import Callable, Optional
+
+import uvc
+
+
+FID = int(uvc.UVCPayloadHeader.FID)
+EOF = int(uvc.UVCPayloadHeader.EOF)
+PTS = int(uvc.UVCPayloadHeader.PTS)
+SCR = int(uvc.UVCPayloadHeader.SCR)
+STI = int(uvc.UVCPayloadHeader.STI)
+EOH = int(uvc.UVCPayloadHeader.EOH)
+
+
+def header_packer(pts: bool, scr: bool):
+    """
+    pack_into(buffer, offset, length, info, pts, stc, sof) for a payload header
+    with or without the PTS and SCR fields
+    """
+    if pts and scr:
+        return struct.Struct('<BBIIH').pack_into
+
+    pack_into = struct.Struct('<BB' + ('I' if pts else '') + ('IH' if scr else '')).pack_into
+
+    def pack(buffer, offset, length, info, presentation_time, stc, sof):
+        fields = (length, info) + ((presentation_time,) if pts else ()) + ((stc, sof) if scr else ())
+        pack_into(buffer, offset, *fields)
+    return pack
+
+
+class PayloadEngine:
+    """
+    Turns frames from `frame_source` into UVC payloads of at most `max_payload_size` bytes
+
+    frame_source is called whenever a new frame is needed and returns a bytes-like
+    object (bytes, bytearray, mmap slice, memoryview) or None if no frame is ready
+
+    With a `pacer` (scheduler.FramePacer) frames are only pulled when due, and
+    payloads are spread over the frame interval instead of sent on every poll
+    """
+
+    def __init__(self, max_payload_size: int, frame_source: Callable[[], Optional[bytes]],
+                 clock_frequency: int = 30000000, pts: bool = True, scr: bool = True,
+                 pacer=None):
+        self.frame_source = frame_source
+        self.pacer = pacer
+        self.clock_frequency = clock_frequency
+
+        self.header_length = 2 + (4 if pts else 0) + (6 if scr else 0)
+        self._flags = EOH | (PTS if pts else 0) | (SCR if scr else 0)
+        self._pack_header = header_packer(pts, scr)
+        self._scr_enabled = scr
+
+        self._frame = None
+        self._frame_length = 0
+        self._offset = 0
+        self._fid = 0
+        self._pts = 0
+        self._info = 0
+        self._last_info = 0
+        # Still image to send in place of the next video frame: a cached still,
+        # or None to send the next video frame as the still
+        self._still = None
+        self._still_pending = False
+        # Called once a still image has been sent
+        self.on_still_sent = None
+        # Called with each frame from the source as it starts being sent
+        self.on_frame_started = None
+
+        # Counters, read by metrics.py
+        self.frames_started = 0
+        self.frames_sent = 0
+        self.frames_abandoned = 0
+        self.stills_sent = 0
+        self.payloads_sent = 0
+        self.bytes_sent = 0
+        # A frame was due but the source had none ready, counted once per frame slot
+        self.underruns = 0
+        self._starved = False
+
+        self.resize(max_payload_size)
+
+    def resize(self, max_payload_size: int):
+        """ Reallocate the payload buffer, e.g. after the host picks a different alternate setting """
+        if max_payload_size <= self.header_length:
+            raise ValueError(f"max_payload_size {max_payload_size} leaves no room for payload data")
+
+        self.max_payload_size = max_payload_size
+        self.buffer = bytearray(max_payload_size)
+        self._view = memoryview(self.buffer)
+        self._data_view = self._view[self.header_length:]
+        self._chunk = max_payload_size - self.header_length
+
+    def source_clock(self) -> int:
+        """ Current source time clock value, in dwClockFrequency units """
+        return (time.monotonic_ns() * self.clock_frequency // 1000000000) & 0xffffffff
+
+    def start_frame(self, frame, still: bool = False):
+        """ Begin sending `frame`, as a still image if `still`; any frame in progress is abandoned """
+        if self._frame is not None:
+            self.frames_abandoned += 1
+        if self.on_frame_started is not None:
+            self.on_frame_started(frame)
+        self.frames_started += 1
+        self._frame = memoryview(frame).cast('B')
+        self._frame_length = len(self._frame)
+        self._offset = 0
+        self._fid ^= FID
+        self._pts = self.source_clock()
+        self._info = self._flags | self._fid | (STI if still else 0)
+        self._last_info = self._info | EOF
+
+    def stop(self):
+        """ Abandon the frame in progress; the next payload starts a new frame """
+        if self._frame is not None:
+            self.frames_abandoned += 1
+            if self._info & STI:
+                # Send the still again once streaming resumes
+                self._still_pending = True
+        self._frame = None
+
+    def inject_still(self, still=None):
+        """
+        Send `still` (a cached still image) in place of the next video frame,
+        or with None, the next video frame marked as a still image
+        """
+        self._still = still
+        self._still_pending = True
+
+    def next_payload(self) -> Optional[memoryview]:
+        """
+        Build the next payload, pulling a new frame from the source if needed
+
+        Returns None when the source has nothing to send
+        """
+        pacer = self.pacer
+        if self._frame is None:
+            if pacer is not None and not pacer.frame_due():
+                return None
+            still = self._still_pending
+            if still and self._still is not None:
+                frame = self._still
+            else:
+                frame = self.frame_source()
+            if frame is None:
+                # The deadline stays where it is, so the frame goes out as soon as it's ready
+                if not self._starved:
+                    self._starved = True
+                    self.underruns += 1
+                return None
+            if pacer is not None:
+                pacer.release()
+            self._starved = False
+            self.start_frame(frame, still)
+            self._still_pending = False
+        elif pacer is not None and not pacer.payload_due(self._offset, self._frame_length):
+            return None
+
+        buffer = self.buffer
+        header_length = self.header_length
+        start = self._offset
+        end = start + self._chunk
+        last = end >= self._frame_length
+        if last:
+            end = self._frame_length
+
+        if self._scr_enabled:
+            now = time.monotonic_ns()
+            stc = (now * self.clock_frequency // 1000000000) & 0xffffffff
+            sof = (now // 1000000) & 0x7ff
+        else:
+            stc = sof = 0
+        self._pack_header(buffer, 0, header_length, self._last_info if last else self._info,
+                          self._pts, stc, sof)
+
+        length = end - start
+        self._data_view[:length] = self._frame[start:end]
+        self._offset = end
+        self.payloads_sent += 1
+        self.bytes_sent += header_length + length
+
+        if last:
+            self._frame = None
+            self.frames_sent += 1
+            if self._info & STI:
+                self._still_sent()
+
+        if length == self._chunk:
+            return self._view
+        return self._view[:header_length + length]
+
+    def _still_sent(self):
+        self._still = None
+        self.stills_sent += 1
+        if self.on_still_sent is not None:
+            self.on_still_sent()
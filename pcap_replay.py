@@ -0,0 +1,281 @@
+# Control request replay from usbmon captures
+#
+# Parses the pcap/pcapng captures of a real camera (Linux usbmon, link types
+# 189 and 220) once, pairs each control submission with its completion and
+# indexes the results by setup packet:
+#
+#   (bmRequestType, bRequest, wValue, wIndex, wLength) -> response bytes
+#
+# IN requests replay the captured data, OUT requests are acknowledged, and
+# requests the real device stalled are stalled. A second index without
+# wLength answers hosts that ask for a different length, with the longest
+# captured response truncated to wLength. Both lookups are one dict probe.
+#
+# The compiled table is cached next to the descriptor cache, keyed by each
+# capture's path, size and mtime, so later launches skip the pcap parsing
+#
+#   python pcap_replay.py webcam_real_connect.pcap ...   dumps the table
+
+import hashlib
+import os
+import struct
+import sys
+
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+
+from facedancer.logging import log
+
+from descriptors import CACHE_DIR
+
+
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+# pcap global header and record header, little endian
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAP_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD = struct.Struct('<IIII')
+
+# pcapng block types
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+# usbmon packet header (Documentation/usb/usbmon.rst): id, type, transfer type,
+# endpoint, device, bus, setup flag, data flag, ts sec, ts usec, status,
+# urb length, captured length, setup packet
+USBMON_HEADER = struct.Struct('<QBBBBHbbqiiII8s')
+USBMON_HEADER_LENGTH = {LINKTYPE_USB_LINUX: 48, LINKTYPE_USB_LINUX_MMAPPED: 64}
+USBMON_SUBMIT = ord('S')
+USBMON_COMPLETE = ord('C')
+USBMON_CONTROL = 2
+
+SETUP = struct.Struct('<BBHHH')
+
+# -EPIPE, the endpoint stalled
+STATUS_STALL = -32
+
+# Cache record: setup packet, stalled, response length, then the response
+CACHE_MAGIC = b'UVCRPL01'
+CACHE_RECORD = struct.Struct('<8sBI')
+
+DEVICE_DESCRIPTOR_REQUEST = (0x80, 0x06, 0x0100)
+
+
+def read_packets(path) -> Iterable[tuple]:
+    """ Yields (link type, packet bytes) for every packet of a pcap or pcapng file """
+    data = Path(path).read_bytes()
+    magic, = struct.unpack_from('<I', data)
+
+    if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+        _, _, _, _, _, _, link_type = PCAP_HEADER.unpack_from(data)
+        offset = PCAP_HEADER.size
+        while offset + PCAP_RECORD.size <= len(data):
+            _, _, captured, _ = PCAP_RECORD.unpack_from(data, offset)
+            offset += PCAP_RECORD.size
+            yield link_type, data[offset:offset + captured]
+            offset += captured
+
+    elif magic == PCAPNG_SECTION_HEADER:
+        link_types = []
+        offset = 0
+        while offset + 12 <= len(data):
+            block_type, block_length = struct.unpack_from('<II', data, offset)
+            body = offset + 8
+            if block_type == PCAPNG_SECTION_HEADER:
+                byte_order, = struct.unpack_from('<I', data, body)
+                if byte_order != PCAPNG_BYTE_ORDER_MAGIC:
+                    raise ValueError(f"{path}: big endian pcapng isn't supported")
+                link_types = []
+            elif block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                link_types.append(struct.unpack_from('<H', data, body)[0])
+            elif block_type == PCAPNG_ENHANCED_PACKET:
+                interface, _, _, captured, _ = struct.unpack_from('<IIIII', data, body)
+                yield link_types[interface], data[body + 20:body + 20 + captured]
+            offset += block_length
+
+    else:
+        raise ValueError(f"{path} is not a pcap or pcapng capture")
+
+
+class ControlTransfer(NamedTuple):
+    device: int
+    setup: bytes
+    status: int
+    response: bytes
+    # usbmon timestamps of the submission and completion, in seconds
+    submitted: float
+    completed: float
+
+
+def control_transfers(path) -> Iterable[ControlTransfer]:
+    """ Yields every completed control transfer in a capture, in completion order """
+    pending = {}
+    for link_type, packet in read_packets(path):
+        header_length = USBMON_HEADER_LENGTH.get(link_type)
+        if header_length is None or len(packet) < header_length:
+            continue
+
+        (urb, event, transfer_type, _, device, _, setup_flag, _, seconds, microseconds, status,
+         _, _, setup) = USBMON_HEADER.unpack_from(packet)
+        if transfer_type != USBMON_CONTROL:
+            continue
+
+        # A setup flag of 0 means the setup packet was captured
+        timestamp = seconds + microseconds / 1e6
+        if event == USBMON_SUBMIT and setup_flag == 0:
+            pending[urb] = (setup, timestamp)
+        elif event == USBMON_COMPLETE and urb in pending:
+            setup, submitted = pending.pop(urb)
+            yield ControlTransfer(device, setup, status, packet[header_length:], submitted, timestamp)
+
+
+def matching_devices(transfers, vendor_id: int, product_id: int) -> set:
+    """ Addresses whose device descriptor in `transfers` has this VID:PID """
+    return {transfer.device for transfer in transfers
+            if SETUP.unpack(transfer.setup)[:3] == DEVICE_DESCRIPTOR_REQUEST
+            and len(transfer.response) >= 12
+            and struct.unpack_from('<HH', transfer.response, 8) == (vendor_id, product_id)}
+
+
+class ReplayTable:
+    """ Captured control responses, indexed by setup packet """
+
+    def __init__(self):
+        # setup bytes -> response, or None for a stall
+        self.exact = {}
+        # setup bytes without wLength -> longest response
+        self.any_length = {}
+
+    def __len__(self) -> int:
+        return len(self.exact)
+
+    def add(self, setup: bytes, response: Optional[bytes]):
+        # The first capture of a request wins, like the first enumeration
+        self.exact.setdefault(setup, response)
+        # Any other length: prefer an answer over a stall, then the longest answer
+        key = setup[:6]
+        if key not in self.any_length:
+            self.any_length[key] = response
+        elif response is not None:
+            known = self.any_length[key]
+            if known is None or len(response) > len(known):
+                self.any_length[key] = response
+
+    def lookup(self, setup: bytes):
+        """ Returns (found, response); a response of None means stall """
+        if setup in self.exact:
+            return True, self.exact[setup]
+        key = setup[:6]
+        if key in self.any_length:
+            response = self.any_length[key]
+            if response is None:
+                return True, None
+            length = SETUP.unpack(setup)[4]
+            return True, response[:length]
+        return False, None
+
+    def reply(self, request) -> bool:
+        """ Answer a facedancer USBControlRequest from the table; False if it isn't in it """
+        setup = SETUP.pack(request.request_type, request.number, request.value,
+                           request.index, request.length)
+        found, response = self.lookup(setup)
+        if not found:
+            return False
+
+        if response is None:
+            request.stall()
+        elif request.request_type & 0x80:
+            request.reply(response)
+        else:
+            request.ack()
+        log.debug("Replayed request %s: %s", setup.hex(),
+                  'stall' if response is None else f"{len(response)} bytes")
+        return True
+
+    @classmethod
+    def from_captures(cls, paths, vendor_id: int = None, product_id: int = None):
+        """
+        Build the table from captures, keeping only the device matching
+        vendor_id/product_id when given (captures hold the whole bus)
+        """
+        table = cls()
+        for path in paths:
+            transfers = list(control_transfers(path))
+            devices = None
+            if vendor_id is not None:
+                devices = matching_devices(transfers, vendor_id, product_id)
+
+            for transfer in transfers:
+                if devices is not None and transfer.device not in devices:
+                    continue
+                if transfer.status == STATUS_STALL:
+                    table.add(transfer.setup, None)
+                elif transfer.status == 0:
+                    table.add(transfer.setup, transfer.response if transfer.setup[0] & 0x80 else b'')
+        return table
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(CACHE_MAGIC)
+            for setup, response in self.exact.items():
+                f.write(CACHE_RECORD.pack(setup, response is None, len(response or b'')))
+                f.write(response or b'')
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path):
+        data = Path(path).read_bytes()
+        if data[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+            raise ValueError(f"{path} is not a replay table")
+
+        table = cls()
+        offset = len(CACHE_MAGIC)
+        while offset < len(data):
+            setup, stalled, length = CACHE_RECORD.unpack_from(data, offset)
+            offset += CACHE_RECORD.size
+            response = data[offset:offset + length]
+            if len(response) != length:
+                raise ValueError(f"{path} is truncated")
+            offset += length
+            table.add(setup, None if stalled else response)
+        return table
+
+
+def cache_path(paths, vendor_id, product_id, cache_dir: Path = CACHE_DIR) -> Path:
+    digest = hashlib.sha256(repr((vendor_id, product_id)).encode())
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return Path(cache_dir) / f"replay-{digest.hexdigest()}.bin"
+
+
+def load_replay_table(paths, vendor_id: int = None, product_id: int = None,
+                      cache_dir: Path = CACHE_DIR) -> ReplayTable:
+    """ Replay table for `paths`, from the cache when the captures haven't changed """
+    path = cache_path(paths, vendor_id, product_id, cache_dir)
+    try:
+        return ReplayTable.load(path)
+    except (OSError, ValueError, struct.error):
+        pass
+
+    table = ReplayTable.from_captures(paths, vendor_id, product_id)
+    try:
+        table.save(path)
+    except OSError as e:
+        log.warning(f"Couldn't cache replay table in {path}: {e}")
+    return table
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"usage: {sys.argv[0]} capture.pcap [capture.pcap ...]", file=sys.stderr)
+        sys.exit(1)
+
+    for setup, response in sorted(ReplayTable.from_captures(sys.argv[1:]).exact.items()):
+        print(setup.hex(), 'stall' if response is None else response.hex())
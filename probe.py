@@ -0,0 +1,263 @@
+# Video Probe and Commit Controls (UVC 1.5, 4.3.1.1)
+#
+# The host proposes a format, frame and frame interval with SET_CUR(PROBE),
+# reads back what the device can actually do with GET_CUR(PROBE), and locks
+# it in with SET_CUR(COMMIT). Every value the host sends is clamped against
+# the advertised formats/frames; dwMaxVideoFrameSize comes from the frame
+# source and dwMaxPayloadTransferSize from the bandwidth the stream needs,
+# which is what the host uses to pick an alternate setting
+
+import math
+import struct
+
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from facedancer.logging import log
+
+import uvc
+from dispatch import ANY
+from scheduler import FRAME_INTERVAL_UNIT_NS, SERVICE_INTERVAL_HS_NS
+
+
+# Length of the control for each bcdUVC
+PROBE_LENGTH_UVC10 = 26
+PROBE_LENGTH_UVC11 = 34
+PROBE_LENGTH_UVC15 = 48
+
+
+def probe_length(bcd_uvc: float) -> int:
+    """ Length of the probe/commit control a host expects from a device of this bcdUVC """
+    if bcd_uvc >= 1.5:
+        return PROBE_LENGTH_UVC15
+    if bcd_uvc >= 1.1:
+        return PROBE_LENGTH_UVC11
+    return PROBE_LENGTH_UVC10
+
+PROBE_FIELDS_UVC10 = ('bmHint', 'bFormatIndex', 'bFrameIndex', 'dwFrameInterval', 'wKeyFrameRate',
+                      'wPFrameRate', 'wCompQuality', 'wCompWindowSize', 'wDelay',
+                      'dwMaxVideoFrameSize', 'dwMaxPayloadTransferSize')
+PROBE_FIELDS_UVC11 = PROBE_FIELDS_UVC10 + ('dwClockFrequency', 'bmFramingInfo', 'bPreferedVersion',
+                                           'bMinVersion', 'bMaxVersion')
+PROBE_FIELDS_UVC15 = PROBE_FIELDS_UVC11 + ('bUsage', 'bBitDepthLuma', 'bmSettings',
+                                           'bMaxNumberOfRefFramesPlus1', 'bmRateControlModes',
+                                           'bmLayoutPerStream')
+
+PROBE_FORMATS = {
+    PROBE_LENGTH_UVC10: (struct.Struct('<HBBIHHHHHII'), PROBE_FIELDS_UVC10),
+    PROBE_LENGTH_UVC11: (struct.Struct('<HBBIHHHHHIIIBBBB'), PROBE_FIELDS_UVC11),
+    PROBE_LENGTH_UVC15: (struct.Struct('<HBBIHHHHHIIIBBBBBBBBHQ'), PROBE_FIELDS_UVC15),
+}
+
+# GET_INFO: supports GET and SET
+INFO_GET_SET = b'\x03'
+
+
+@dataclass
+class FrameSetting:
+    """ One frame descriptor, as the probe negotiation needs it """
+    format_index: int
+    frame_index: int
+    width: int
+    height: int
+    max_frame_size: int
+    default_interval: int
+    min_interval: int
+    max_interval: int
+    interval_step: int = 0
+    # Discrete intervals (bFrameIntervalType > 0); empty for a continuous range
+    intervals: List[int] = field(default_factory=list)
+
+    @classmethod
+    def from_descriptor_fields(cls, format_index: int, fields: dict):
+        """ Build from the fields of a VS frame descriptor definition (see descriptors.py) """
+        intervals = list(fields.get('dwFrameInterval', []))
+        return cls(
+            format_index=format_index,
+            frame_index=fields['bFrameIndex'],
+            width=fields['wWidth'],
+            height=fields['wHeight'],
+            max_frame_size=fields.get('dwMaxVideoFrameBufSize', 0),
+            default_interval=fields['dwDefaultFrameInterval'],
+            min_interval=fields.get('dwMinFrameInterval', min(intervals, default=0)),
+            max_interval=fields.get('dwMaxFrameInterval', max(intervals, default=0)),
+            interval_step=fields.get('dwFrameIntervalStep', 0),
+            intervals=intervals,
+        )
+
+    def clamp_interval(self, interval: int) -> int:
+        if interval == 0:
+            return self.default_interval
+        if self.intervals:
+            return min(self.intervals, key=lambda candidate: abs(candidate - interval))
+        interval = max(self.min_interval, min(self.max_interval, interval))
+        if self.interval_step:
+            steps = round((interval - self.min_interval) / self.interval_step)
+            interval = min(self.min_interval + steps * self.interval_step, self.max_interval)
+        return interval
+
+
+def pack_probe(values: dict, length: int) -> bytes:
+    probe_struct, names = PROBE_FORMATS[length]
+    return probe_struct.pack(*(values.get(name, 0) for name in names))
+
+
+def unpack_probe(data: bytes, length: int) -> dict:
+    probe_struct, names = PROBE_FORMATS[length]
+    # Hosts may send a shorter (older) structure; missing fields read as zero
+    data = bytes(data[:length]).ljust(length, b'\x00')
+    return dict(zip(names, probe_struct.unpack(data)))
+
+
+class ProbeCommit:
+    """
+    VS_PROBE_CONTROL/VS_COMMIT_CONTROL state for one VideoStreaming interface
+
+    frames            : every FrameSetting advertised on the interface; the first
+                        one of each format is its default
+    payload_capacities: bytes per service interval of each streaming alternate
+    max_frame_size    : optional callable giving the largest frame the source of a
+                        FrameSetting will produce, overriding the descriptor's
+                        dwMaxVideoFrameBufSize when it returns non-zero
+    on_commit         : called with the committed values after SET_CUR(COMMIT)
+    """
+
+    def __init__(self, frames: List[FrameSetting], payload_capacities: List[int], *,
+                 length: int = PROBE_LENGTH_UVC10, clock_frequency: int = 30000000,
+                 header_length: int = 12, service_interval_ns: int = SERVICE_INTERVAL_HS_NS,
+                 max_frame_size: Optional[Callable[[FrameSetting], int]] = None,
+                 on_commit: Optional[Callable[[dict], None]] = None):
+        self.frames = {(f.format_index, f.frame_index): f for f in frames}
+        self.default_frames = {}
+        for f in frames:
+            self.default_frames.setdefault(f.format_index, f)
+        self.default_format = frames[0].format_index
+
+        self.payload_capacities = sorted(payload_capacities)
+        self.length = length
+        self.clock_frequency = clock_frequency
+        self.header_length = header_length
+        self.service_interval_ns = service_interval_ns
+        self.max_frame_size = max_frame_size
+        self.on_commit = on_commit
+
+        self.default = self.negotiate({})
+        self.probe = dict(self.default)
+        self.commit = dict(self.default)
+
+    def frame_for(self, values: dict) -> FrameSetting:
+        format_index = values.get('bFormatIndex', 0)
+        if format_index not in self.default_frames:
+            format_index = self.default_format
+        frame = self.frames.get((format_index, values.get('bFrameIndex', 0)))
+        return frame or self.default_frames[format_index]
+
+    def frame_size(self, frame: FrameSetting) -> int:
+        if self.max_frame_size is not None:
+            size = self.max_frame_size(frame)
+            if size:
+                return size
+        return frame.max_frame_size
+
+    def payload_transfer_size(self, frame_size: int, interval: int) -> int:
+        """
+        Bytes per service interval to send `frame_size` every `interval` (100ns units)
+
+        Rounded up to the smallest payload capacity (alternate setting) that
+        sustains the stream, so the host picks exactly that alternate
+        """
+        service_intervals = max(1, interval * FRAME_INTERVAL_UNIT_NS // self.service_interval_ns)
+        for capacity in self.payload_capacities:
+            # Each payload carries a header
+            payloads = math.ceil(frame_size / (capacity - self.header_length))
+            needed = math.ceil((frame_size + payloads * self.header_length) / service_intervals)
+            if needed <= capacity:
+                return capacity
+        return self.payload_capacities[-1]
+
+    def negotiate(self, requested: dict) -> dict:
+        """ Clamp a probe from the host to something this device can stream """
+        frame = self.frame_for(requested)
+        interval = frame.clamp_interval(requested.get('dwFrameInterval', 0))
+        frame_size = self.frame_size(frame)
+
+        values = dict(requested)
+        values.update({
+            'bmHint': requested.get('bmHint', 0) & 0x1f,
+            'bFormatIndex': frame.format_index,
+            'bFrameIndex': frame.frame_index,
+            'dwFrameInterval': interval,
+            # No key frames or compression windows for frame-based formats like MJPEG
+            'wKeyFrameRate': 0,
+            'wPFrameRate': 0,
+            'wCompQuality': requested.get('wCompQuality', 0) or 61,
+            'wCompWindowSize': 0,
+            'wDelay': 0,
+            'dwMaxVideoFrameSize': frame_size,
+            'dwMaxPayloadTransferSize': self.payload_transfer_size(frame_size, interval),
+        })
+        if self.length >= PROBE_LENGTH_UVC11:
+            values.update({
+                'dwClockFrequency': self.clock_frequency,
+                # FID may toggle and EOF is set on the last payload of every frame
+                'bmFramingInfo': 0x03,
+                'bPreferedVersion': 1,
+                'bMinVersion': 1,
+                'bMaxVersion': 1,
+            })
+        return values
+
+    def limit(self, which: str) -> dict:
+        """ GET_MIN/GET_MAX: the default format/frame at its fastest/slowest interval """
+        frame = self.frame_for(self.probe)
+        interval = frame.min_interval if which == 'min' else frame.max_interval
+        return self.negotiate({**self.probe, 'dwFrameInterval': interval})
+
+    #
+    # Request handlers, registered in a RequestDispatcher by register()
+    #
+
+    def handle_set_probe(self, request):
+        self.probe = self.negotiate(unpack_probe(request.data, self.length))
+        request.ack()
+
+    def handle_set_commit(self, request):
+        values = self.negotiate(unpack_probe(request.data, self.length))
+        self.commit = values
+        self.probe = dict(values)
+        log.info(f"Committed format {values['bFormatIndex']} frame {values['bFrameIndex']} "
+                 f"interval {values['dwFrameInterval']} payload {values['dwMaxPayloadTransferSize']}")
+        if self.on_commit is not None:
+            self.on_commit(values)
+        request.ack()
+
+    def _reply(self, request, values: dict):
+        request.reply(pack_probe(values, self.length)[:request.length])
+
+    def register(self, dispatcher, interface: int, alternates):
+        """ Add PROBE/COMMIT handlers for `interface` to `dispatcher`, for each alternate setting """
+        UVC = uvc.UVC
+        length = self.length.to_bytes(2, 'little')
+        for alternate in alternates:
+            for selector in (UVC.VS_PROBE_CONTROL, UVC.VS_COMMIT_CONTROL):
+                dispatcher.add(interface, alternate, UVC.GET_INFO, selector, ANY, INFO_GET_SET)
+                dispatcher.add(interface, alternate, UVC.GET_LEN, selector, ANY, length)
+
+            probe = UVC.VS_PROBE_CONTROL
+            dispatcher.add(interface, alternate, UVC.SET_CUR, probe, ANY, self.handle_set_probe)
+            dispatcher.add(interface, alternate, UVC.GET_CUR, probe, ANY,
+                           lambda request: self._reply(request, self.probe))
+            dispatcher.add(interface, alternate, UVC.GET_DEF, probe, ANY,
+                           lambda request: self._reply(request, self.default))
+            dispatcher.add(interface, alternate, UVC.GET_MIN, probe, ANY,
+                           lambda request: self._reply(request, self.limit('min')))
+            dispatcher.add(interface, alternate, UVC.GET_MAX, probe, ANY,
+                           lambda request: self._reply(request, self.limit('max')))
+            # RES: one step of each field
+            dispatcher.add(interface, alternate, UVC.GET_RES, probe, ANY,
+                           lambda request: self._reply(request, {'dwFrameInterval': 1}))
+
+            commit = UVC.VS_COMMIT_CONTROL
+            dispatcher.add(interface, alternate, UVC.SET_CUR, commit, ANY, self.handle_set_commit)
+            dispatcher.add(interface, alternate, UVC.GET_CUR, commit, ANY,
+                           lambda request: self._reply(request, self.commit))
@@ -0,0 +1,204 @@
+# Threaded frame production
+#
+# FrameProducer runs a frame source (file reads, pattern generation,
+# encoding) on its own thread and hands frames to the USB service loop
+# through a bounded ring, so a slow source can't stall control requests or
+# the video endpoint. The consumer side never blocks: it's called from
+# handle_data_requested() through the PayloadEngine, like any frame source.
+#
+# What happens when the two sides don't keep up with each other is the
+# policy:
+#
+#   block        - the producer waits for a free slot; an empty ring is an
+#                  underrun and the consumer gets None
+#   drop-oldest  - the producer runs at the frame rate and never waits, the
+#                  oldest queued frame makes room; freshest frames win
+#   repeat-last  - like block, but an empty ring repeats the last frame
+#                  instead of starving the host
+
+import threading
+import time
+
+from collections import deque
+from typing import Callable, Optional
+
+from facedancer.logging import log
+
+from scheduler import FRAME_INTERVAL_UNIT_NS
+
+
+POLICIES = ('block', 'drop-oldest', 'repeat-last')
+DEFAULT_DEPTH = 4
+
+# How long the producer sleeps when its source has nothing, seconds
+IDLE_WAIT = 0.001
+
+
+class FrameProducer:
+    """ Frames from `source`, produced on a thread into a ring of `depth` frames """
+
+    def __init__(self, source: Callable[[], Optional[bytes]], depth: int = DEFAULT_DEPTH,
+                 policy: str = 'block', frame_interval: int = 0, name: str = 'frame-producer'):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, expected one of {', '.join(POLICIES)}")
+
+        self.source = source
+        self.policy = policy
+        self.depth = depth
+        self._ring = deque(maxlen=depth)
+        self._space = threading.Condition()
+        self._running = threading.Event()
+        self._stopping = False
+        self._last = None
+        # Bumped by flush(); a frame the source returns across a flush is dropped
+        self._generation = 0
+        # Called on the producer thread before the source is next asked for a frame
+        self._before_next: Optional[Callable[[], None]] = None
+        self.set_interval(frame_interval)
+        # Called from the producer thread with the exception when the source fails
+        self.on_error: Optional[Callable[[Exception], None]] = None
+
+        self.produced = 0
+        self.dropped = 0
+        self.repeated = 0
+        self.underruns = 0
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def set_interval(self, frame_interval: int):
+        """ Frame interval in 100ns units; paces drop-oldest, which never waits for the consumer """
+        self.interval_ns = frame_interval * FRAME_INTERVAL_UNIT_NS
+        self._deadline = None
+        # Sources that stamp or pace frames themselves follow the committed rate too
+        set_interval = getattr(self.source, 'set_interval', None)
+        if set_interval:
+            set_interval(frame_interval)
+
+    #
+    # Consumer side, called from the USB service loop
+    #
+
+    def __call__(self):
+        try:
+            frame = self._ring.popleft()
+        except IndexError:
+            if self.policy == 'repeat-last' and self._last is not None:
+                self.repeated += 1
+                return self._last
+            self.underruns += 1
+            return None
+
+        if self.policy != 'drop-oldest':
+            with self._space:
+                self._space.notify()
+        self._last = frame
+        return frame
+
+    def max_frame_size(self) -> int:
+        max_frame_size = getattr(self.source, 'max_frame_size', None)
+        return max_frame_size() if max_frame_size else 0
+
+    def resume(self):
+        """ Start (or restart) producing """
+        self._deadline = None
+        self._running.set()
+
+    def pause(self):
+        """ Stop producing and forget queued frames, e.g. when another format is committed """
+        self._running.clear()
+        self.flush()
+
+    def flush(self, then: Optional[Callable[[], None]] = None):
+        """
+        Forget queued frames, and the one being produced, e.g. when the source
+        must skip ahead to a key frame. `then` is called on the producer
+        thread before the source is next asked for a frame, so it can't race
+        a frame the source is already working on
+        """
+        with self._space:
+            self._generation += 1
+            if then is not None:
+                self._before_next = then
+            self._ring.clear()
+            self._last = None
+            self._space.notify()
+
+    @property
+    def flush_pending(self) -> bool:
+        """ A flush()'s `then` hasn't run yet """
+        return self._before_next is not None
+
+    def close(self):
+        self._stopping = True
+        self._running.set()
+        with self._space:
+            self._space.notify()
+        self._thread.join()
+
+    #
+    # Producer thread
+    #
+
+    def _wait_for_space(self) -> bool:
+        with self._space:
+            while len(self._ring) >= self.depth:
+                if self._stopping or not self._running.is_set():
+                    return False
+                self._space.wait()
+        return True
+
+    def _wait_for_deadline(self):
+        if not self.interval_ns:
+            return
+        now = time.monotonic_ns()
+        if self._deadline is None or self._deadline < now - self.interval_ns:
+            self._deadline = now
+        if self._deadline > now:
+            time.sleep((self._deadline - now) / 1e9)
+        self._deadline += self.interval_ns
+
+    def _run(self):
+        while True:
+            self._running.wait()
+            if self._stopping:
+                return
+
+            if self.policy == 'drop-oldest':
+                self._wait_for_deadline()
+            elif not self._wait_for_space():
+                continue
+
+            with self._space:
+                generation = self._generation
+                before_next = self._before_next
+            try:
+                if before_next is not None:
+                    before_next()
+                    with self._space:
+                        # Unless another flush() replaced it meanwhile
+                        if self._before_next is before_next:
+                            self._before_next = None
+                frame = self.source()
+            except Exception as e:
+                log.error(f"Frame source failed: {e}")
+                self._running.clear()
+                if self.on_error is not None:
+                    self.on_error(e)
+                continue
+
+            if frame is None:
+                time.sleep(IDLE_WAIT)
+                continue
+            if not self._running.is_set():
+                continue
+
+            with self._space:
+                if generation != self._generation:
+                    # Flushed while the source was producing it
+                    continue
+                if len(self._ring) == self.depth:
+                    self.dropped += 1
+                # A full deque drops its oldest frame itself
+                self._ring.append(frame)
+            self.produced += 1
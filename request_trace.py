@@ -0,0 +1,145 @@
+# Binary control request trace
+#
+# Instead of logging every request as a formatted string, TraceRing packs
+# each submission and completion into a fixed-size record of a preallocated
+# ring buffer: a struct.pack_into and a slice copy, no string formatting and
+# no allocation on the hot path. Optionally only one request in `sample` is
+# recorded.
+#
+# The ring is written out on demand (SIGUSR1) or when the emulator dies from
+# an unhandled exception, as a pcapng of Linux usbmon packets (link type 220),
+# the same as webcam_real_connect.pcap, so Wireshark, pcap_replay.py and
+# enum_timing.py all read it
+#
+# Record: timestamp (ns), urb id, event ('S'/'C'), device address, status,
+# setup packet, full data length, then up to TRACE_DATA_BYTES of data
+
+import os
+import signal
+import struct
+import sys
+import time
+
+from facedancer.logging import log
+
+
+TRACE_RECORD = struct.Struct('<QIBBbx8sI')
+TRACE_DATA_BYTES = 64
+TRACE_RECORD_SIZE = TRACE_RECORD.size + TRACE_DATA_BYTES
+
+EVENT_SUBMIT = ord('S')
+EVENT_COMPLETE = ord('C')
+
+STATUS_OK = 0
+STATUS_STALL = -32
+STATUS_IN_PROGRESS = -115
+
+# pcapng blocks and the 64 byte usbmon header, see pcap_replay.py
+LINKTYPE_USB_LINUX_MMAPPED = 220
+PCAPNG_SECTION_HEADER = struct.Struct('<IIIHHq')
+PCAPNG_INTERFACE_DESCRIPTION = struct.Struct('<IIHHI')
+PCAPNG_ENHANCED_PACKET = struct.Struct('<IIIIIII')
+# if_tsresol option: timestamps in nanoseconds
+PCAPNG_TSRESOL_NS = struct.pack('<HHB3xHH', 9, 1, 9, 0, 0)
+USBMON_HEADER = struct.Struct('<QBBBBHBBqiiII8siiII')
+USBMON_CONTROL = 2
+USBMON_BUS = 1
+
+
+class TraceRing:
+    """ The last `capacity` request events, recording one request in `sample` """
+
+    def __init__(self, capacity: int = 4096, sample: int = 1):
+        self.capacity = capacity
+        self.sample = max(1, sample)
+        self.buffer = bytearray(capacity * TRACE_RECORD_SIZE)
+        self._view = memoryview(self.buffer)
+        self.records = 0
+        self.requests = 0
+        self._urb = 0
+        self._setup = None
+        self._address = 0
+
+    def _record(self, event: int, address: int, status: int, setup: bytes, data):
+        offset = (self.records % self.capacity) * TRACE_RECORD_SIZE
+        length = len(data)
+        TRACE_RECORD.pack_into(self.buffer, offset, time.time_ns(), self._urb, event,
+                               address, status, setup, length)
+        captured = min(length, TRACE_DATA_BYTES)
+        start = offset + TRACE_RECORD.size
+        self._view[start:start + captured] = data[:captured]
+        self.records += 1
+
+    def submit(self, request, address: int = 0):
+        """ Record a request as it arrives; the completion that follows belongs to it """
+        self.requests += 1
+        if self.requests % self.sample:
+            self._setup = None
+            return
+        self._urb += 1
+        self._setup = struct.pack('<BBHHH', request.request_type, request.number,
+                                  request.value, request.index, request.length)
+        self._address = address
+        self._record(EVENT_SUBMIT, address, STATUS_IN_PROGRESS, self._setup, request.data or b'')
+
+    def complete(self, data=b'', status: int = STATUS_OK):
+        """ Record the reply (or acknowledgement, or stall) to the last submitted request """
+        if self._setup is None:
+            return
+        self._record(EVENT_COMPLETE, self._address, status, self._setup, data)
+        self._setup = None
+
+    def events(self):
+        """ Recorded events, oldest first, as (timestamp, urb, event, address, status, setup, length, data) """
+        first = max(0, self.records - self.capacity)
+        for index in range(first, self.records):
+            offset = (index % self.capacity) * TRACE_RECORD_SIZE
+            fields = TRACE_RECORD.unpack_from(self.buffer, offset)
+            captured = min(fields[-1], TRACE_DATA_BYTES)
+            start = offset + TRACE_RECORD.size
+            yield (*fields, bytes(self.buffer[start:start + captured]))
+
+    def dump(self, path):
+        """ Write the ring to `path` as a usbmon pcapng """
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(PCAPNG_SECTION_HEADER.pack(0x0a0d0d0a, 28, 0x1a2b3c4d, 1, 0, -1))
+            f.write(struct.pack('<I', 28))
+            idb_length = PCAPNG_INTERFACE_DESCRIPTION.size + len(PCAPNG_TSRESOL_NS) + 4
+            f.write(PCAPNG_INTERFACE_DESCRIPTION.pack(1, idb_length, LINKTYPE_USB_LINUX_MMAPPED, 0,
+                                                      USBMON_HEADER.size + TRACE_DATA_BYTES))
+            f.write(PCAPNG_TSRESOL_NS)
+            f.write(struct.pack('<I', idb_length))
+
+            for timestamp, urb, event, address, status, setup, length, data in self.events():
+                submit = event == EVENT_SUBMIT
+                # The endpoint carries the direction of the data stage
+                endpoint = 0x80 if setup[0] & 0x80 else 0x00
+                packet = USBMON_HEADER.pack(
+                    urb, event, USBMON_CONTROL, endpoint, address, USBMON_BUS,
+                    0 if submit else ord('-'), 0 if data else ord('<' if submit else '>'),
+                    timestamp // 1000000000, timestamp // 1000 % 1000000, status,
+                    length, len(data), setup if submit else bytes(8), 0, 0, 0, 0) + data
+                padding = -len(packet) % 4
+                block_length = PCAPNG_ENHANCED_PACKET.size + len(packet) + padding + 4
+                f.write(PCAPNG_ENHANCED_PACKET.pack(6, block_length, 0, timestamp >> 32,
+                                                    timestamp & 0xffffffff, len(packet),
+                                                    USBMON_HEADER.size + length))
+                f.write(packet + bytes(padding))
+                f.write(struct.pack('<I', block_length))
+        os.replace(tmp, path)
+        log.info(f"Wrote {min(self.records, self.capacity)} trace records to {path}")
+
+    def install_dump_handlers(self, path):
+        """ Dump to `path` on SIGUSR1 and on an unhandled exception """
+        previous_hook = sys.excepthook
+
+        def dump_on_crash(kind, value, traceback):
+            try:
+                self.dump(path)
+            finally:
+                previous_hook(kind, value, traceback)
+
+        sys.excepthook = dump_on_crash
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump(path))
@@ -0,0 +1,120 @@
+# Frame pacing
+#
+# Frames are released on absolute deadlines, t0 + n * frame interval, read
+# from the monotonic clock, so error doesn't accumulate the way sleeping for
+# "one interval" after each frame does. Within a frame, payloads are spread
+# evenly over the interval instead of being sent as fast as the host polls.
+#
+# Every release records its lateness (release time - deadline) and an
+# RFC 3550 style interarrival jitter estimate, so a stream that floods or
+# starves the host shows up in stats()
+
+import time
+
+from array import array
+
+
+# UVC frame intervals are in 100ns units
+FRAME_INTERVAL_UNIT_NS = 100
+
+# USB service intervals; (micro)frames of 1ms at full speed, 125us at high/super speed
+SERVICE_INTERVAL_FS_NS = 1000000
+SERVICE_INTERVAL_HS_NS = 125000
+
+LATENESS_HISTORY = 256
+
+
+class FramePacer:
+    """ Releases one frame per `frame_interval` (100ns units, as in dwFrameInterval) """
+
+    def __init__(self, frame_interval: int, service_interval_ns: int = SERVICE_INTERVAL_HS_NS,
+                 clock=time.monotonic_ns):
+        self.clock = clock
+        self.service_interval_ns = service_interval_ns
+        self.lateness = array('q', bytes(8 * LATENESS_HISTORY))
+        # Optional metrics.Histogram fed every release's lateness, in microseconds
+        self.lateness_histogram = None
+
+        # Totals over the pacer's lifetime; reset() leaves them alone, so they
+        # can be exported as counters
+        self.frames = 0
+        self.late_frames = 0
+        self.skipped_frames = 0
+        self.max_lateness_ns = 0
+        self.total_lateness_ns = 0
+        self.jitter_ns = 0.0
+
+        self.set_interval(frame_interval)
+
+    def set_interval(self, frame_interval: int):
+        """ Switch to a new frame interval, e.g. after a VS_COMMIT_CONTROL, and restart the schedule """
+        self.frame_interval = frame_interval
+        self.interval_ns = frame_interval * FRAME_INTERVAL_UNIT_NS
+        # Leave the last service interval of each frame free so a frame
+        # finishes before the next deadline
+        self.spread_ns = max(self.interval_ns - self.service_interval_ns, self.service_interval_ns)
+        self.reset()
+
+    def reset(self):
+        """ Restart the schedule; the next frame is due immediately """
+        self.deadline = None
+        self.frame_start = 0
+        self.last_release = None
+
+    def frame_due(self) -> bool:
+        """ True if the next frame should start now; nothing is recorded until release() """
+        now = self.clock()
+        if self.deadline is None:
+            self.deadline = now
+        return now >= self.deadline
+
+    def release(self):
+        """ Record that the due frame started and move the deadline to the next one """
+        now = self.clock()
+        lateness = now - self.deadline
+        self._record(now, lateness)
+
+        # Deadlines we slept through are skipped rather than sent back to back
+        missed = lateness // self.interval_ns
+        if missed:
+            self.skipped_frames += missed
+        self.deadline += (missed + 1) * self.interval_ns
+        self.frame_start = now
+
+    def payload_due(self, sent: int, frame_length: int) -> bool:
+        """ True if a payload should be sent now, given `sent` of `frame_length` bytes already went out """
+        if sent == 0:
+            return True
+        elapsed = self.clock() - self.frame_start
+        if elapsed >= self.spread_ns:
+            return True
+        return sent * self.spread_ns <= frame_length * elapsed
+
+    def _record(self, now: int, lateness: int):
+        self.lateness[self.frames % LATENESS_HISTORY] = lateness
+        if self.lateness_histogram is not None:
+            self.lateness_histogram.observe(lateness // 1000)
+        self.frames += 1
+        self.total_lateness_ns += lateness
+        if lateness > self.service_interval_ns:
+            self.late_frames += 1
+        if lateness > self.max_lateness_ns:
+            self.max_lateness_ns = lateness
+
+        if self.last_release is not None:
+            deviation = abs((now - self.last_release) - self.interval_ns)
+            self.jitter_ns += (deviation - self.jitter_ns) / 16
+        self.last_release = now
+
+    def stats(self) -> dict:
+        recent = self.lateness[:min(self.frames, LATENESS_HISTORY)]
+        return {
+            'frame_interval': self.frame_interval,
+            'frames': self.frames,
+            'late_frames': self.late_frames,
+            'skipped_frames': self.skipped_frames,
+            'mean_lateness_us': self.total_lateness_ns / self.frames / 1000 if self.frames else 0.0,
+            'max_lateness_us': self.max_lateness_ns / 1000,
+            'recent_max_lateness_us': max(recent, default=0) / 1000,
+            'jitter_us': self.jitter_ns / 1000,
+        }
@@ -0,0 +1,214 @@
+# Shared-memory frame handoff
+#
+# SharedFrameRing lets a separate process (an encoder running on other
+# cores, outside our GIL) hand finished frames to fake-cam through a block
+# of shared memory: the writer copies each frame into a slot, the reader
+# copies it out once, and nothing is pickled or sent over a socket. fake-cam creates the ring (FAKE_UVC_MJPEG=shm:NAME) and the
+# encoder attaches to it by name:
+#
+#   ring = SharedFrameRing.attach('fake-uvc')
+#   ring.write(jpeg_bytes)
+#
+#   ffmpeg -i input.mp4 -f mjpeg - | python shm_ring.py fake-uvc   feeds it from a pipe
+#
+# Layout, little endian:
+#
+#   0   header    magic 'UVCSHM01', u32 slot count, u32 slot size,
+#                 u64 published, u64 held, u64 frames written
+#   64  slots     per slot: u64 sequence number (0 while being written), u32 length, u32 reserved
+#   ..  data      slot_count * slot_size, starting on a 64 byte boundary
+#
+# There is one writer and one reader, and each slot is a seqlock. The
+# writer marks a slot as being written (sequence 0), fills it, then stores
+# its new sequence number and publishes the frame by writing
+# (sequence << 8 | slot) to `published`. The reader checks the slot's
+# sequence matches, copies the frame out and reads the sequence again: if
+# it changed, the writer got to the slot meanwhile and the copy is dropped.
+# That needs the stores of each side to be seen in order and the loads not
+# to pass each other, never a store ordered before a later load, so it
+# holds between processes on x86 and without any lock. The reader also
+# notes the frame it's copying in `held`, and the writer avoids that slot
+# and the published one when it can, so with three or more slots drops
+# only happen when the reader stalls mid-copy; a reader that falls behind
+# simply gets the newest frame
+
+import atexit
+import struct
+import sys
+
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+from facedancer.logging import log
+
+
+SHM_PREFIX = 'shm:'
+
+MAGIC = b'UVCSHM01'
+HEADER = struct.Struct('<8sIIQQQ')
+HEADER_SIZE = 64
+PUBLISHED_OFFSET = 16
+HELD_OFFSET = 24
+WRITTEN_OFFSET = 32
+
+SLOT = struct.Struct('<QII')
+
+U64 = struct.Struct('<Q')
+
+MIN_SLOTS = 3
+DEFAULT_SLOTS = 4
+DEFAULT_SLOT_SIZE = 4 * 1024 * 1024
+
+
+def data_offset(slot_count: int) -> int:
+    return (HEADER_SIZE + slot_count * SLOT.size + 63) & ~63
+
+
+class SharedFrameRing:
+    """
+    A frame ring in shared memory; use create() in the reader (fake-cam) and
+    attach() in the writer. Calling the ring returns a copy of the newest
+    frame not returned before, or None
+    """
+
+    def __init__(self, memory: SharedMemory, owner: bool):
+        self.memory = memory
+        self.owner = owner
+        self._buffer = memory.buf
+
+        magic, self.slot_count, self.slot_size, _, _, _ = HEADER.unpack_from(self._buffer)
+        if magic != MAGIC:
+            raise ValueError(f"Shared memory {memory.name} is not a frame ring")
+        self._data_offset = data_offset(self.slot_count)
+
+        # Writer state
+        self._sequence = 0
+        self._slot = 0
+        # Reader state
+        self._taken = 0
+        self.skipped = 0
+
+    @classmethod
+    def create(cls, name: str, slot_count: int = DEFAULT_SLOTS, slot_size: int = DEFAULT_SLOT_SIZE):
+        if slot_count < MIN_SLOTS or slot_count > 256:
+            raise ValueError(f"A frame ring needs {MIN_SLOTS} to 256 slots, not {slot_count}")
+        size = data_offset(slot_count) + slot_count * slot_size
+        try:
+            memory = SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a previous run that didn't clean up
+            stale = SharedMemory(name, track=False)
+            stale.unlink()
+            stale.close()
+            memory = SharedMemory(name, create=True, size=size)
+        HEADER.pack_into(memory.buf, 0, MAGIC, slot_count, slot_size, 0, 0, 0)
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name: str):
+        # The creator owns the segment; don't let our resource tracker unlink it
+        return cls(SharedMemory(name, track=False), owner=False)
+
+    def _slot_header(self, slot: int) -> int:
+        return HEADER_SIZE + slot * SLOT.size
+
+    def _slot_data(self, slot: int) -> memoryview:
+        start = self._data_offset + slot * self.slot_size
+        return self._buffer[start:start + self.slot_size]
+
+    #
+    # Writer
+    #
+
+    def write(self, frame) -> bool:
+        """ Publish `frame`; False if it doesn't fit in a slot """
+        length = len(frame)
+        if length > self.slot_size:
+            log.warning(f"{length} byte frame doesn't fit the {self.slot_size} byte slots of {self.memory.name}")
+            return False
+
+        buffer = self._buffer
+        published, = U64.unpack_from(buffer, PUBLISHED_OFFSET)
+        held, = U64.unpack_from(buffer, HELD_OFFSET)
+        busy = {value & 0xff for value in (published, held) if value}
+        slot = self._slot
+        while True:
+            slot = (slot + 1) % self.slot_count
+            if slot not in busy:
+                break
+
+        # Sequence 0 first, so a reader copying this slot sees it change
+        SLOT.pack_into(buffer, self._slot_header(slot), 0, 0, 0)
+        self._sequence += 1
+        self._slot_data(slot)[:length] = frame
+        SLOT.pack_into(buffer, self._slot_header(slot), self._sequence, length, 0)
+        U64.pack_into(buffer, PUBLISHED_OFFSET, self._sequence << 8 | slot)
+        U64.pack_into(buffer, WRITTEN_OFFSET, self._sequence)
+        self._slot = slot
+        return True
+
+    #
+    # Reader
+    #
+
+    def __call__(self) -> Optional[bytes]:
+        buffer = self._buffer
+        published, = U64.unpack_from(buffer, PUBLISHED_OFFSET)
+        if published == self._taken or not published:
+            return None
+
+        U64.pack_into(buffer, HELD_OFFSET, published)
+        sequence, slot = published >> 8, published & 0xff
+        header = self._slot_header(slot)
+        slot_sequence, length, _ = SLOT.unpack_from(buffer, header)
+        if slot_sequence != sequence:
+            # Overwritten since it was published; try again next time
+            return None
+        frame = bytes(self._slot_data(slot)[:length])
+        slot_sequence, = U64.unpack_from(buffer, header)
+        if slot_sequence != sequence:
+            # The writer reused the slot while we were copying it; the copy may be torn.
+            # Counted as skipped once a newer frame is taken
+            return None
+
+        self.skipped += sequence - (self._taken >> 8) - 1
+        self._taken = published
+        return frame
+
+    @property
+    def written(self) -> int:
+        return U64.unpack_from(self._buffer, WRITTEN_OFFSET)[0]
+
+    def close(self):
+        self._buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def is_shm_address(address: str) -> bool:
+    return address.startswith(SHM_PREFIX)
+
+
+def open_ring(address: str, slot_count: int = DEFAULT_SLOTS, slot_size: int = DEFAULT_SLOT_SIZE) -> SharedFrameRing:
+    """ Create the ring named by a FAKE_UVC_MJPEG=shm:NAME address """
+    name = address[len(SHM_PREFIX):]
+    ring = SharedFrameRing.create(name, slot_count, slot_size)
+    atexit.register(ring.close)
+    log.info(f"Waiting for frames in shared memory {name}, {slot_count} slots of {slot_size} bytes")
+    return ring
+
+
+if __name__ == "__main__":
+    # python shm_ring.py NAME < stream.mjpeg: feed an MJPEG stream on stdin into a ring
+    from live_source import LiveMJPEGSource
+
+    if len(sys.argv) != 2:
+        print(f"usage: {sys.argv[0]} NAME < stream.mjpeg", file=sys.stderr)
+        sys.exit(1)
+
+    ring = SharedFrameRing.attach(sys.argv[1])
+    source = LiveMJPEGSource('-')
+    while (frame := source()) is not None:
+        ring.write(frame)
+    ring.close()
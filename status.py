@@ -0,0 +1,146 @@
+# Status Interrupt Endpoint (UVC 1.5, 2.4.2.2)
+#
+# StatusQueue turns control changes, button presses and stream errors into
+# the status packets hosts read from the VideoControl interrupt endpoint,
+# so they learn about them without polling GET_CUR:
+#
+#   VideoControl   bStatusType 1, bOriginator (unit/terminal), bEvent 0 (control
+#                  change), bSelector, bAttribute, bValue (the new value, GET_CUR layout)
+#   VideoStreaming bStatusType 2, bOriginator (interface), bEvent 0 (button) or
+#                  1 (stream error, see VS_STREAM_ERROR_CODE_CONTROL), bValue
+#
+# Events are posted from anywhere (the USB loop, producer threads, signal
+# handlers) onto a deque, which appends atomically, and the endpoint drains
+# it once per interrupt interval: everything posted during the interval is
+# coalesced by what it reports (a control's value, a stream's error, a
+# button's state), so a control that changes ten times an interval costs
+# one packet with its latest value, and a value the host was already sent
+# last time isn't sent again. Hosts take one status packet per interrupt
+# transfer, so the coalesced events then go out one per interval, oldest
+# first
+
+import time
+
+from collections import OrderedDict, deque
+from typing import Optional
+
+import uvc
+from dispatch import ANY
+
+
+STATUS_VIDEO_CONTROL = 0x01
+STATUS_VIDEO_STREAMING = 0x02
+
+# VideoControl bEvent and bAttribute
+EVENT_CONTROL_CHANGE = 0x00
+ATTRIBUTE_VALUE = 0x00
+ATTRIBUTE_INFO = 0x01
+ATTRIBUTE_FAILURE = 0x02
+
+# VideoStreaming bEvent
+EVENT_BUTTON = 0x00
+EVENT_STREAM_ERROR = 0x01
+BUTTON_RELEASED = 0x00
+BUTTON_PRESSED = 0x01
+
+# 4.3.1.7 Stream Error Code Control
+STREAM_ERROR_NONE = 0x00
+STREAM_ERROR_INPUT_UNDERRUN = 0x02
+STREAM_ERROR_DISCONTINUITY = 0x03
+STREAM_ERROR_FORMAT_CHANGE = 0x06
+STREAM_ERROR_STILL_CAPTURE = 0x07
+STREAM_ERROR_UNKNOWN = 0x08
+
+# GET_INFO: supports GET
+INFO_GET = b'\x01'
+
+
+def interrupt_interval_ns(b_interval: int, high_speed: bool) -> int:
+    """ Service interval of an interrupt endpoint's bInterval (USB 2.0, 9.6.6) """
+    if high_speed:
+        return (1 << (b_interval - 1)) * 125000
+    return b_interval * 1000000
+
+
+class StatusQueue:
+    """ Status events for the interrupt endpoint, sent at most one per `interval_ns` """
+
+    def __init__(self, interval_ns: int):
+        self.interval_ns = interval_ns
+        # (key, packet, stateful) posted since the last drain
+        self._inbox = deque()
+        # key -> packet, in the order first posted
+        self._pending = OrderedDict()
+        # Last packet sent for each stateful key
+        self._sent = {}
+        self._next_send = 0
+
+        # VS_STREAM_ERROR_CODE_CONTROL
+        self.stream_error_code = STREAM_ERROR_NONE
+
+        self.posted = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    def post(self, key: tuple, packet: bytes, stateful: bool = True):
+        """
+        Queue a status packet; a later packet with the same key replaces it.
+        A stateful packet (a value, not an occurrence) identical to the last
+        one sent for its key is dropped
+        """
+        self._inbox.append((key, packet, stateful))
+
+    def control_changed(self, originator: int, selector: int, value: bytes, attribute: int = ATTRIBUTE_VALUE):
+        header = bytes((STATUS_VIDEO_CONTROL, originator, EVENT_CONTROL_CHANGE, selector, attribute))
+        self.post((STATUS_VIDEO_CONTROL, originator, selector, attribute), header + value)
+
+    def button(self, interface: int, pressed: bool):
+        state = BUTTON_PRESSED if pressed else BUTTON_RELEASED
+        packet = bytes((STATUS_VIDEO_STREAMING, interface, EVENT_BUTTON, state))
+        # Presses and releases are occurrences; repeated presses within an interval collapse into one
+        self.post((STATUS_VIDEO_STREAMING, interface, EVENT_BUTTON, state), packet, stateful=False)
+
+    def stream_error(self, interface: int, code: int):
+        self.stream_error_code = code
+        packet = bytes((STATUS_VIDEO_STREAMING, interface, EVENT_STREAM_ERROR, code))
+        self.post((STATUS_VIDEO_STREAMING, interface, EVENT_STREAM_ERROR), packet, stateful=False)
+
+    def due(self, now: int = None) -> bool:
+        """ Whether an interrupt interval has passed since the last packet """
+        return (now if now is not None else time.monotonic_ns()) >= self._next_send
+
+    def next_packet(self) -> Optional[bytes]:
+        """ The next status packet to send, or None if there is none or it isn't time yet """
+        now = time.monotonic_ns()
+        if now < self._next_send:
+            return None
+        self._drain()
+        while self._pending:
+            key, (packet, stateful) = self._pending.popitem(last=False)
+            if stateful:
+                if self._sent.get(key) == packet:
+                    self.coalesced += 1
+                    continue
+                self._sent[key] = packet
+            self.sent += 1
+            self._next_send = now + self.interval_ns
+            return packet
+        return None
+
+    def _drain(self):
+        inbox = self._inbox
+        pending = self._pending
+        while inbox:
+            key, packet, stateful = inbox.popleft()
+            self.posted += 1
+            if key in pending:
+                self.coalesced += 1
+            pending[key] = (packet, stateful)
+
+    def register(self, dispatcher, interface: int, alternates):
+        """ Add VS_STREAM_ERROR_CODE_CONTROL for `interface` to `dispatcher`, for each alternate setting """
+        selector = uvc.UVC.VS_STREAM_ERROR_CODE_CONTROL
+        for alternate in alternates:
+            dispatcher.add(interface, alternate, uvc.UVC.GET_INFO, selector, ANY, INFO_GET)
+            dispatcher.add(interface, alternate, uvc.UVC.GET_CUR, selector, ANY,
+                           lambda request: request.reply(bytes([self.stream_error_code])[:request.length]))
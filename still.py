@@ -0,0 +1,223 @@
+# Still image capture (UVC 1.5, 2.4.2.4 Still Image Capture)
+#
+# Method 1 needs nothing from the device: the host keeps a frame of the video
+# stream. With method 2 the host picks a still size with the Video Still
+# Probe and Commit Controls (4.3.1.2), from the Still Image Frame descriptor
+# after each format's frames, and asks for a still with SET_CUR of the Still
+# Image Trigger Control (4.3.1.3). The still then goes out on the video pipe
+# in place of the next video frame, with STI set in its payload headers, and
+# the trigger reads back as normal operation once it's sent.
+#
+# Stills are encoded ahead of time: each still size of a format is a JPEG
+# file, memory mapped when the device starts, so a trigger only hands the
+# payload engine a view of it and the still starts at the next frame slot,
+# within one frame interval, while the video source keeps producing as
+# before. A format without still files (the uncompressed test pattern) sends
+# its next video frame as the still, at the video frame size
+
+import struct
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+from facedancer.logging import log
+
+import uvc
+from dispatch import ANY
+from frame_source import MJPEGFileSource, jpeg_size
+
+
+# bFormatIndex, bFrameIndex, bCompressionIndex, dwMaxVideoFrameSize, dwMaxPayloadTransferSize
+STILL_PROBE = struct.Struct('<BBBII')
+STILL_PROBE_FIELDS = ('bFormatIndex', 'bFrameIndex', 'bCompressionIndex',
+                      'dwMaxVideoFrameSize', 'dwMaxPayloadTransferSize')
+
+# bTrigger values of the Still Image Trigger Control
+TRIGGER_NORMAL = 0
+TRIGGER_TRANSMIT = 1
+TRIGGER_TRANSMIT_BULK = 2
+TRIGGER_ABORT = 3
+
+# GET_INFO: supports GET and SET
+INFO_GET_SET = b'\x03'
+
+
+@dataclass
+class StillFormat:
+    """
+    The still images of one format: a cached JPEG per still size, or just the
+    video frame size when stills are taken from the video
+    """
+    format_index: int
+    sizes: List[tuple]
+    stills: list = field(default_factory=list)
+    # bCompression values of the Still Image Frame descriptor
+    compressions: List[int] = field(default_factory=list)
+
+    @classmethod
+    def from_files(cls, format_index: int, paths: List[str]):
+        """ One still size per JPEG file, in the order given """
+        stills = [MJPEGFileSource(path)[0] for path in paths]
+        sizes = [jpeg_size(still) for still in stills]
+        for path, (width, height) in zip(paths, sizes):
+            log.info(f"Still image {width}x{height} from {path}")
+        return cls(format_index, sizes, stills, compressions=[1])
+
+    def descriptor_fields(self) -> dict:
+        """ Fields of the ClassSpecificVideoStreamStillImageFrameDescriptor for this format """
+        return {
+            'bEndpointAddress': 0x00,
+            'wImageSizes': [{'wWidth': width, 'wHeight': height} for width, height in self.sizes],
+            'bCompression': self.compressions,
+        }
+
+
+def pack_still_probe(values: dict) -> bytes:
+    return STILL_PROBE.pack(*(values.get(name, 0) for name in STILL_PROBE_FIELDS))
+
+
+def unpack_still_probe(data: bytes) -> dict:
+    data = bytes(data[:STILL_PROBE.size]).ljust(STILL_PROBE.size, b'\x00')
+    return dict(zip(STILL_PROBE_FIELDS, STILL_PROBE.unpack(data)))
+
+
+class StillCapture:
+    """
+    VS_STILL_PROBE_CONTROL/VS_STILL_COMMIT_CONTROL/VS_STILL_IMAGE_TRIGGER_CONTROL
+    state for one VideoStreaming interface
+
+    formats       : a StillFormat for each video format
+    video_commit  : returns the committed video probe/commit values; stills of
+                    the committed format are sent, with its payload size
+    payloads      : the payload.PayloadEngine the stills are injected into
+    """
+
+    def __init__(self, formats: List[StillFormat], video_commit: Callable[[], dict], payloads):
+        self.formats: Dict[int, StillFormat] = {f.format_index: f for f in formats}
+        self.default_format = formats[0].format_index
+        self.video_commit = video_commit
+        self.payloads = payloads
+        payloads.on_still_sent = self.handle_still_sent
+
+        self.trigger = TRIGGER_NORMAL
+        self.default = self.negotiate({})
+        self.probe = dict(self.default)
+        self.commit = dict(self.default)
+
+    def negotiate(self, requested: dict) -> dict:
+        """ Clamp a still probe from the host to a still size this device has """
+        still_format = self.formats.get(requested.get('bFormatIndex', 0))
+        if still_format is None:
+            still_format = self.formats[self.default_format]
+        frame_index = requested.get('bFrameIndex', 0)
+        if not 1 <= frame_index <= len(still_format.sizes):
+            frame_index = 1
+        compression_index = requested.get('bCompressionIndex', 0)
+        if not 1 <= compression_index <= len(still_format.compressions):
+            compression_index = 1 if still_format.compressions else 0
+
+        video = self.video_commit()
+        if still_format.stills:
+            frame_size = len(still_format.stills[frame_index - 1])
+        else:
+            frame_size = video['dwMaxVideoFrameSize']
+        return {
+            'bFormatIndex': still_format.format_index,
+            'bFrameIndex': frame_index,
+            'bCompressionIndex': compression_index,
+            'dwMaxVideoFrameSize': frame_size,
+            'dwMaxPayloadTransferSize': video['dwMaxPayloadTransferSize'],
+        }
+
+    def limit(self, which: str) -> dict:
+        """ GET_MIN/GET_MAX: the first/last still size and compression of the probed format """
+        still_format = self.formats.get(self.probe['bFormatIndex'], self.formats[self.default_format])
+        if which == 'min':
+            return self.negotiate({**self.probe, 'bFrameIndex': 1, 'bCompressionIndex': 1})
+        return self.negotiate({**self.probe, 'bFrameIndex': len(still_format.sizes),
+                               'bCompressionIndex': len(still_format.compressions)})
+
+    def still_for(self, values: dict):
+        """ The cached still `values` select, or None to take it from the video """
+        still_format = self.formats[values['bFormatIndex']]
+        if not still_format.stills:
+            return None
+        return still_format.stills[values['bFrameIndex'] - 1]
+
+    #
+    # Request handlers, registered in a RequestDispatcher by register()
+    #
+
+    def handle_set_probe(self, request):
+        self.probe = self.negotiate(unpack_still_probe(request.data))
+        request.ack()
+
+    def handle_set_commit(self, request):
+        self.commit = self.negotiate(unpack_still_probe(request.data))
+        self.probe = dict(self.commit)
+        log.info(f"Committed still format {self.commit['bFormatIndex']} frame {self.commit['bFrameIndex']} "
+                 f"size {self.commit['dwMaxVideoFrameSize']}")
+        request.ack()
+
+    def handle_set_trigger(self, request):
+        trigger = request.data[0] if request.data else TRIGGER_NORMAL
+        if trigger == TRIGGER_TRANSMIT:
+            video_format = self.video_commit()['bFormatIndex']
+            if video_format not in self.formats:
+                # No still image frame descriptor, e.g. H.264: nothing to send the still as
+                log.info(f"No still images in format {video_format}")
+                request.stall()
+                return
+            if self.commit['bFormatIndex'] != video_format:
+                # The still goes out in the streaming format; use its first size
+                self.commit = self.negotiate({'bFormatIndex': video_format})
+            self.payloads.inject_still(self.still_for(self.commit))
+            log.info(f"Still image triggered, format {self.commit['bFormatIndex']} "
+                     f"frame {self.commit['bFrameIndex']}")
+        elif trigger == TRIGGER_ABORT or trigger == TRIGGER_NORMAL:
+            # Nothing to abort once the still has started; it's one frame
+            trigger = TRIGGER_NORMAL
+        else:
+            # Method 3 (a dedicated bulk still endpoint) isn't supported
+            request.stall()
+            return
+        self.trigger = trigger
+        request.ack()
+
+    def handle_still_sent(self):
+        self.trigger = TRIGGER_NORMAL
+
+    def _reply(self, request, values: dict):
+        request.reply(pack_still_probe(values)[:request.length])
+
+    def register(self, dispatcher, interface: int, alternates):
+        """ Add the still image control handlers for `interface` to `dispatcher`, for each alternate setting """
+        UVC = uvc.UVC
+        length = STILL_PROBE.size.to_bytes(2, 'little')
+        for alternate in alternates:
+            for selector in (UVC.VS_STILL_PROBE_CONTROL, UVC.VS_STILL_COMMIT_CONTROL):
+                dispatcher.add(interface, alternate, UVC.GET_INFO, selector, ANY, INFO_GET_SET)
+                dispatcher.add(interface, alternate, UVC.GET_LEN, selector, ANY, length)
+
+            probe = UVC.VS_STILL_PROBE_CONTROL
+            dispatcher.add(interface, alternate, UVC.SET_CUR, probe, ANY, self.handle_set_probe)
+            dispatcher.add(interface, alternate, UVC.GET_CUR, probe, ANY,
+                           lambda request: self._reply(request, self.probe))
+            dispatcher.add(interface, alternate, UVC.GET_DEF, probe, ANY,
+                           lambda request: self._reply(request, self.default))
+            dispatcher.add(interface, alternate, UVC.GET_MIN, probe, ANY,
+                           lambda request: self._reply(request, self.limit('min')))
+            dispatcher.add(interface, alternate, UVC.GET_MAX, probe, ANY,
+                           lambda request: self._reply(request, self.limit('max')))
+
+            commit = UVC.VS_STILL_COMMIT_CONTROL
+            dispatcher.add(interface, alternate, UVC.SET_CUR, commit, ANY, self.handle_set_commit)
+            dispatcher.add(interface, alternate, UVC.GET_CUR, commit, ANY,
+                           lambda request: self._reply(request, self.commit))
+
+            trigger = UVC.VS_STILL_IMAGE_TRIGGER_CONTROL
+            dispatcher.add(interface, alternate, UVC.GET_INFO, trigger, ANY, INFO_GET_SET)
+            dispatcher.add(interface, alternate, UVC.GET_LEN, trigger, ANY, b'\x01\x00')
+            dispatcher.add(interface, alternate, UVC.SET_CUR, trigger, ANY, self.handle_set_trigger)
+            dispatcher.add(interface, alternate, UVC.GET_CUR, trigger, ANY,
+                           lambda request: request.reply(bytes([self.trigger])[:request.length]))
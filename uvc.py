@@ -1,7 +1,4 @@
-from enum import IntEnum, Enum, auto
-from usb_protocol.types.descriptor import DescriptorFormat, DescriptorNumber, DescriptorField
-
-import construct
+from enum import IntEnum, IntFlag, Enum, auto
 
 class UVC(IntEnum):
     # Video Interface Class Code
@@ -181,6 +178,17 @@ class UVC(IntEnum):
     VS_UPDATE_FRAME_SEGMENT_CONTROL = 0x08
     VS_SYNCH_DELAY_CONTROL = 0x09
 
+""" 2.4.3.3 Video and Still Image Payload Headers, bmHeaderInfo """
+class UVCPayloadHeader(IntFlag):
+    FID = 0x01  # Frame ID, toggles at each frame start boundary
+    EOF = 0x02  # End of Frame
+    PTS = 0x04  # dwPresentationTime field present
+    SCR = 0x08  # dwSourceClockReference + wSofCounter present
+    RES = 0x10  # Reserved (UVC 1.0 payload specific)
+    STI = 0x20  # Still Image
+    ERR = 0x40  # Error
+    EOH = 0x80  # End of Header
+
 class UVCError(Enum):
     SUCCESS = (0, "Success (no error)")
     ERROR_IO = (-1, "Input/output error")
@@ -220,160 +228,12 @@ class UVCError(Enum):
         raise ValueError(f"{cls.__name__} has no member with code {value}")
 
 
-InterfaceAssociationDescriptor = DescriptorFormat(
-    "bLength"                / construct.Const(8, construct.Int8ul),
-    "bDescriptorType"        / DescriptorNumber(0x0B),
-    "bFirstInterface"        / DescriptorField("First Interface", default=0x01),
-    "bInterfaceCount"        / DescriptorField("Interface Count", default=0x01),
-    "bFunctionClass"         / DescriptorField("Function Class", default=UVC.CC_VIDEO),
-    "bFunctionSubClass"      / DescriptorField("Function Subclass", default=UVC.SC_VIDEO_INTERFACE_COLLECTION),
-    "bFunctionProtocol"      / DescriptorField("Function Protocol", default=UVC.PC_PROTOCOL_UNDEFINED),
-    "iFunction"              / DescriptorField("Function String", default=0x00),
-)
-
-ClassSpecificVCInterfaceHeader = DescriptorFormat(
-    "bLength"                / construct.Const(13, construct.Int8ul),
-    "bDescriptorType"        / DescriptorNumber(UVC.CS_INTERFACE),
-    "bDescriptorSubType"     / DescriptorNumber(UVC.VC_HEADER),
-    "bcdUVC"                 / DescriptorField("bcdUVC", default=0x0100),
-    "wTotalLength"           / DescriptorField("wTotalLength", default=0x00),
-    "dwClockFrequency"       / DescriptorField("dwClockFrequency", length=4),
-    # TODO: bInCollection is dynamic based on length of baInterfaceNr, which is list[Byte]
-    "bInCollection"          / DescriptorField("Number of VideoStreaming Interfaces", default=0x01),
-    "baInterfaceNr"          / DescriptorField("baInterfaceNr", length=1, default=0x01),
-)
-
-""" Table 3-4 Input Terminal Descriptor"""
-InputTerminalDescriptorComposite = DescriptorFormat(
-    # TODO: length is 8+n (default +0 here)
-    "bLength"                / construct.Const(8, construct.Int8ul),
-    "bDescriptorType"        / DescriptorNumber(UVC.CS_INTERFACE),
-    "bDescriptorSubType"     / DescriptorNumber(UVC.VC_INPUT_TERMINAL),
-    "bTerminalID"            / DescriptorField("bTerminalID", default=0x01),
-    "wTerminalType"            / construct.Const(0x0401, construct.Int16ul),
-    "bAssocTerminal"         / DescriptorField("bAssocTerminal", default=0x00),
-    "iTerminal"              / DescriptorField("iTerminal", default=0x00),
-)
-
-""" Table 3-4 Input Terminal Descriptor"""
-InputTerminalCameraInputDescriptor = DescriptorFormat(
-    # TODO: length is 8+n (default +10 here)
-    "bLength"                  / construct.Const(18, construct.Int8ul),
-    "bDescriptorType"          / DescriptorNumber(UVC.CS_INTERFACE),
-    "bDescriptorSubType"       / DescriptorNumber(UVC.VC_INPUT_TERMINAL),
-    "bTerminalID"              / DescriptorField("bTerminalID", default=0x01),
-    "wTerminalType"            / construct.Const(0x0201, construct.Int16ul),
-    "bAssocTerminal"           / DescriptorField("bAssocTerminal", default=0x00),
-    "iTerminal"                / DescriptorField("iTerminal", default=0x00),
-    "wObjectiveFocalLengthMin" / DescriptorField("wObjectiveFocalLengthMin", default=0x0000),
-    "wObjectiveFocalLengthMax" / DescriptorField("wObjectiveFocalLengthMax", default=0x0000),
-    "wOcularFocalLength"       / DescriptorField("wOcularFocalLength", default=0x0000),
-    # This controls the size of bmControls, but seems it's just 3 for this descriptor sub type
-    "bControlSize"            / DescriptorField("bControlSize", default=3),
-    "bmControls"              / DescriptorField("bmControls", length=3, default=0x000000),
-)
-
-
-""" Table 3-5 Output Terminal Descriptor """
-OutputTerminalDescriptor = DescriptorFormat(
-    # TODO: length is 9+n (default +0 here)
-    "bLength"                / construct.Const(9, construct.Int8ul),
-    "bDescriptorType"        / DescriptorNumber(UVC.CS_INTERFACE),
-    "bDescriptorSubType"     / DescriptorNumber(UVC.VC_OUTPUT_TERMINAL),
-    "bTerminalID"            / DescriptorField("bTerminalID", default=0x02),
-    "wTerminalType"          / DescriptorField("wTerminalType", default=0x0101),
-    "bAssocTerminal"         / DescriptorField("bAssocTerminal", default=0x00),
-    "bSourceID"              / DescriptorField("bSourceID", default=0x01),
-    "iTerminal"              / DescriptorField("iTerminal", default=0x00),
-)
-
-""" Table 3-7 Selector Unit Descriptor """
-SelectorUnitDescriptor = DescriptorFormat(
-    # TODO: legnth is 6+n (default +1 here)
-    "bLength"                / construct.Const(7, construct.Int8ul),
-    "bDescriptorType"        / DescriptorNumber(UVC.CS_INTERFACE),
-    "bDescriptorSubType"     / DescriptorNumber(UVC.VC_SELECTOR_UNIT),
-    "bUnitID"                / DescriptorField("bUnitID", default=0x05),
-    "bNrInPins"              / DescriptorField("bNrInPins", default=0x01),
-    "baSourceID"             / DescriptorField("baSourceID", length=1, default=0x01),
-    "iSelector"              / DescriptorField("iSelector", default=0x00),
-)
-
-""" Table 3-8 Processing Unit Descriptor """
-ProcessingUnitDescriptor = DescriptorFormat(
-    "bLength"                / construct.Const(13, construct.Int8ul),
-    "bDescriptorType"        / DescriptorNumber(UVC.CS_INTERFACE),
-    "bDescriptorSubType"     / DescriptorNumber(UVC.VC_PROCESSING_UNIT),
-    "bUnitID"                / DescriptorField("bUnitID", default=0x05),
-    "bSourceID"              / DescriptorField("bSourceID", default=0x04),
-    "wMaxMultiplier"         / DescriptorField("wMaxMultiplier", default=0x0000),
-    "bControlSize"           / DescriptorField("bControlSize", default=3),
-    "bmControls"             / DescriptorField("bmControls", length=3, default=0x000000),
-    "iProcessing"            / DescriptorField("iProcessing", default=0x00),
-    "bmVideoStandards"       / DescriptorField("bmVideoStandards", default=0x00),
-)
-
-""" Table 3-14 Class-specific VS Interface Input Header Descriptor """
-ClassSpecificVideoStreamInputHeaderDescriptor = DescriptorFormat(
-    # TODO: bLength is 13+bControlSize (default +1 here)
-    "bLength"                / construct.Const(14, construct.Int8ul),
-    "bDescriptorType"        / DescriptorNumber(UVC.CS_INTERFACE),
-    "bDescriptorSubType"     / DescriptorNumber(UVC.VS_INPUT_HEADER),
-    "bNumFormats"            / DescriptorField("bNumFormats", default=0x01),
-    "wTotalLength"           / DescriptorField("wTotalLength", default=0x00),
-    "bEndPointAddress"       / DescriptorField("bEndPointAddress", default=0x81),
-    "bmInfo"                 / DescriptorField("bmInfo", default=0x00),
-    "bTerminalLink"          / DescriptorField("bTerminalLink", default=0x01),
-    "bStillCaptureMethod"    / DescriptorField("bStillCaptureMethod", default=0x00),
-    "bTriggerSupport"        / DescriptorField("bTriggerSupport", default=0x00),
-    "bTriggerUsage"          / DescriptorField("bTriggerUsage", default=0x00),
-    # TODO: bControlSize is dynamic based on bmaControls, which is list[Byte]
-    "bControlSize"           / DescriptorField("bControlSize", default=0x01),
-    "bmaControls"            / DescriptorField("bmaControls", length=1, default=0x00),
-)
-
-
-"""
-Loosely based on Table 3-18 Still Image Frame Descriptor
-This is more complex and dependson bDescriptorSubType
-Defauling to mjpeg for this one
-"""
-ClassSpecificVideoStreamFormatDescriptorMJPEG = DescriptorFormat(
-    # TODO: bLength is 10+(4*bNumImageSizePatterns)
-    "bLength"                / construct.Const(11, construct.Int8ul),
-    "bDescriptorType"        / DescriptorNumber(UVC.CS_INTERFACE),
-    "bDescriptorSubType"     / DescriptorNumber(UVC.VS_FORMAT_MJPEG),
-    "bFormatIndex"           / DescriptorField("bFormatIndex", default=0x01),
-    "bNumFrameDescriptors"   / DescriptorField("bNumFrameDescriptors", default=0x01),
-    "bmFlags"                / DescriptorField("bmFlags", default=0x00),
-    "bDefaultFrameIndex"     / DescriptorField("bDefaultFrameIndex", default=0x01),
-    "bAspectRatioX"          / DescriptorField("bAspectRatioX", default=0x00),
-    "bAspectRatioY"          / DescriptorField("bAspectRatioY", default=0x00),
-    "bmInterlaceFlags"       / DescriptorField("bmInterlaceFlags", default=0x00),
-    "bCopyProtect"           / DescriptorField("bCopyProtect", default=0x00),
-)
-
-
-"""
-Loosely based on Table 3-18 Still Image Frame Descriptor
-This is more complex and dependson bDescriptorSubType
-Defauling to mjpeg for this one
-"""
-ClassSpecificVideoStreamFrameDescriptorMJPEG = DescriptorFormat(
-    "bLength"                / construct.Const(38, construct.Int8ul),
-    "bDescriptorType"        / DescriptorNumber(UVC.CS_INTERFACE),
-    "bDescriptorSubType"     / DescriptorNumber(UVC.VS_FRAME_MJPEG),
-    "bFrameIndex"            / DescriptorField("bFrameIndex", default=0x01),
-    "bmCapabilities"         / DescriptorField("bmCapabilities", default=0x03),
-    "wWidth"                 / DescriptorField("wWidth", default=0x00B0),
-    "wHeight"                / DescriptorField("wHeight", default=0x0090),
-    "dwMinBitRate"           / DescriptorField("dwMinBitRate", default=0x000DEC00, length=4),
-    "dwMaxBitRate"           / DescriptorField("dwMaxBitRate", default=0x000DEC00, length=4),
-    "dwMaxVideoFrameBufSize" / DescriptorField("dwMaxVideoFrameBufSize", default=0x00009480, length=4),
-    "dwDefaultFrameInterval" / DescriptorField("dwDefaultFrameInterval", default=0x000A2C2A, length=4),
-    "bFrameIntervalType"     / DescriptorField("bFrameIntervalType", default=0x00),
-    "dwMinFrameInterval"     / DescriptorField("dwMinFrameInterval", default=0x000A2C2A, length=4),
-    "dwMaxFrameInterval"     / DescriptorField("dwMaxFrameInterval", default=0x000A2C2A, length=4),
-    "dwFrameIntervalStep"    / DescriptorField("dwFrameIntervalStep", default=0x00000000, length=4),
-
-)
+def __getattr__(name):
+    # The construct-based descriptor formats live in uvc_descriptors, which is
+    # only imported the first time one is used; importing construct dominates
+    # startup, and descriptors.py usually serves a cached build instead
+    import uvc_descriptors
+    try:
+        return getattr(uvc_descriptors, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None